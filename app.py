@@ -4,18 +4,29 @@ import time
 import base64
 import uuid
 import json
-from flask import Flask, render_template, request, jsonify, send_file, url_for
+from flask import Flask, Response, render_template, request, jsonify, send_file, url_for
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.lib import colors
-from PIL import Image
-import io
-from gtts import gTTS
 import logging
+import re
+import io
+import itertools
+import shutil
+import hashlib
+import hmac
+import contextlib
+import fcntl
+import queue
+import threading
+import functools
+import mimetypes
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from scene_analysis import extract_scene_keywords, STOP_WORDS
+from static_assets import install_static_assets
+from tts_backends import ChunkedSpeech, create_backend as create_tts_backend, VOICES as TTS_VOICES, SPEEDS as TTS_SPEEDS
+from task_queue import TaskWorker, TaskDeferred, TaskQueueError, create_task_queue, dispatch as dispatch_task_queue
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here')
@@ -49,11 +60,794 @@ FREEPIK_HEADERS = {
     "Content-Type": "application/json"
 }
 
-def generate_story_pages(prompt, story_length="normal"):
-    """Generate a children's story with enhanced length options"""
+# Streaming limits for Freepik responses: read size, largest accepted image, and the
+# most JSON buffered while looking for the image data
+IMAGE_CHUNK_BYTES = 64 * 1024
+FREEPIK_MAX_IMAGE_BYTES = int(os.getenv("FREEPIK_MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+FREEPIK_MAX_METADATA_BYTES = 1024 * 1024
+
+# Downloaded page images are verified and re-encoded to IMAGE_FORMAT ("jpeg", "webp"
+# or "png"); each IMAGE_QUALITY tier is (longest edge in pixels, encoder quality)
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()
+IMAGE_QUALITY_TIERS = {
+    'high': (1600, 90),
+    'standard': (1024, 82),
+    'compact': (768, 70)
+}
+IMAGE_QUALITY = os.getenv("IMAGE_QUALITY", "standard").lower()
+
+# Narration: TTS_BACKEND is "gtts", or "stub" for offline tests and benchmarks; sentence
+# chunks are synthesized on TTS_CHUNK_WORKERS shared threads. TTS_VOICE and TTS_SPEED
+# are the defaults for stories that do not choose their own
+TTS_BACKEND = os.getenv("TTS_BACKEND", "gtts").lower()
+TTS_CHUNK_WORKERS = int(os.getenv("TTS_CHUNK_WORKERS", "8"))
+TTS_VOICE = os.getenv("TTS_VOICE", "us").lower()
+TTS_SPEED = os.getenv("TTS_SPEED", "normal").lower()
+# Checked once here; otherwise every story would fail when its narration settings are read
+if TTS_VOICE not in TTS_VOICES:
+    raise ValueError(f"TTS_VOICE must be one of {', '.join(TTS_VOICES)}, not {TTS_VOICE!r}")
+if TTS_SPEED not in TTS_SPEEDS:
+    raise ValueError(f"TTS_SPEED must be one of {', '.join(TTS_SPEEDS)}, not {TTS_SPEED!r}")
+
+# "page" stamps the page number on each placeholder; "static" hard-links one shared image
+PLACEHOLDER_MODE = os.getenv("PLACEHOLDER_MODE", "page").lower()
+
+# CSS and JS are minified, fingerprinted and precompressed into static/dist at startup
+STATIC_ASSET_PIPELINE = os.getenv("STATIC_ASSET_PIPELINE", "1").lower() in ('1', 'true', 'yes')
+static_asset_manifest = install_static_assets(app) if STATIC_ASSET_PIPELINE else {}
+
+# Worker threads that finish images, audio and PDFs after /generate has returned
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "4"))
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="storybook")
+
+# Seconds of silence after which /generate/stream sends a heartbeat
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+
+# Caps on concurrent provider calls, shared by interactive and batch work in every process on the host
+PROVIDER_CONCURRENCY = {
+    'llm': int(os.getenv("LLM_CONCURRENCY", "4")),
+    'image': int(os.getenv("IMAGE_CONCURRENCY", "4")),
+    'tts': int(os.getenv("TTS_CONCURRENCY", "4"))
+}
+PROVIDER_LOCK_DIR = os.getenv("PROVIDER_LOCK_DIR", os.path.join("uploads", "locks"))
+
+class HostSlots:
+    """A counting semaphore shared by every process on the host, for use in a with block
+
+    Each slot is an flock on its own file, so a slot held by a gunicorn worker
+    that dies is freed with it. Threads of one process first queue on a local
+    semaphore, so only callers that could use a slot poll the files.
+    """
+
+    def __init__(self, name, limit, lock_dir, poll_seconds=0.05):
+        self.paths = [os.path.join(lock_dir, f"provider_{name}_{i}.lock") for i in range(limit)]
+        self.lock_dir = lock_dir
+        self.poll_seconds = poll_seconds
+        self._local = threading.BoundedSemaphore(limit)
+        self._held = threading.local()
+
+    def _try_slot(self):
+        for path in self.paths:
+            lock_file = open(path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except BlockingIOError:
+                lock_file.close()
+        return None
+
+    def __enter__(self):
+        self._local.acquire()
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            delay = self.poll_seconds
+            while True:
+                lock_file = self._try_slot()
+                if lock_file:
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+        except BaseException:
+            self._local.release()
+            raise
+        self._held.files = getattr(self._held, 'files', []) + [lock_file]
+        return self
+
+    def __exit__(self, *exc_info):
+        self._held.files.pop().close()
+        self._local.release()
+        return False
+
+provider_slots = {name: HostSlots(name, limit, PROVIDER_LOCK_DIR) for name, limit in PROVIDER_CONCURRENCY.items()}
+
+class StageLatencies:
+    """Exponentially weighted moving averages of how long each pipeline stage takes"""
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self._averages = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            previous = self._averages.get(stage)
+            self._averages[stage] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+            self._counts[stage] = self._counts.get(stage, 0) + 1
+
+    def average(self, stage, default=None):
+        with self._lock:
+            return self._averages.get(stage, default)
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: {'average_seconds': round(value, 2), 'samples': self._counts[stage]}
+                    for stage, value in self._averages.items()}
+
+stage_latencies = StageLatencies()
+
+# Opt-in tracemalloc instrumentation of each pipeline stage (MEMORY_PROFILING=1), and a
+# worker that has grown MEMORY_RECYCLE_MB past its starting RSS exits between stories
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING", "").lower() in ('1', 'true', 'yes')
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", "10"))
+MEMORY_RECYCLE_MB = float(os.getenv("MEMORY_RECYCLE_MB", "0"))
+MEMORY_TRACKED_STORIES = 256
+
+def current_rss_bytes():
+    """Resident set size of this process; the peak from getrusage where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+def peak_rss_bytes():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class MemoryProfiler:
+    """Peak and retained traced allocations per pipeline stage, grouped by story
+
+    Stages that overlap in time share tracemalloc's process-wide peak, so a
+    stage's peak is an upper bound while other stages run; retained bytes are
+    exact per stage only when it runs alone.
+    """
+
+    def __init__(self, enabled, frames, recycle_mb):
+        self.enabled = enabled
+        self.frames = frames
+        self.recycle_bytes = int(recycle_mb * 1024 * 1024)
+        self.recycling = False
+        self._stories = {}
+        self._stages = {}
+        self._active = 0
+        self._baseline = None
+        self._previous = None
+        self._rss_pid = None
+        self._baseline_rss = 0
+        self._lock = threading.Lock()
+        if enabled:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self._baseline = tracemalloc.take_snapshot()
+
+    def baseline_rss(self):
+        # Measured per process, so a forked gunicorn worker starts from its own size
+        if self._rss_pid != os.getpid():
+            self._rss_pid = os.getpid()
+            self._baseline_rss = current_rss_bytes()
+        return self._baseline_rss
+
+    def begin_story(self, story_id):
+        """Collect stage measurements for story_id until story_report() takes them"""
+        if self.enabled:
+            with self._lock:
+                # Stories that failed before finishing are never reported; drop the oldest
+                if story_id not in self._stories and len(self._stories) >= MEMORY_TRACKED_STORIES:
+                    self._stories.pop(next(iter(self._stories)))
+                self._stories.setdefault(story_id, {})
+
+    @contextlib.contextmanager
+    def stage(self, story_id, stage):
+        if not self.enabled:
+            yield
+            return
+        import tracemalloc
+        
+        with self._lock:
+            if self._active == 0:
+                tracemalloc.reset_peak()
+            self._active += 1
+        before = tracemalloc.get_traced_memory()[0]
+        rss_before = current_rss_bytes()
+        started = time.time()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            sample = {
+                'peak_bytes': max(0, peak - before),
+                'retained_bytes': current - before,
+                'rss_growth_bytes': current_rss_bytes() - rss_before,
+                'seconds': time.time() - started
+            }
+            with self._lock:
+                self._active -= 1
+                targets = [self._stages]
+                if story_id in self._stories:
+                    targets.append(self._stories[story_id])
+                for stages in targets:
+                    totals = stages.setdefault(stage, {'calls': 0, 'peak_bytes': 0, 'retained_bytes': 0,
+                                                       'rss_growth_bytes': 0, 'seconds': 0.0})
+                    totals['calls'] += 1
+                    totals['peak_bytes'] = max(totals['peak_bytes'], sample['peak_bytes'])
+                    for key in ('retained_bytes', 'rss_growth_bytes', 'seconds'):
+                        totals[key] += sample[key]
+
+    def story_report(self, story_id):
+        """Per-stage totals for a story, plus its overall peak and retained bytes; stops collecting for it"""
+        with self._lock:
+            stages = self._stories.pop(story_id, None)
+        if stages is None:
+            return None
+        for totals in stages.values():
+            totals['seconds'] = round(totals['seconds'], 3)
+        return {
+            'stages': stages,
+            'peak_bytes': max((totals['peak_bytes'] for totals in stages.values()), default=0),
+            'retained_bytes': sum(totals['retained_bytes'] for totals in stages.values()),
+            'rss_bytes': current_rss_bytes(),
+            'peak_rss_bytes': peak_rss_bytes()
+        }
+
+    def top_allocations(self, limit=20, compare='baseline'):
+        """The largest allocation sites now, or the largest growth since startup or since the last call"""
+        import tracemalloc
+        
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+        reference = {'baseline': self._baseline, 'previous': self._previous}.get(compare)
+        self._previous = snapshot
+        if reference is not None:
+            statistics = snapshot.compare_to(reference, 'lineno')
+        else:
+            statistics = snapshot.statistics('lineno')
+        sites = []
+        for stat in statistics[:limit]:
+            frame = stat.traceback[0]
+            site = {'site': f"{frame.filename}:{frame.lineno}", 'size_bytes': stat.size, 'count': stat.count}
+            if reference is not None:
+                site.update(size_diff_bytes=stat.size_diff, count_diff=stat.count_diff)
+            sites.append(site)
+        return sites
+
+    def snapshot(self):
+        with self._lock:
+            stages = {stage: dict(totals, seconds=round(totals['seconds'], 3)) for stage, totals in self._stages.items()}
+            tracked_stories = len(self._stories)
+        rss = current_rss_bytes()
+        snapshot = {
+            'enabled': self.enabled,
+            'rss_bytes': rss,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'rss_growth_bytes': rss - self.baseline_rss(),
+            'recycle_threshold_bytes': self.recycle_bytes or None,
+            'stages': stages,
+            'tracked_stories': tracked_stories
+        }
+        if self.enabled:
+            import tracemalloc
+            snapshot['traced_bytes'], snapshot['traced_peak_bytes'] = tracemalloc.get_traced_memory()
+        return snapshot
+
+    def maybe_recycle(self):
+        """Ask this worker to exit once its RSS has grown past the threshold; gunicorn starts a fresh one
+
+        Call it only when no story is in flight, so the graceful shutdown
+        does not cut off any generation work.
+        """
+        if not self.recycle_bytes or self.recycling:
+            return False
+        growth = current_rss_bytes() - self.baseline_rss()
+        if growth < self.recycle_bytes:
+            return False
+        import signal
+        
+        self.recycling = True
+        print(f"♻️ Worker {os.getpid()} grew {growth / 1e6:.0f} MB since startup "
+              f"(limit {self.recycle_bytes / 1e6:.0f} MB); recycling")
+        os.kill(os.getpid(), signal.SIGTERM)
+        return True
+
+memory_profiler = MemoryProfiler(MEMORY_PROFILING, MEMORY_TRACE_FRAMES, MEMORY_RECYCLE_MB)
+memory_profiler.baseline_rss()
+
+def provider_limited(provider):
+    """Decorator that holds one of the provider's host-wide slots for the duration of the call"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with provider_slots[provider]:
+                started = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    stage_latencies.observe(provider, time.time() - started)
+        return wrapper
+    return decorator
+
+class FairScheduler:
+    """Thread pool that serves its lanes round-robin
+
+    Every story, and every batch as a whole, gets its own lane, so a batch of
+    fifty stories receives the same share of workers as one interactive story.
+    Tasks within a lane run in submission order.
+    """
+
+    def __init__(self, workers, name="scheduler"):
+        self.workers = workers
+        self.name = name
+        self._lanes = OrderedDict()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._active = 0
+
+    def submit(self, lane, func, *args, **kwargs):
+        future = Future()
+        with self._condition:
+            # Threads start lazily so forked gunicorn workers each get their own
+            if not self._threads:
+                self._start_workers()
+            self._lanes.setdefault(lane, deque()).append((future, func, args, kwargs))
+            self._condition.notify()
+        return future
+
+    def stats(self):
+        with self._condition:
+            return {
+                'workers': self.workers,
+                'active': self._active,
+                'queued': sum(len(tasks) for tasks in self._lanes.values()),
+                'lanes': len(self._lanes)
+            }
+
+    def _start_workers(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_task(self):
+        with self._condition:
+            while not self._lanes:
+                self._condition.wait()
+            lane, tasks = self._lanes.popitem(last=False)
+            task = tasks.popleft()
+            # The lane goes to the back of the line if it still has work
+            if tasks:
+                self._lanes[lane] = tasks
+            self._active += 1
+            return task
+
+    def _work(self):
+        while True:
+            future, func, args, kwargs = self._next_task()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(func(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._condition:
+                    self._active -= 1
+
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", str(PROVIDER_CONCURRENCY['image'] + PROVIDER_CONCURRENCY['tts'])))
+page_scheduler = FairScheduler(SCHEDULER_WORKERS, name="pages")
+
+# Per-instance generation budget: stories running at once, and stories allowed to wait for a slot
+MAX_INFLIGHT_GENERATIONS = int(os.getenv("MAX_INFLIGHT_GENERATIONS", str(BACKGROUND_WORKERS)))
+MAX_QUEUED_GENERATIONS = int(os.getenv("MAX_QUEUED_GENERATIONS", str(MAX_INFLIGHT_GENERATIONS * 2)))
+# In-flight slots batch stories leave free for interactive requests (at most all but one)
+INTERACTIVE_RESERVED_SLOTS = int(os.getenv("INTERACTIVE_RESERVED_SLOTS", "1"))
+# Assumed story duration until real measurements exist
+DEFAULT_STORY_SECONDS = float(os.getenv("DEFAULT_STORY_SECONDS", "60"))
+
+class AdmissionTicket:
+    """One admitted generation; moves from queued to running and is released exactly once"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.state = 'queued'
+        self.started_at = None
+
+    def start(self, blocking=True, timeout=None):
+        """Wait for an in-flight slot (at most timeout seconds), or with blocking=False take one only if it is free
+
+        Returns whether the ticket is running.
+        """
+        if self.state == 'queued':
+            return self.controller._start(self, blocking, timeout)
+        return self.state == 'running'
+
+    def finish(self):
+        if self.state != 'finished':
+            self.controller._finish(self)
+
+class AdmissionController:
+    """Bounded in-flight and queued generation budget with wait estimates for Retry-After"""
+
+    def __init__(self, max_inflight, max_queued):
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.inflight = 0
+        self.queued = 0
+        self.rejected = 0
+        self._slots = threading.Semaphore(max_inflight)
+        self._lock = threading.Lock()
+
+    def admit(self):
+        """Return a ticket, or None when the instance is already at its budget"""
+        with self._lock:
+            if self.inflight + self.queued >= self.max_inflight + self.max_queued:
+                self.rejected += 1
+                return None
+            self.queued += 1
+            return AdmissionTicket(self)
+
+    def admit_background(self, reserved):
+        """A running ticket for background work, or None
+
+        Background work only gets a slot while at least `reserved` more stay
+        free for interactive requests and none of those is waiting.
+        """
+        with self._lock:
+            if self.queued or self.inflight + reserved >= self.max_inflight or not self._slots.acquire(False):
+                return None
+            self.inflight += 1
+            ticket = AdmissionTicket(self)
+            ticket.state = 'running'
+            ticket.started_at = time.time()
+            return ticket
+
+    def _start(self, ticket, blocking=True, timeout=None):
+        if not self._slots.acquire(blocking, timeout if blocking else None):
+            return False
+        with self._lock:
+            self.queued -= 1
+            self.inflight += 1
+        ticket.state = 'running'
+        ticket.started_at = time.time()
+        return True
+
+    def _finish(self, ticket):
+        with self._lock:
+            if ticket.state == 'running':
+                self.inflight -= 1
+                self._slots.release()
+                stage_latencies.observe('story', time.time() - ticket.started_at)
+            else:
+                self.queued -= 1
+            ticket.state = 'finished'
+            idle = self.inflight == 0 and self.queued == 0
+        # Tasks leased from the queue would only be retried elsewhere after their leases expire
+        if idle and not task_worker.held():
+            memory_profiler.maybe_recycle()
+
+    def has_room(self):
+        """Whether admit() would hand out a ticket right now"""
+        with self._lock:
+            return self.inflight + self.queued < self.max_inflight + self.max_queued
+
+    def estimated_wait(self):
+        """Seconds until a newly queued story would start, from queue depth and recent story times"""
+        story_seconds = stage_latencies.average('story', DEFAULT_STORY_SECONDS)
+        with self._lock:
+            waiting = self.queued + max(0, self.inflight - self.max_inflight + 1)
+        rounds = -(-waiting // self.max_inflight)  # ceiling division
+        return int(round(rounds * story_seconds))
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                'inflight': self.inflight,
+                'queued': self.queued,
+                'max_inflight': self.max_inflight,
+                'max_queued': self.max_queued,
+                'rejected': self.rejected,
+                'saturated': self.inflight + self.queued >= self.max_inflight + self.max_queued
+            }
+        snapshot['estimated_wait_seconds'] = self.estimated_wait()
+        return snapshot
+
+admission = AdmissionController(MAX_INFLIGHT_GENERATIONS, MAX_QUEUED_GENERATIONS)
+
+def busy_response():
+    """503 telling the client when a retry is likely to be admitted"""
+    retry_after = max(1, admission.estimated_wait())
+    response = jsonify({
+        'error': 'The storybook studio is busy right now. Please try again shortly.',
+        'retry_after': retry_after,
+        'queued': admission.queued
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+# Upper bound on stories in one /api/batch request
+BATCH_MAX_STORIES = int(os.getenv("BATCH_MAX_STORIES", "100"))
+
+# Seconds a synchronous /generate may take per story length; pages still being
+# illustrated after that get placeholders and are backfilled in the background
+GENERATION_BUDGETS = {
+    length: float(os.getenv(f"GENERATION_BUDGET_{length.upper()}", default))
+    for length, default in (('short', '30'), ('normal', '45'), ('long', '75'), ('extended', '90'))
+}
+
+# Completed /generate responses are replayed for repeated Idempotency-Keys for this long;
+# a key whose request is still running is presumed abandoned after the lease
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 60 * 60)))
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", str(max(GENERATION_BUDGETS.values()) + 120)))
+IDEMPOTENCY_DB_PATH = os.getenv("IDEMPOTENCY_DB_PATH", os.path.join("uploads", "idempotency.sqlite3"))
+
+class IdempotencyStore:
+    """Idempotency keys for /generate, kept in SQLite so every gunicorn worker sees the same keys
+
+    A key is claimed atomically with INSERT OR IGNORE while its request runs
+    and then holds the stored response until its TTL expires. Connections are
+    opened per call, so the store is safe across threads and forked workers.
+    """
+
+    def __init__(self, path, ttl, lease):
+        self.path = path
+        self.ttl = ttl
+        self.lease = lease
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute("""CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            story_id TEXT NOT NULL,
+            state TEXT NOT NULL,
+            response TEXT,
+            status_code INTEGER,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )""")
+        conn.execute('CREATE INDEX IF NOT EXISTS idempotency_keys_expiry ON idempotency_keys (expires_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idempotency_keys_story ON idempotency_keys (story_id)')
+        return conn
+
+    def claim(self, key, fingerprint, story_id):
+        """Claim key for a new request; returns (claimed, row) where row is the key's current entry"""
+        now = time.time()
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM idempotency_keys WHERE expires_at < ?', (now,))
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO idempotency_keys (key, fingerprint, story_id, state, created_at, expires_at) "
+                    "VALUES (?, ?, ?, 'running', ?, ?)",
+                    (key, fingerprint, story_id, now, now + self.lease)
+                )
+                row = conn.execute('SELECT * FROM idempotency_keys WHERE key = ?', (key,)).fetchone()
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return cursor.rowcount == 1, dict(row)
+
+    def complete(self, key, story_id, response, status_code):
+        """Store the response for a claimed key and keep it for the TTL"""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE idempotency_keys SET state = 'done', response = ?, status_code = ?, expires_at = ? "
+                "WHERE key = ? AND story_id = ?",
+                (json.dumps(response, default=str), status_code, time.time() + self.ttl, key, story_id)
+            )
+
+    def renew(self, key, story_id):
+        """Extend a running claim by another lease"""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("UPDATE idempotency_keys SET expires_at = ? WHERE key = ? AND story_id = ? AND state = 'running'",
+                         (time.time() + self.lease, key, story_id))
+
+    def release(self, key, story_id):
+        """Forget a claim whose request failed so a retry can start fresh; completed keys are kept"""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("DELETE FROM idempotency_keys WHERE key = ? AND story_id = ? AND state = 'running'", (key, story_id))
+
+    def is_running(self, story_id):
+        """Whether a request holding a live claim is generating story_id"""
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute("SELECT 1 FROM idempotency_keys WHERE story_id = ? AND state = 'running' AND expires_at >= ?",
+                               (story_id, time.time())).fetchone()
+        return row is not None
+
+    def get(self, key):
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute('SELECT * FROM idempotency_keys WHERE key = ? AND expires_at >= ?', (key, time.time())).fetchone()
+        return dict(row) if row else None
+
+    def wait(self, key, timeout, interval=0.5):
+        """Poll until the key's request finishes or timeout passes; None if the claim was released"""
+        deadline = time.time() + timeout
+        while True:
+            row = self.get(key)
+            if not row or row['state'] != 'running' or time.time() >= deadline:
+                return row
+            time.sleep(interval)
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_DB_PATH, IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_LEASE_SECONDS)
+
+# Durable task queue: every page image, narration, PDF and batch story is recorded before it runs and
+# leased to one worker, so work lost with a worker is resumed by another worker or node
+TASK_QUEUE_URL = os.getenv("TASK_QUEUE_URL", "")
+TASK_QUEUE_DB_PATH = os.getenv("TASK_QUEUE_DB_PATH", os.path.join("uploads", "tasks.sqlite3"))
+TASK_QUEUE_TOKEN = os.getenv("TASK_QUEUE_TOKEN", "")
+TASK_QUEUE_SERVE = os.getenv("TASK_QUEUE_SERVE", "").lower() in ('1', 'true', 'yes')
+TASK_WORKER = os.getenv("TASK_WORKER", "1").lower() in ('1', 'true', 'yes')
+TASK_LEASE_SECONDS = float(os.getenv("TASK_LEASE_SECONDS", "60"))
+TASK_HEARTBEAT_SECONDS = float(os.getenv("TASK_HEARTBEAT_SECONDS", "15"))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "3"))
+TASK_RETRY_SECONDS = float(os.getenv("TASK_RETRY_SECONDS", "30"))
+TASK_POLL_SECONDS = float(os.getenv("TASK_POLL_SECONDS", "2"))
+TASK_RETENTION_HOURS = float(os.getenv("TASK_RETENTION_HOURS", "24"))
+
+if TASK_QUEUE_SERVE and not TASK_QUEUE_TOKEN:
+    print("⚠️ TASK_QUEUE_SERVE is set without TASK_QUEUE_TOKEN; the task queue will not be served")
+
+task_queue = create_task_queue(TASK_QUEUE_URL, TASK_QUEUE_DB_PATH, TASK_QUEUE_TOKEN, max_attempts=TASK_MAX_ATTEMPTS,
+                               retry_seconds=TASK_RETRY_SECONDS, retention=TASK_RETENTION_HOURS * 3600)
+task_worker = TaskWorker(task_queue, TASK_LEASE_SECONDS, TASK_HEARTBEAT_SECONDS)
+
+def replay_idempotent_response(row):
+    """The stored response of an earlier request with the same Idempotency-Key"""
+    response = jsonify(json.loads(row['response']))
+    response.status_code = row['status_code']
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+STORY_FIELDS = ('title', 'character_description', 'setting', 'moral')
+# Follow-up calls allowed per story to fill in missing fields or pages
+STORY_REPAIR_ATTEMPTS = int(os.getenv("STORY_REPAIR_ATTEMPTS", "2"))
+
+def openrouter_chat(messages, metrics=None):
+    """Send one chat completion to OpenRouter and return the message content
+
+    Token usage and the call count are added to metrics when it is given.
+    """
     url = "https://openrouter.ai/api/v1/chat/completions"
+    try:
+        resp = requests.post(url, headers=OPENROUTER_HEADERS, json={"model": TEXT_MODEL, "messages": messages}, timeout=30)
+    except requests.RequestException as e:
+        print(f"Network error during story generation: {e}")
+        raise RuntimeError(f"Network error during story generation: {e}")
+    if resp.status_code != 200:
+        print(f"Error from API: Status {resp.status_code}\nResponse: {resp.text}")
+        raise RuntimeError(f"Story generation failed: {resp.text}")
+    
+    try:
+        result = resp.json()
+        content = result["choices"][0]["message"]["content"]
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        print(f"Error accessing response data: {e}\nResponse: {resp.text}")
+        raise RuntimeError(f"Invalid response structure: {e}")
+    if metrics is not None:
+        usage = result.get('usage') or {}
+        metrics['llm_calls'] = metrics.get('llm_calls', 0) + 1
+        metrics['prompt_tokens'] = metrics.get('prompt_tokens', 0) + (usage.get('prompt_tokens') or 0)
+        metrics['completion_tokens'] = metrics.get('completion_tokens', 0) + (usage.get('completion_tokens') or 0)
+    return content or ""
+
+def scan_json_objects(text):
+    """Yield each balanced top-level {...} span in text, ignoring braces inside strings"""
+    offset = 0
+    while offset < len(text):
+        depth = 0
+        start = None
+        in_string = False
+        escaped = False
+        for i in range(offset, len(text)):
+            char = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = depth > 0
+            elif char == '{':
+                if depth == 0:
+                    start = i
+                depth += 1
+            elif char == '}' and depth > 0:
+                depth -= 1
+                if depth == 0:
+                    yield text[start:i + 1]
+        if depth == 0:
+            return
+        # A stray unclosed brace swallowed the rest of the text; rescan just past it
+        offset = start + 1
+
+def extract_json_object(content):
+    """Return the largest JSON object embedded in model output (prose, code fences), or None"""
+    found = None
+    for candidate in scan_json_objects(content or ""):
+        for attempt in (candidate, re.sub(r',\s*([}\]])', r'\1', candidate)):  # Trailing commas are a common slip
+            try:
+                value = json.loads(attempt)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(value, dict) and (found is None or len(candidate) > found[0]):
+                found = (len(candidate), value)
+            break
+    return found[1] if found else None
+
+def normalize_story_pages(pages, page_count):
+    """Usable pages as [{'page': n, 'text': ...}] for 1..page_count; unnumbered pages keep their position"""
+    normalized = {}
+    for position, page in enumerate(pages if isinstance(pages, list) else [], start=1):
+        if isinstance(page, str):
+            page = {'page': position, 'text': page}
+        if not isinstance(page, dict) or not isinstance(page.get('text'), str) or not page['text'].strip():
+            continue
+        try:
+            number = int(page.get('page', position))
+        except (TypeError, ValueError):
+            number = position
+        if 1 <= number <= page_count and number not in normalized:
+            normalized[number] = {**page, 'page': number, 'text': page['text'].strip()}
+    return [normalized[number] for number in sorted(normalized)]
+
+def validate_story_data(story_data, page_count):
+    """Normalize story_data['pages'] in place and return (missing_fields, missing_page_numbers)"""
+    missing_fields = [field for field in STORY_FIELDS
+                      if not isinstance(story_data.get(field), str) or not story_data[field].strip()]
+    story_data['pages'] = normalize_story_pages(story_data.get('pages'), page_count)
+    present = {page['page'] for page in story_data['pages']}
+    return missing_fields, [number for number in range(1, page_count + 1) if number not in present]
+
+def story_repair_messages(prompt, story_length, spec, story_data, missing_fields, missing_pages):
+    """Chat messages asking only for the missing parts of a partially generated story"""
+    known = {field: story_data[field] for field in STORY_FIELDS if field not in missing_fields}
+    known['pages'] = story_data.get('pages', [])
+    wanted = {field: "..." for field in missing_fields}
+    if missing_pages:
+        wanted['pages'] = [{"page": number, "text": "..."} for number in missing_pages]
+    
+    system_message = f"""You are a creative children's storybook writer completing a {spec['pages']}-page children's story.
     
+    Some parts of the story are missing. Write ONLY the missing parts so they fit the existing story
+    ({spec['sentences']}, appropriate for children aged 3-8).
     
+    Respond with JSON containing only these keys:
+    {json.dumps(wanted)}"""
+    
+    return [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": f"Story idea ({story_length}): {prompt}\n\nExisting story:\n{json.dumps(known)}"},
+    ]
+
+@provider_limited('llm')
+def generate_story_pages(prompt, story_length="normal", metrics=None):
+    """Generate a children's story with enhanced length options
+
+    Malformed output is repaired with follow-up calls that ask only for the
+    missing fields and pages. If a metrics dict is passed it receives the
+    call count, token usage, repairs made and the time they added.
+    """
     length_specs = {
         "short": {"pages": 3, "sentences": "1-2 sentences per page", "description": "Very short story for toddlers"},
         "normal": {"pages": 5, "sentences": "2-3 sentences per page", "description": "Standard children's story"},
@@ -90,60 +884,174 @@ def generate_story_pages(prompt, story_length="normal"):
     
     Make sure the story is appropriate for children aged 3-8 and each page flows naturally to the next."""
     
-    data = {
-        "model": TEXT_MODEL,
-        "messages": [
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": f"Create a {story_length} {spec['pages']}-page children's storybook about: {prompt}"},
-        ]
-    }
+    messages = [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": f"Create a {story_length} {spec['pages']}-page children's storybook about: {prompt}"},
+    ]
     
-    try:
-        resp = requests.post(url, headers=OPENROUTER_HEADERS, json=data, timeout=30)
-        if resp.status_code == 200:
-            try:
-                content = resp.json()["choices"][0]["message"]["content"]
-                
-                if content.strip().startswith('{'):
-                    story_data = json.loads(content)
-                else:
-                    # Try to find JSON in the response
-                    import re
-                    json_match = re.search(r'\{.*\}', content, re.DOTALL)
-                    if json_match:
-                        story_data = json.loads(json_match.group())
-                    else:
-                        print(f"Error: No valid JSON found in response. Content: {content}")
-                        raise RuntimeError("No valid JSON found in response")
-                
-                # Validate story data structure
-                required_fields = ['title', 'character_description', 'setting', 'pages', 'moral']
-                missing_fields = [field for field in required_fields if field not in story_data]
-                if missing_fields:
-                    raise RuntimeError(f"Missing required fields in story data: {', '.join(missing_fields)}")
-                
-                # Validate pages structure
-                if not isinstance(story_data['pages'], list) or len(story_data['pages']) != spec['pages']:
-                    raise RuntimeError(f"Invalid pages data. Expected {spec['pages']} pages.")
-                
-                return story_data
-            except json.JSONDecodeError as e:
-                print(f"Error parsing story JSON: {e}\nContent: {content}")
-                raise RuntimeError(f"Failed to parse story JSON response: {e}")
-            except KeyError as e:
-                print(f"Error accessing response data: {e}\nResponse: {resp.json()}")
-                raise RuntimeError(f"Invalid response structure: {e}")
+    metrics = metrics if metrics is not None else {}
+    metrics.update({'llm_calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'repairs': 0,
+                    'repaired_fields': [], 'repaired_pages': [], 'repair_seconds': 0.0})
+    started = time.time()
+    
+    content = openrouter_chat(messages, metrics)
+    story_data = extract_json_object(content)
+    if story_data is None:
+        print(f"Error: No valid JSON found in response. Content: {content}")
+        story_data = {}
+    
+    # Ask only for what is missing instead of paying for the whole story again
+    missing_fields, missing_pages = validate_story_data(story_data, spec['pages'])
+    while (missing_fields or missing_pages) and metrics['repairs'] < STORY_REPAIR_ATTEMPTS:
+        print(f"🔧 Repairing story: missing fields {missing_fields}, missing pages {missing_pages}")
+        repair_started = time.time()
+        metrics['repairs'] += 1
+        repair = extract_json_object(openrouter_chat(
+            story_repair_messages(prompt, story_length, spec, story_data, missing_fields, missing_pages), metrics
+        )) or {}
+        metrics['repair_seconds'] += time.time() - repair_started
+        
+        for field in missing_fields:
+            if isinstance(repair.get(field), str) and repair[field].strip():
+                story_data[field] = repair[field]
+                metrics['repaired_fields'].append(field)
+        pages = {page['page']: page for page in story_data.get('pages', [])}
+        for page in normalize_story_pages(repair.get('pages'), spec['pages']):
+            if page['page'] in missing_pages:
+                pages[page['page']] = page
+                metrics['repaired_pages'].append(page['page'])
+        story_data['pages'] = [pages[number] for number in sorted(pages)]
+        missing_fields, missing_pages = validate_story_data(story_data, spec['pages'])
+    
+    metrics['seconds'] = round(time.time() - started, 2)
+    metrics['repair_seconds'] = round(metrics['repair_seconds'], 2)
+    if metrics['repairs']:
+        stage_latencies.observe('llm_repair', metrics['repair_seconds'])
+    print(f" Story text: {metrics['llm_calls']} calls, {metrics['prompt_tokens'] + metrics['completion_tokens']} tokens, {metrics['repairs']} repairs")
+    
+    if missing_fields:
+        raise RuntimeError(f"Missing required fields in story data: {', '.join(missing_fields)}")
+    if missing_pages:
+        raise RuntimeError(f"Invalid pages data. Expected {spec['pages']} pages.")
+    return story_data
+
+@provider_limited('llm')
+def regenerate_page_text(story_data, page_number, metrics=None):
+    """Rewrite the text of a single page so it still fits the surrounding story
+
+    Token usage is added to metrics when it is given.
+    """
+    pages = story_data['pages']
+    index = page_number - 1
+    previous_text = pages[index - 1]['text'] if index > 0 else "(this is the first page)"
+    next_text = pages[index + 1]['text'] if index + 1 < len(pages) else "(this is the last page)"
+
+    system_message = f"""You are a creative children's storybook writer. Rewrite exactly one page of an existing children's story.
+
+    Story title: {story_data.get('title', '')}
+    Characters: {story_data.get('character_description', '')}
+    Setting: {story_data.get('setting', '')}
+    Moral: {story_data.get('moral', '')}
+
+    The rewritten page must keep the same length and tone, flow naturally from the previous page into the next one,
+    and be appropriate for children aged 3-8.
+
+    Format your response as JSON with this structure:
+    {{"page": {page_number}, "text": "New page text"}}"""
+
+    messages = [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": f"Previous page: {previous_text}\nCurrent page {page_number}: {pages[index]['text']}\nNext page: {next_text}\n\nRewrite page {page_number}."},
+    ]
+
+    page_data = extract_json_object(openrouter_chat(messages, metrics))
+    if page_data is None:
+        raise RuntimeError("No valid JSON found in response")
+
+    text = str(page_data.get('text', '')).strip()
+    if not text:
+        raise RuntimeError("Missing page text in response")
+    return text
+
+
+BASE64_FIELD_PATTERN = re.compile(rb'"base64"\s*:\s*"')
+
+def decode_base64_stream(chunks, out_file, max_bytes):
+    """Decode a base64 JSON string value arriving in chunks straight into out_file
+
+    Stops at the closing quote, so only one chunk of encoded and decoded data
+    is held at a time. Returns the number of bytes written.
+    """
+    pending = b''
+    written = 0
+    prefix_checked = False
+    for chunk in chunks:
+        # Base64 never contains backslashes; they only appear as the JSON escape in "\/"
+        chunk = chunk.replace(b'\\', b'')
+        end = chunk.find(b'"')
+        if end != -1:
+            chunk = chunk[:end]
+        pending += chunk
+        
+        if not prefix_checked:
+            if pending.startswith(b'data:'):
+                comma = pending.find(b',')
+                if comma == -1:
+                    if end == -1 and len(pending) < 256:
+                        continue
+                    raise ValueError("Malformed data URI in image payload")
+                pending = pending[comma + 1:]
+            elif end == -1 and len(pending) < 5:
+                continue  # Not enough data yet to rule out a data URI prefix
+            prefix_checked = True
+        
+        if end == -1:
+            usable = len(pending) - len(pending) % 4
         else:
-            print(f"Error from API: Status {resp.status_code}\nResponse: {resp.text}")
-            raise RuntimeError(f"Story generation failed: {resp.text}")
-    except requests.RequestException as e:
-        print(f"Network error during story generation: {e}")
-        raise RuntimeError(f"Network error during story generation: {e}")
+            pending += b'=' * (-len(pending) % 4)
+            usable = len(pending)
+        if usable:
+            decoded = base64.b64decode(pending[:usable])
+            written += len(decoded)
+            if written > max_bytes:
+                raise ValueError(f"Image exceeds the {max_bytes} byte limit")
+            out_file.write(decoded)
+            pending = pending[usable:]
+        if end != -1:
+            return written
+    raise ValueError("Image payload ended before the base64 data was complete")
 
- 
+def download_image_stream(image_url, filename, max_bytes):
+    """Stream a URL-delivered image to disk in chunks; returns filename or None"""
+    with requests.get(image_url, stream=True, timeout=30) as img_response:
+        if img_response.status_code != 200:
+            print(f"❌ Failed to download image: {img_response.status_code}")
+            return None
+        
+        content_length = int(img_response.headers.get('Content-Length') or 0)
+        if content_length > max_bytes:
+            raise ValueError(f"Image of {content_length} bytes exceeds the {max_bytes} byte limit")
+        
+        written = 0
+        with atomic_output(filename) as temp_path:
+            with open(temp_path, "wb") as f:
+                for chunk in img_response.iter_content(chunk_size=IMAGE_CHUNK_BYTES):
+                    written += len(chunk)
+                    if written > max_bytes:
+                        raise ValueError(f"Image exceeds the {max_bytes} byte limit")
+                    f.write(chunk)
+    print(f"✅ Freepik image downloaded as {filename} ({written} bytes)")
+    return filename
 
+@provider_limited('image')
 def generate_image_freepik(prompt, filename="story.png"):
-    """Generate image using Freepik API - Primary method"""
+    """Generate image using Freepik API - Primary method
+
+    The response is streamed: an inline base64 image is decoded chunk by chunk
+    into the output file and a URL-delivered image is downloaded in chunks,
+    so memory per page stays near-constant. Both are written to a temporary
+    file and renamed into place, and FREEPIK_MAX_IMAGE_BYTES is enforced.
+    """
     print("\n Image Generation via Freepik API")
     
     if not FREEPIK_API_KEY:
@@ -176,74 +1084,70 @@ def generate_image_freepik(prompt, filename="story.png"):
     
     try:
         print(" Sending request to Freepik API...")
-        response = requests.post(url, headers=FREEPIK_HEADERS, json=payload, timeout=60)
-        
-        print(f" Response status: {response.status_code}")
-        
-        if response.status_code == 200:
-            try:
-                result = response.json()
-            except json.JSONDecodeError as e:
-                print(f" Error parsing JSON response: {e}")
-                return None
-                
-            if not result.get('data'):
-                print(" No image data in response")
-                return None
-                
-            image_data = result['data'][0]
+        with requests.post(url, headers=FREEPIK_HEADERS, json=payload, timeout=60, stream=True) as response:
+            print(f" Response status: {response.status_code}")
             
-            if 'base64' in image_data:
+            if response.status_code == 200:
+                chunks = response.iter_content(chunk_size=IMAGE_CHUNK_BYTES)
+                head = b''
+                # Buffer only until the base64 field starts; URL responses are small
+                for chunk in chunks:
+                    head += chunk
+                    match = BASE64_FIELD_PATTERN.search(head)
+                    if match:
+                        remainder = head[match.end():]
+                        head = None
+                        try:
+                            with atomic_output(filename) as temp_path:
+                                with open(temp_path, 'wb') as f:
+                                    written = decode_base64_stream(
+                                        itertools.chain([remainder], chunks), f, FREEPIK_MAX_IMAGE_BYTES
+                                    )
+                        except Exception as e:
+                            print(f" Failed to decode base64 image: {e}")
+                            return None
+                        print(f"✅ Freepik image saved as {filename} ({written} bytes)")
+                        return filename
+                    if len(head) > FREEPIK_MAX_METADATA_BYTES:
+                        print(" Freepik response too large without image data")
+                        return None
+                
                 try:
-                    base64_data = image_data['base64']
-                    if base64_data.startswith('data:image'):
-                        base64_data = base64_data.split(',', 1)[1]
-                    
-                    image_bytes = base64.b64decode(base64_data)
+                    result = json.loads(head)
+                except json.JSONDecodeError as e:
+                    print(f" Error parsing JSON response: {e}")
+                    return None
                     
-                    os.makedirs(os.path.dirname(filename), exist_ok=True)
-                    with open(filename, 'wb') as f:
-                        f.write(image_bytes)
-                    print(f"✅ Freepik image saved as {filename}")
-                    return filename
-                except Exception as e:
-                    print(f" Failed to decode base64 image: {e}")
+                if not result.get('data'):
+                    print(" No image data in response")
                     return None
-            
-            # Handle URL-based image
-            elif 'url' in image_data:
-                try:
-                    img_response = requests.get(image_data['url'], timeout=30)
-                    if img_response.status_code == 200:
-                        # Ensure directory exists before writing
-                        os.makedirs(os.path.dirname(filename), exist_ok=True)
-                        with open(filename, "wb") as f:
-                            f.write(img_response.content)
-                        print(f"✅ Freepik image downloaded as {filename}")
-                        return filename
-                    else:
-                        print(f"❌ Failed to download image: {img_response.status_code}")
+                    
+                image_data = result['data'][0]
+                
+                # Handle URL-based image
+                if 'url' in image_data:
+                    try:
+                        return download_image_stream(image_data['url'], filename, FREEPIK_MAX_IMAGE_BYTES)
+                    except Exception as e:
+                        print(f"❌ Error downloading image: {e}")
                         return None
-                except Exception as e:
-                    print(f"❌ Error downloading image: {e}")
+                
+                else:
+                    print("❌ No recognizable image data in response")
                     return None
-            
+                    
+            elif response.status_code == 401:
+                print("❌ Freepik API: Authentication failed")
+                return None
+            elif response.status_code == 402:
+                print("❌ Freepik API: Payment required - insufficient credits")
+                return None
+            elif response.status_code == 429:
+                print("❌ Freepik API: Rate limit exceeded")
+                return None
             else:
-                print("❌ No recognizable image data in response")
+                print(f"❌ Freepik API failed: {response.status_code}")
                 return None
-                
-        elif response.status_code == 401:
-            print("❌ Freepik API: Authentication failed")
-            return None
-        elif response.status_code == 402:
-            print("❌ Freepik API: Payment required - insufficient credits")
-            return None
-        elif response.status_code == 429:
-            print("❌ Freepik API: Rate limit exceeded")
-            return None
-        else:
-            print(f"❌ Freepik API failed: {response.status_code}")
-            return None
             
     except requests.exceptions.Timeout:
         print("❌ Freepik API timeout")
@@ -251,8 +1155,6 @@ def generate_image_freepik(prompt, filename="story.png"):
     except Exception as e:
         print(f"❌ Freepik API error: {str(e)}")
         return None
-        print(f" Freepik API error: {e}")
-        return None
 
 # def generate_image_huggingface(prompt, filename="story.png"):
 #     """Generate image using Hugging Face Stable Diffusion XL"""
@@ -336,16 +1238,20 @@ def generate_image_freepik(prompt, filename="story.png"):
 #         print(f"❌ Replicate error: {e}")
 #         return None
 
-def generate_image(story_text, character_desc="", setting_desc="", filename="story.png"):
-    """Generate image using Freepik API"""
-     
+def illustration_prompt(story_text, character_desc="", setting_desc=""):
+    """Wrap a scene description in the house illustration style"""
     base_prompt = f"Children's storybook illustration: {story_text}"
     if character_desc:
         base_prompt += f" Character: {character_desc}"
     if setting_desc:
         base_prompt += f" Setting: {setting_desc}"
     
-    image_prompt = f"{base_prompt}. Whimsical, colorful, cartoon style, fairy tale atmosphere, beautiful lighting, suitable for children"
+    return f"{base_prompt}. Whimsical, colorful, cartoon style, fairy tale atmosphere, beautiful lighting, suitable for children"
+
+def generate_image(story_text, character_desc="", setting_desc="", filename="story.png"):
+    """Generate image using Freepik API"""
+     
+    image_prompt = illustration_prompt(story_text, character_desc, setting_desc)
     
     print(f"\n Starting image generation...")
     print("Using Freepik API for image generation...")
@@ -358,49 +1264,109 @@ def generate_image(story_text, character_desc="", setting_desc="", filename="sto
     print(" Image generation failed")
     return create_placeholder_image(filename, 1, story_text)
 
-def create_placeholder_image(filepath, page_number, page_text):
-    """Create a simple placeholder image when AI generation fails"""
+PLACEHOLDER_SIZE = (1024, 768)
+PLACEHOLDER_COLOR = (70, 130, 180)
+PLACEHOLDER_INK = 1  # Palette index of PLACEHOLDER_COLOR
+# Fonts tried in order before falling back to Pillow's built-in font
+PLACEHOLDER_FONTS = ("DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "arial.ttf")
+
+@contextlib.contextmanager
+def atomic_output(filepath):
+    """Yield a temporary path next to filepath and move it into place once written
+
+    Replacing the directory entry instead of rewriting the file means readers
+    never see a partial asset, and a hard-linked shared placeholder is never
+    overwritten through one story's path.
+    """
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    temp_path = f"{filepath}.{uuid.uuid4().hex[:8]}.tmp"
     try:
-        from PIL import Image, ImageDraw, ImageFont
-        
-         
-        img = Image.new('RGB', (1024, 768), color=(240, 248, 255))  # Light blue
-        draw = ImageDraw.Draw(img)
-        
-        
+        yield temp_path
+        os.replace(temp_path, filepath)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+@functools.lru_cache(maxsize=None)
+def placeholder_fonts():
+    """Load the placeholder fonts once per process as (large, small)"""
+    from PIL import ImageFont
+    
+    for font_name in PLACEHOLDER_FONTS:
         try:
-            font_large = ImageFont.truetype("arial.ttf", 48)
-            font_small = ImageFont.truetype("arial.ttf", 24)
-        except:
-            try:
-                font_large = ImageFont.load_default()
-                font_small = ImageFont.load_default()
-            except:
-                font_large = None
-                font_small = None
-        
-        
-        if font_large:
-            draw.text((50, 50), f"Page {page_number}", fill=(70, 130, 180), font=font_large)
-        else:
-            draw.text((50, 50), f"Page {page_number}", fill=(70, 130, 180))
-        
-        
-        draw.rectangle([200, 150, 824, 450], outline=(70, 130, 180), width=3)
-        if font_small:
-            draw.text((350, 280), "Story Illustration", fill=(70, 130, 180), font=font_small)
-        else:
-            draw.text((350, 280), "Story Illustration", fill=(70, 130, 180))
+            return ImageFont.truetype(font_name, 48), ImageFont.truetype(font_name, 24)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size=48), ImageFont.load_default(size=24)
+    except TypeError:
+        # Pillow builds without FreeType only have the fixed-size bitmap font
+        return ImageFont.load_default(), ImageFont.load_default()
+
+@functools.lru_cache(maxsize=None)
+def placeholder_base_image():
+    """Draw the page-independent placeholder artwork once per process"""
+    from PIL import Image, ImageDraw
+    
+    _, font_small = placeholder_fonts()
+    # Three-colour palette image: a fraction of the encode time and size of RGB
+    img = Image.new('P', PLACEHOLDER_SIZE, color=0)
+    img.putpalette([240, 248, 255, *PLACEHOLDER_COLOR, 255, 182, 193])  # Light blue, steel blue, light pink
+    draw = ImageDraw.Draw(img)
+    
+    draw.rectangle([200, 150, 824, 450], outline=PLACEHOLDER_INK, width=3)
+    draw.text((350, 280), "Story Illustration", fill=PLACEHOLDER_INK, font=font_small)
+    
+    for i in range(5):
+        x = 100 + i * 150
+        y = 500 + (i % 2) * 50
+        draw.ellipse([x, y, x+30, y+30], fill=2)  # Light pink circles
+    return img
+
+@functools.lru_cache(maxsize=None)
+def static_placeholder_path():
+    """Content-addressed copy of the page-independent placeholder, shared by every story"""
+    image_buffer = io.BytesIO()
+    placeholder_base_image().save(image_buffer, 'PNG', optimize=True)
+    image_bytes = image_buffer.getvalue()
+    
+    digest = hashlib.sha256(image_bytes).hexdigest()[:16]
+    filepath = os.path.join('uploads', 'placeholders', f'placeholder_{digest}.png')
+    if not os.path.exists(filepath):
+        with atomic_output(filepath) as temp_path:
+            with open(temp_path, 'wb') as f:
+                f.write(image_bytes)
+    return filepath
+
+def link_shared_file(source, filepath):
+    """Point filepath at source with a hard link, copying when links are not supported"""
+    with atomic_output(filepath) as temp_path:
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            shutil.copyfile(source, temp_path)
+
+def create_placeholder_image(filepath, page_number, page_text):
+    """Create a simple placeholder image when AI generation fails
+
+    The artwork and fonts are cached per process, so each call only stamps the
+    page number. With PLACEHOLDER_MODE=static no per-page text is drawn at all
+    and every story hard-links one shared, optimized PNG.
+    """
+    try:
+        if PLACEHOLDER_MODE == 'static':
+            link_shared_file(static_placeholder_path(), filepath)
+            print(f" Placeholder image linked: {filepath}")
+            return filepath
         
-         
-        for i in range(5):
-            x = 100 + i * 150
-            y = 500 + (i % 2) * 50
-            draw.ellipse([x, y, x+30, y+30], fill=(255, 182, 193))  # Light pink circles
+        from PIL import ImageDraw
         
+        font_large, _ = placeholder_fonts()
+        img = placeholder_base_image().copy()
+        ImageDraw.Draw(img).text((50, 50), f"Page {page_number}", fill=PLACEHOLDER_INK, font=font_large)
         
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        img.save(filepath, 'PNG')
+        with atomic_output(filepath) as temp_path:
+            img.save(temp_path, 'PNG', optimize=True)
         print(f" Placeholder image created: {filepath}")
         return filepath
         
@@ -408,17 +1374,92 @@ def create_placeholder_image(filepath, page_number, page_text):
         print(f" Failed to create placeholder image: {e}")
         return None
 
-def generate_page_image(character_description, page_text, page_number, story_id, setting_description=""):
-    """Generate an image for a specific page with enhanced consistency"""
-    print(f"\n Generating image for page {page_number}")
+IMAGE_EXTENSIONS = {'jpeg': '.jpg', 'webp': '.webp', 'png': '.png'}
+
+def ingest_image(filepath):
+    """Verify a downloaded image and replace it with an optimized, metadata-free master
+
+    The master is written next to filepath with the extension of IMAGE_FORMAT,
+    downscaled to the IMAGE_QUALITY tier, and the original is removed. When
+    re-encoding would not make the file smaller, a JPEG, WebP or PNG original
+    is kept as it is instead. Returns (path, meta) where meta records
+    dimensions and byte sizes. Raises ValueError if the file is not a
+    readable image.
+    """
+    from PIL import Image, ImageOps
     
-    filename = f"page_{page_number}_{story_id}.png"
-    filepath = os.path.join("uploads", filename)
+    image_format = IMAGE_FORMAT if IMAGE_FORMAT in IMAGE_EXTENSIONS else 'jpeg'
+    max_edge, quality = IMAGE_QUALITY_TIERS.get(IMAGE_QUALITY, IMAGE_QUALITY_TIERS['standard'])
+    source_bytes = os.path.getsize(filepath)
+    
+    try:
+        # verify() catches truncated or corrupt files but leaves the image unusable
+        with Image.open(filepath) as img:
+            img.verify()
+        with Image.open(filepath) as img:
+            source_size = img.size
+            source_format = (img.format or '').lower()
+            img.draft('RGB', (max_edge, max_edge))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Invalid image {filepath}: {e}")
+    
+    has_alpha = img.mode in ('RGBA', 'LA') or 'transparency' in img.info
+    if has_alpha and image_format == 'jpeg':
+        # JPEG has no alpha channel: flatten onto the page colour
+        rgba = img.convert('RGBA')
+        img = Image.new('RGB', rgba.size, (255, 255, 255))
+        img.paste(rgba, mask=rgba)
+    else:
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+    # Drop EXIF, ICC, text chunks and anything else carried over from the download
+    img.info = {}
     
+    master_path = os.path.splitext(filepath)[0] + IMAGE_EXTENSIONS[image_format]
+    # Encoded beside the master and only moved into place if it is worth keeping
+    temp_path = f"{master_path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        if image_format == 'jpeg':
+            img.save(temp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+        elif image_format == 'webp':
+            img.save(temp_path, 'WEBP', quality=quality, method=4)
+        else:
+            img.save(temp_path, 'PNG', optimize=True)
+        if os.path.getsize(temp_path) >= source_bytes and source_format in IMAGE_EXTENSIONS:
+            # Flat artwork such as a placeholder can grow when re-encoded; the download is already as small
+            image_format, (width, height) = source_format, source_size
+            master_path = os.path.splitext(filepath)[0] + IMAGE_EXTENSIONS[source_format]
+            os.replace(filepath, master_path)
+        else:
+            width, height = img.size
+            os.replace(temp_path, master_path)
+            if master_path != filepath:
+                os.remove(filepath)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    
+    master_bytes = os.path.getsize(master_path)
+    meta = {
+        'format': image_format,
+        'width': width,
+        'height': height,
+        'source_width': source_size[0],
+        'source_height': source_size[1],
+        'source_bytes': source_bytes,
+        'bytes': master_bytes,
+        'bytes_saved': max(0, source_bytes - master_bytes)
+    }
+    print(f"🗜️ Optimized {master_path}: {source_bytes} -> {master_bytes} bytes ({meta['bytes_saved']} saved)")
+    return master_path, meta
+
+def build_page_image_prompt(character_description, page_text, setting_description=""):
+    """Build the scene prompt used to illustrate one page"""
     scene_keywords = extract_scene_keywords(page_text)
     
     # Build enhanced prompt with character consistency
-    enhanced_prompt = f"""High-quality children's storybook illustration for the scene:
+    return f"""High-quality children's storybook illustration for the scene:
     
     Characters: {character_description}
     Setting: {setting_description}
@@ -434,228 +1475,1682 @@ def generate_page_image(character_description, page_text, page_number, story_id,
     - Consistent character design across pages
     - Clear focal point with good visual hierarchy
     - Soft, warm lighting for a cozy atmosphere"""
+
+def generate_page_image_with_status(character_description, page_text, page_number, story_id, setting_description=""):
+    """Generate a page image and report whether it is real artwork ('ready'), a 'placeholder' or 'failed'
+
+    Returns (path, status, meta); meta describes the optimized master and is
+    None for placeholders.
+    """
+    print(f"\n Generating image for page {page_number}")
+    
+    filename = f"page_{page_number}_{story_id}.png"
+    filepath = os.path.join("uploads", filename)
     
-    print(f"📝 Enhanced prompt: {enhanced_prompt}")
-    
-    # Use enhanced generate_image function
-    result = generate_image(enhanced_prompt, "", "", filepath)
+    enhanced_prompt = build_page_image_prompt(character_description, page_text, setting_description)
+    print(f"📝 Enhanced prompt: {enhanced_prompt}")
     
+    with memory_profiler.stage(story_id, 'image_download'):
+        result = generate_image_freepik(illustration_prompt(enhanced_prompt), filepath)
     if result:
-        print(f" Image saved as {filepath}")
+        try:
+            with memory_profiler.stage(story_id, 'image_ingest'):
+                image_path, image_meta = ingest_image(result)
+            print(f" Image saved as {image_path}")
+            return image_path, 'ready', image_meta
+        except ValueError as e:
+            print(f" Rejected image for page {page_number}: {e}")
+            if os.path.exists(result):
+                os.remove(result)
+    
+    print(f" Image generation failed for page {page_number}, creating placeholder...")
+    # Create a placeholder image as fallback
+    with memory_profiler.stage(story_id, 'placeholder'):
+        placeholder_path = create_placeholder_image(filepath, page_number, page_text)
+    return placeholder_path, ('placeholder' if placeholder_path else 'failed'), None
+
+def generate_page_image(character_description, page_text, page_number, story_id, setting_description=""):
+    """Generate an image for a specific page with enhanced consistency"""
+    image_path, _, _ = generate_page_image_with_status(
+        character_description, page_text, page_number, story_id, setting_description
+    )
+    return image_path
+
+@provider_limited('tts')
+def try_fallback_tts(text, filename):
+    """Enhanced fallback TTS with multiple options"""
+    print("Attempting fallback TTS solution...")
+    try:
+        from gtts import gTTS
+        tts = gTTS(text=text, lang='en', slow=False)
+        tts.save(filename)
+        print(f" Fallback speech saved as {filename}")
+        return filename
+    except ImportError:
+        print("gTTS not installed. Install with: pip install gtts")
+        return None
+    except Exception as e:
+        print(f" Fallback TTS also failed: {e}")
+        return None
+
+speech = ChunkedSpeech(create_tts_backend(TTS_BACKEND, pool_size=TTS_CHUNK_WORKERS), TTS_CHUNK_WORKERS)
+
+def narration_settings(data=None):
+    """Voice and speed for a story's narration from request data, defaulting to TTS_VOICE and TTS_SPEED
+
+    Raises ValueError for a voice or speed the backends do not offer.
+    """
+    data = data or {}
+    voice = str(data.get('voice') or TTS_VOICE).lower()
+    speed = str(data.get('speed') or TTS_SPEED).lower()
+    if voice not in TTS_VOICES:
+        raise ValueError(f"voice must be one of {', '.join(TTS_VOICES)}")
+    if speed not in TTS_SPEEDS:
+        raise ValueError(f"speed must be one of {', '.join(TTS_SPEEDS)}")
+    return {'voice': voice, 'speed': speed}
+
+def story_narration(story_id):
+    """The narration settings stored with a story; older records use the defaults"""
+    try:
+        return load_story_record(story_id).get('narration') or narration_settings()
+    except FileNotFoundError:
+        return narration_settings()
+
+@provider_limited('tts')
+def generate_speech_for_page(text, page_number, story_id, narration=None):
+    """Narrate a page: sentence chunks are synthesized in parallel and joined in order"""
+    print(f"\n Generating TTS for page {page_number}")
+    narration = narration or narration_settings()
+    
+    # Ensure uploads directory exists
+    os.makedirs('uploads', exist_ok=True)
+    
+    filename = f"page_{page_number}_{story_id}.{speech.backend.extension}"
+    filepath = os.path.join("uploads", filename)
+    
+    try:
+        with atomic_output(filepath) as temp_path:
+            with open(temp_path, 'wb') as f:
+                stats = speech.synthesize(text, f, narration['voice'], narration['speed'])
+        print(f" TTS audio saved as {filepath} ({stats['chunks']} chunks in {stats['seconds']:.1f} s, "
+              f"longest {stats['longest_chunk_seconds']:.1f} s)")
         return filepath
-    else:
-        print(f" Image generation failed for page {page_number}, creating placeholder...")
-        # Create a placeholder image as fallback
-        return create_placeholder_image(filepath, page_number, page_text)
-
-def extract_scene_keywords(text):
-    """Extract key scene elements with enhanced context awareness"""
-    import re
-    
-    # Expanded word sets for better scene understanding
-    stop_words = {'the', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'a', 'an', 
-                 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had'}
-    
-    action_words = {
-        'run', 'walk', 'jump', 'fly', 'swim', 'dance', 'sing', 'play', 'laugh', 'smile', 'cry', 'sleep',
-        'eat', 'drink', 'climb', 'fall', 'sit', 'stand', 'look', 'see', 'find', 'meet', 'help', 'save',
-        'fight', 'hide', 'explore', 'discover', 'build', 'create', 'magic', 'adventure', 'chase', 'search',
-        'whisper', 'shout', 'giggle', 'dream', 'imagine', 'wonder', 'think', 'wish'
-    }
+    except Exception as e:
+        print(f"❌ Error generating audio: {e}")
+        return None
+
+@functools.lru_cache(maxsize=None)
+def pdf_styles():
+    """Build the ReportLab stylesheet once per process; styles are read-only during builds"""
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib import colors
+    
+    styles = getSampleStyleSheet()
+    
+    # Enhanced custom styles
+    styles.add(ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=28,
+        spaceAfter=30,
+        alignment=1,  # Center
+        textColor=colors.darkblue,
+        fontName='Helvetica-Bold'
+    ))
+    
+    styles.add(ParagraphStyle(
+        'StoryText',
+        parent=styles['Normal'],
+        fontSize=16,
+        spaceAfter=20,
+        alignment=0,  # Left
+        leftIndent=30,
+        rightIndent=30,
+        leading=22
+    ))
+    
+    styles.add(ParagraphStyle(
+        'MoralText',
+        parent=styles['Normal'],
+        fontSize=14,
+        spaceAfter=15,
+        alignment=1,  # Center
+        leftIndent=40,
+        rightIndent=40,
+        textColor=colors.darkgreen,
+        fontName='Helvetica-Oblique'
+    ))
+    return styles
+
+def create_storybook_pdf(story_data, image_paths, story_id):
+    """Create enhanced PDF storybook with better formatting"""
+    # Ensure uploads directory exists
+    os.makedirs('uploads', exist_ok=True)
+    
+    filename = f"storybook_{story_id}.pdf"
+    filepath = os.path.join("uploads", filename)
+    
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage
+    from reportlab.lib.units import inch
+    
+    styles = pdf_styles()
+    title_style = styles['CustomTitle']
+    story_style = styles['StoryText']
+    moral_style = styles['MoralText']
+    
+    story = []
+    
+    # Title page
+    story.append(Paragraph(story_data['title'], title_style))
+    story.append(Spacer(1, 30))
+    
+    # Add moral/message if available
+    if 'moral' in story_data and story_data['moral']:
+        story.append(Paragraph(f"<i>Lesson: {story_data['moral']}</i>", moral_style))
+        story.append(Spacer(1, 20))
+    
+    # Story pages with enhanced layout
+    for i, page in enumerate(story_data['pages']):
+        page_num = page['page']
+        
+        # Add page break between pages (except first)
+        if i > 0:
+            story.append(Spacer(1, 30))
+        
+        # Add page title
+        story.append(Paragraph(f"Page {page_num}", styles['Heading2']))
+        story.append(Spacer(1, 15))
+        
+        # Add image if available
+        if i < len(image_paths) and image_paths[i] and os.path.exists(image_paths[i]):
+            try:
+                # Enhanced image sizing
+                img = RLImage(image_paths[i], width=5*inch, height=3.75*inch)
+                story.append(img)
+                story.append(Spacer(1, 15))
+            except Exception as e:
+                print(f"Could not add image for page {page_num}: {e}")
+                # Add placeholder text when image fails
+                story.append(Paragraph(f"<i>[Image placeholder for page {page_num}]</i>", styles['Italic']))
+                story.append(Spacer(1, 15))
+        else:
+            # Add placeholder when no image is available
+            story.append(Paragraph(f"<i>[Image placeholder for page {page_num}]</i>", styles['Italic']))
+            story.append(Spacer(1, 15))
+        
+        # Add text with better formatting
+        story.append(Paragraph(page['text'], story_style))
+        story.append(Spacer(1, 20))
     
-    object_words = {
-        'tree', 'flower', 'house', 'castle', 'forest', 'mountain', 'river', 'ocean', 'garden', 'bridge',
-        'door', 'window', 'book', 'treasure', 'crown', 'sword', 'wand', 'star', 'moon', 'sun', 'cloud',
-        'rainbow', 'path', 'road', 'street', 'shop', 'school', 'park', 'playground', 'beach', 'cave',
-        'island', 'ship', 'boat', 'train', 'car', 'bicycle', 'balloon', 'kite', 'toy', 'pet'
+    # Build beside the old PDF so a download in progress never reads a half-written file
+    with atomic_output(filepath) as temp_path:
+        doc = SimpleDocTemplate(temp_path, pagesize=A4, topMargin=0.5*inch, bottomMargin=0.5*inch)
+        doc.build(story)
+    print(f"✅ Enhanced PDF created: {filepath}")
+    return filepath
+
+def story_record_path(story_id):
+    """Path of the JSON record that ties a story's text to its assets"""
+    return os.path.join("uploads", f"story_data_{story_id}.json")
+
+def load_story_record(story_id):
+    """Load a stored story record, raising FileNotFoundError if it does not exist"""
+    with open(story_record_path(story_id), 'r') as f:
+        return json.load(f)
+
+def save_story_record(story_id, record):
+    """Write a story record atomically so readers never see a half-written file"""
+    os.makedirs('uploads', exist_ok=True)
+    filepath = story_record_path(story_id)
+    temp_path = f"{filepath}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(temp_path, filepath)
+    return filepath
+
+@contextlib.contextmanager
+def record_file_lock(filepath):
+    """Exclusive lock on a JSON record across threads, gunicorn workers and queue workers
+
+    flock on a sidecar file in uploads/locks; the record itself is replaced by
+    rename on every save, so it cannot carry the lock.
+    """
+    lock_dir = os.path.join(os.path.dirname(filepath), 'locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, f"{os.path.basename(filepath)}.lock"), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def new_story_record(story_data, story_length, draft=False, narration=None):
+    """Create the record for a story whose text exists but whose assets are still pending"""
+    page_count = len(story_data['pages'])
+    return {
+        'created_at': time.time(),
+        'draft': draft,
+        'narration': narration_settings(narration),
+        'story_data': story_data,
+        'image_paths': [None] * page_count,
+        'audio_paths': [None] * page_count,
+        'pdf_path': None,
+        'story_length': story_length,
+        'status': 'generating',
+        'page_status': [{'image': 'pending', 'audio': 'pending'} for _ in range(page_count)],
+        'image_meta': [None] * page_count
+    }
+
+def update_story_record(story_id, mutate):
+    """Apply mutate(record) to the stored record under a lock and save it"""
+    with record_file_lock(story_record_path(story_id)):
+        record = load_story_record(story_id)
+        mutate(record)
+        save_story_record(story_id, record)
+        return record
+
+def story_is_complete(record):
+    """Records written before per-page tracking existed are always complete"""
+    return record.get('status', 'complete') == 'complete'
+
+class StoryBusyError(RuntimeError):
+    """Raised when a story cannot be changed because its assets are still being generated"""
+
+def story_status_payload(story_id, record):
+    """Per-page asset status and URLs used by the progressive reader"""
+    pages = record['story_data']['pages']
+    image_paths = record.get('image_paths') or []
+    audio_paths = record.get('audio_paths') or []
+    page_status = record.get('page_status') or []
+    default_status = 'ready' if story_is_complete(record) else 'pending'
+
+    def asset(paths, index, kind, route):
+        path = paths[index] if index < len(paths) else None
+        status = page_status[index].get(kind, default_status) if index < len(page_status) else default_status
+        if status in ('ready', 'placeholder', 'deferred') and not (path and os.path.exists(path)):
+            status = 'failed'
+        if status not in ('ready', 'placeholder', 'deferred'):
+            return {'status': status, 'url': None}
+        # The version changes whenever the file is replaced in place, so browsers refetch it
+        version = int(os.path.getmtime(path))
+        return {'status': status, 'url': f'/{route}/{os.path.basename(path)}?v={version}'}
+
+    payload = {
+        'story_id': story_id,
+        'status': record.get('status', 'complete'),
+        'draft': record.get('draft', False),
+        'narration': record.get('narration') or narration_settings(),
+        'title': record['story_data'].get('title', ''),
+        'pages': [
+            {
+                'page': page['page'],
+                'text': page['text'],
+                'image': asset(image_paths, i, 'image', 'image'),
+                'audio': asset(audio_paths, i, 'audio', 'audio')
+            }
+            for i, page in enumerate(pages)
+        ]
     }
+    if story_is_complete(record):
+        payload['pdf_url'] = f'/download-pdf/{story_id}'
+        payload['audiobook_url'] = f'/download-audiobook/{story_id}'
+    elif record.get('status') == 'partial':
+        # Provisional PDF with placeholders for the pages still being backfilled
+        payload['pdf_url'] = f'/download-pdf/{story_id}'
+    return payload
+
+def set_page_asset(story_id, story_data, index, kind, path, status, on_event=None, meta=None):
+    """Record a finished page asset and report it through on_event(event, payload)"""
+    replaced = []
+    def mutate(record):
+        previous = record[f'{kind}_paths'][index]
+        if previous and previous != path:
+            replaced.append(previous)
+        record[f'{kind}_paths'][index] = path
+        record['page_status'][index][kind] = status
+        if kind == 'image':
+            record.setdefault('image_meta', [None] * len(record['image_paths']))[index] = meta
+    record = update_story_record(story_id, mutate)
+    # A backfilled page replaces its deferred placeholder and makes the provisional PDF stale
+    for previous in replaced:
+        if os.path.exists(previous):
+            os.remove(previous)
+    if record['status'] == 'partial':
+        discard_story_pdf(story_id)
+    if on_event:
+        on_event(f'page_{kind}', {
+            'page': story_data['pages'][index]['page'],
+            'status': status,
+            'url': f'/{kind}/{os.path.basename(path)}' if path else None
+        })
+
+def generate_page_image_asset(story_id, story_data, index, on_event=None, draft=False):
+    """Scheduler task: illustrate one page, falling back to a placeholder; returns the image status
+
+    Drafts skip the provider and use the local placeholder straight away.
+    """
+    page = story_data['pages'][index]
+    image_meta = None
+    if draft:
+        with memory_profiler.stage(story_id, 'placeholder'):
+            image_path = create_placeholder_image(os.path.join('uploads', f'page_{page["page"]}_{story_id}.png'), page['page'], page['text'])
+        image_status = 'placeholder' if image_path else 'failed'
+        set_page_asset(story_id, story_data, index, 'image', image_path, image_status, on_event)
+        return image_status
+    try:
+        image_path, image_status, image_meta = generate_page_image_with_status(
+            story_data['character_description'],
+            page['text'],
+            page['page'],
+            story_id,
+            story_data.get('setting', '')
+        )
+    except Exception as e:
+        print(f"❌ Error generating image for page {page['page']}: {e}")
+        with memory_profiler.stage(story_id, 'placeholder'):
+            image_path = create_placeholder_image(
+                os.path.join('uploads', f'page_{page["page"]}_{story_id}.png'),
+                page['page'],
+                page['text']
+            )
+        image_status = 'placeholder' if image_path else 'failed'
+    set_page_asset(story_id, story_data, index, 'image', image_path, image_status, on_event, image_meta)
+    return image_status
+
+def generate_page_audio_asset(story_id, story_data, index, on_event=None, draft=False):
+    """Scheduler task: narrate one page; returns the audio status ('skipped' for drafts)"""
+    page = story_data['pages'][index]
+    if draft:
+        set_page_asset(story_id, story_data, index, 'audio', None, 'skipped', on_event)
+        return 'skipped'
+    try:
+        with memory_profiler.stage(story_id, 'tts'):
+            audio_path = generate_speech_for_page(page['text'], page['page'], story_id, narration=story_narration(story_id))
+    except Exception as e:
+        print(f" Error generating audio for page {page['page']}: {e}")
+        audio_path = None
+    audio_status = 'ready' if audio_path else 'failed'
+    set_page_asset(story_id, story_data, index, 'audio', audio_path, audio_status, on_event)
+    return audio_status
+
+def finish_story_assets(story_id, story_data, image_futures, audio_futures, on_event=None, draft=False):
+    """Scheduler task: build the PDF once every page task is done and mark the story complete"""
+    image_statuses = [future.result() for future in image_futures]
+    audio_statuses = [future.result() for future in audio_futures]
+    return complete_story(story_id, story_data, image_statuses, audio_statuses, on_event, draft)
+
+def complete_story(story_id, story_data, image_statuses, audio_statuses, on_event=None, draft=False):
+    """Build the PDF from the stored page assets and mark the story complete; returns the generation stats"""
+    stats = {
+        'images_generated': image_statuses.count('ready'),
+        'image_placeholders': image_statuses.count('placeholder'),
+        'audio_generated': audio_statuses.count('ready'),
+        'total_pages': len(story_data['pages'])
+    }
+    print(f"✅ Generated {stats['images_generated']}/{stats['total_pages']} images successfully")
+    print(f" Generated {stats['audio_generated']}/{stats['total_pages']} audio files successfully")
+    
+    # Create enhanced PDF (this should work even without images)
+    pdf_started = time.time()
+    with pdf_build_lock(story_id):
+        record = load_story_record(story_id)
+        stats['image_bytes_saved'] = sum(meta['bytes_saved'] for meta in record.get('image_meta') or [] if meta)
+        try:
+            image_paths = record['image_paths']
+            with memory_profiler.stage(story_id, 'pdf'):
+                pdf_path = create_storybook_pdf(story_data, image_paths, story_id)
+        except Exception as e:
+            print(f" Error creating PDF: {e}")
+            pdf_path = None
+        
+        memory = memory_profiler.story_report(story_id)
+        
+        def finish(record):
+            record['pdf_path'] = pdf_path
+            record['status'] = 'complete'
+            record['draft'] = draft
+            if memory:
+                record['memory'] = memory
+        update_story_record(story_id, finish)
+    stage_latencies.observe('pdf', time.time() - pdf_started)
+    if on_event:
+        on_event('pdf', {'status': 'ready' if pdf_path else 'failed', 'url': f'/download-pdf/{story_id}' if pdf_path else None})
     
-    emotion_words = {
-        'happy', 'sad', 'excited', 'scared', 'brave', 'worried', 'curious', 'proud', 'friendly',
-        'lonely', 'angry', 'peaceful', 'silly', 'surprised', 'confused', 'determined'
+    stats['pdf_created'] = bool(pdf_path)
+    stats['draft'] = draft
+    return stats
+
+# Queue task kinds; a story's PDF task waits until none of its page tasks is left
+PAGE_TASK_KINDS = ('page_image', 'tts')
+
+def story_task_specs(story_id, image_pages, audio_pages, draft=False, lane=None):
+    """Queue specs for a story's page images, page narration and PDF, in that order"""
+    payload = {'draft': draft, 'lane': lane or story_id}
+    specs = [{'kind': 'page_image', 'group': story_id, 'payload': {**payload, 'index': i}, 'dedupe_key': f"{story_id}:image:{i}"}
+             for i in image_pages]
+    specs += [{'kind': 'tts', 'group': story_id, 'payload': {**payload, 'index': i}, 'dedupe_key': f"{story_id}:audio:{i}"}
+              for i in audio_pages]
+    specs.append({'kind': 'pdf', 'group': story_id, 'payload': payload, 'dedupe_key': f"{story_id}:pdf"})
+    return specs
+
+def submit_story_assets(story_id, story_data, lane=None, on_event=None, draft=False):
+    """Queue every page's image and audio task on the fair scheduler, then the PDF
+
+    Returns a Future that resolves to the generation stats. Nothing blocks while
+    waiting, so this is safe to call from inside a scheduler task. A draft uses
+    placeholder art and no narration, so it finishes in well under a second.
+    Each step is also a task in the durable queue, held by this process while
+    it runs them.
+    """
+    lane = lane or story_id
+    page_count = len(story_data['pages'])
+    done = Future()
+    memory_profiler.begin_story(story_id)
+    # Every step is queued durably but leased to this process; if it dies, other workers finish the story
+    pages = range(page_count)
+    tasks = task_worker.enqueue_held(story_task_specs(story_id, pages, pages, draft, lane))
+    image_tasks, audio_tasks, pdf_task = tasks[:page_count], tasks[page_count:-1], tasks[-1]
+    # Images first so the reader can show artwork as early as possible
+    image_futures = [page_scheduler.submit(lane, task_worker.execute, task, generate_page_image_asset, story_id, story_data, i, on_event, draft)
+                     for i, task in enumerate(image_tasks)]
+    audio_futures = [page_scheduler.submit(lane, task_worker.execute, task, generate_page_audio_asset, story_id, story_data, i, on_event, draft)
+                     for i, task in enumerate(audio_tasks)]
+    remaining = [page_count * 2]
+    remaining_lock = threading.Lock()
+
+    def forward(future):
+        if future.exception():
+            done.set_exception(future.exception())
+        else:
+            done.set_result(future.result())
+
+    def page_finished(_):
+        with remaining_lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            finish = page_scheduler.submit(lane, task_worker.execute, pdf_task, finish_story_assets,
+                                           story_id, story_data, image_futures, audio_futures, on_event, draft)
+            finish.add_done_callback(forward)
+
+    for future in image_futures + audio_futures:
+        future.add_done_callback(page_finished)
+    return done
+
+def generate_story_assets(story_id, story_data, on_event=None, draft=False):
+    """Generate every page's image and audio plus the PDF, saving progress to the record as each finishes
+
+    on_event(event, payload) is called after each page asset and the PDF are ready.
+    """
+    return submit_story_assets(story_id, story_data, on_event=on_event, draft=draft).result()
+
+def deferred_placeholder_path(story_id, page_number):
+    """Where a page's placeholder lives while its real illustration is backfilled"""
+    return os.path.join('uploads', f'page_{page_number}_{story_id}_pending.png')
+
+def defer_pending_images(story_id, story_data):
+    """Give every page still being illustrated a placeholder and mark the story 'partial'
+
+    The page tasks keep running: set_page_asset swaps each illustration in when
+    it arrives and finish_story_assets rebuilds the PDF and marks the story
+    complete. Returns the numbers of the deferred pages.
+    """
+    record = load_story_record(story_id)
+    placeholders = {}
+    for index, page_status in enumerate(record['page_status']):
+        if page_status['image'] == 'pending':
+            page = story_data['pages'][index]
+            placeholders[index] = create_placeholder_image(deferred_placeholder_path(story_id, page['page']), page['page'], page['text'])
+
+    deferred = []
+    def mutate(current):
+        for index, path in placeholders.items():
+            # The page may have finished while its placeholder was being drawn
+            if path and current['page_status'][index]['image'] == 'pending':
+                current['image_paths'][index] = path
+                current['page_status'][index]['image'] = 'deferred'
+                deferred.append(index)
+        if current['status'] == 'generating':
+            current['status'] = 'partial'
+    update_story_record(story_id, mutate)
+
+    for index, path in placeholders.items():
+        if path and index not in deferred and os.path.exists(path):
+            os.remove(path)
+    return [story_data['pages'][index]['page'] for index in deferred]
+
+def run_story_assets_in_background(story_id, story_data, ticket=None, draft=False):
+    """Finish a story's assets on the background executor, releasing its admission ticket at the end"""
+    def run():
+        try:
+            generate_story_assets(story_id, story_data, draft=draft)
+        except Exception as e:
+            print(f" Background generation failed for story {story_id}: {e}")
+            update_story_record(story_id, lambda record: record.update(status='failed'))
+        finally:
+            if ticket:
+                ticket.finish()
+    return background_executor.submit(run)
+
+def upgrade_draft_story(story_id, ticket=None):
+    """Regenerate a draft story's art and narration at full quality in the background
+
+    The text and record are reused. Until each page's illustration arrives the
+    reader and the provisional PDF keep its draft placeholder. Raises
+    ValueError if the story is not a draft and StoryBusyError if it is still
+    being generated.
+    """
+    def mutate(record):
+        if not record.get('draft'):
+            raise ValueError(f"Story {story_id} is already full quality")
+        if not story_is_complete(record):
+            raise StoryBusyError(f"Story {story_id} is still being generated")
+        record['status'] = 'partial'
+        for index, page_status in enumerate(record['page_status']):
+            has_placeholder = record['image_paths'][index] and os.path.exists(record['image_paths'][index])
+            page_status['image'] = 'deferred' if has_placeholder else 'pending'
+            page_status['audio'] = 'pending'
+        invalidate_derived_artifacts(story_id, record)
+    record = update_story_record(story_id, mutate)
+    run_story_assets_in_background(story_id, record['story_data'], ticket)
+    return record
+
+def batch_record_path(batch_id):
+    return os.path.join("uploads", f"batch_{batch_id}.json")
+
+def update_batch_record(batch_id, mutate):
+    """Apply mutate(record) to a stored batch record under a lock and save it atomically"""
+    with record_file_lock(batch_record_path(batch_id)):
+        with open(batch_record_path(batch_id), 'r') as f:
+            record = json.load(f)
+        mutate(record)
+        temp_path = f"{batch_record_path(batch_id)}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(temp_path, batch_record_path(batch_id))
+        return record
+
+def batch_summary(record):
+    """Aggregate progress and throughput for a batch record"""
+    stories = record['stories']
+    counts = {status: sum(1 for story in stories if story['status'] == status)
+              for status in ('queued', 'writing', 'illustrating', 'complete', 'failed')}
+    finished = counts['complete'] + counts['failed']
+    elapsed = (record.get('finished_at') or time.time()) - record['created_at']
+    totals = {'images_generated': 0, 'image_placeholders': 0, 'audio_generated': 0, 'total_pages': 0}
+    for story in stories:
+        for key in totals:
+            totals[key] += (story.get('stats') or {}).get(key, 0)
+    text_metrics = [story['text_metrics'] for story in stories if story.get('text_metrics')]
+    totals['llm_tokens'] = sum(m.get('prompt_tokens', 0) + m.get('completion_tokens', 0) for m in text_metrics)
+    totals['text_repairs'] = sum(m.get('repairs', 0) for m in text_metrics)
+    latencies = [story['finished_at'] - story['started_at'] for story in stories
+                 if story['status'] == 'complete' and story.get('started_at')]
+    return {
+        'total_stories': len(stories),
+        **counts,
+        **totals,
+        'elapsed_seconds': round(elapsed, 2),
+        'stories_per_minute': round(finished * 60 / elapsed, 2) if elapsed > 0 else 0,
+        'average_story_seconds': round(sum(latencies) / len(latencies), 2) if latencies else None
     }
+
+def set_batch_story(batch_id, index, **changes):
+    """Update one story of a batch, marking the batch complete once every story has finished"""
+    def mutate(record):
+        record['stories'][index].update(changes)
+        if all(story['status'] in ('complete', 'failed') for story in record['stories']):
+            record['status'] = 'complete'
+            record['finished_at'] = time.time()
+    update_batch_record(batch_id, mutate)
+
+def run_batch_story(batch_id, index, lane, ticket=None):
+    """Write one story of a batch and queue its assets on the batch's lane
+
+    A story whose text was already written by an earlier attempt is not
+    written again; only the steps it still lacks are queued. The admission
+    ticket, if any, is released once the story's assets are done.
+    """
+    with open(batch_record_path(batch_id), 'r') as f:
+        item = json.load(f)['stories'][index]
+    if item.get('story_id'):
+        if ticket:
+            ticket.finish()
+        resume_story_assets(item['story_id'], lane)
+        return item['story_id']
+    
+    set_batch_story(batch_id, index, status='writing', started_at=time.time(), error=None)
+    story_id = str(uuid.uuid4())[:8]
+    text_metrics = {}
+    memory_profiler.begin_story(story_id)
+    try:
+        with memory_profiler.stage(story_id, 'story_text'):
+            story_data = generate_story_pages(item['prompt'], item['length'], text_metrics)
+    except Exception as e:
+        print(f" Batch {batch_id} story {index} failed: {e}")
+        # The queue retries the story until its attempts run out
+        set_batch_story(batch_id, index, status='queued', error=str(e), text_metrics=text_metrics)
+        raise
+    record = new_story_record(story_data, item['length'], narration=item.get('narration'))
+    record['batch'] = {'batch_id': batch_id, 'index': index}
+    save_story_record(story_id, record)
+    set_batch_story(batch_id, index, status='illustrating', story_id=story_id, reader_url=f'/reader/{story_id}', text_metrics=text_metrics)
+
+    def story_finished(future):
+        if ticket:
+            ticket.finish()
+        if future.exception():
+            update_story_record(story_id, lambda record: record.update(status='failed'))
+            set_batch_story(batch_id, index, status='failed', error=str(future.exception()), finished_at=time.time())
+        else:
+            set_batch_story(batch_id, index, status='complete', stats=future.result(), finished_at=time.time(),
+                            pdf_url=f'/download-pdf/{story_id}')
+
+    # Page tasks join the back of the same lane, interleaved with the batch's other stories
+    submit_story_assets(story_id, story_data, lane=lane).add_done_callback(story_finished)
+    return story_id
+
+def start_batch(batch_id, items):
+    """Queue every story of a batch as a durable task; any worker with room picks them up on one shared lane"""
+    lane = f"batch:{batch_id}"
+    task_queue.enqueue_many([
+        {'kind': 'story', 'group': batch_id, 'payload': {'batch_id': batch_id, 'index': index, 'lane': lane},
+         'dedupe_key': f"batch:{batch_id}:{index}"}
+        for index in range(len(items))
+    ])
+    task_worker.poke()
+
+def resume_story_assets(story_id, lane=None):
+    """Queue the steps an unfinished story still lacks, unless tasks for it are already queued
+
+    Covers a worker that died between writing a story's text and queueing its
+    assets. Returns the queued tasks.
+    """
+    record = load_story_record(story_id)
+    if story_is_complete(record) or task_queue.pending(story_id):
+        return []
+    image_pages = [i for i, status in enumerate(record['page_status']) if status['image'] in ('pending', 'deferred')]
+    audio_pages = [i for i, status in enumerate(record['page_status']) if status['audio'] == 'pending']
+    print(f"🔁 Resuming story {story_id}: {len(image_pages)} images and {len(audio_pages)} narrations to go")
+    return task_queue.enqueue_many(story_task_specs(story_id, image_pages, audio_pages, record.get('draft', False), lane))
+
+def run_page_task(task):
+    """Queue handler for a page image or narration another worker started; pages already finished are kept"""
+    story_id = task['group']
+    index = task['payload']['index']
+    kind = 'image' if task['kind'] == 'page_image' else 'audio'
+    record = load_story_record(story_id)
+    status = record['page_status'][index][kind]
+    if status not in ('pending', 'deferred'):
+        return status
+    if kind == 'image':
+        return generate_page_image_asset(story_id, record['story_data'], index, draft=task['payload']['draft'])
+    return generate_page_audio_asset(story_id, record['story_data'], index, draft=task['payload']['draft'])
+
+def page_task_finished(task, result, error):
+    """A dead-lettered page keeps its placeholder, if it has one, and otherwise counts as failed"""
+    if not error:
+        return
+    index = task['payload']['index']
+    kind = 'image' if task['kind'] == 'page_image' else 'audio'
+    def mutate(record):
+        path = record[f'{kind}_paths'][index]
+        if record['page_status'][index][kind] in ('pending', 'deferred'):
+            record['page_status'][index][kind] = 'placeholder' if path and os.path.exists(path) else 'failed'
+    update_story_record(task['group'], mutate)
+
+def run_story_pdf_task(task):
+    """Queue handler: once none of the story's page tasks is left, build its PDF and mark it complete"""
+    story_id = task['group']
+    record = load_story_record(story_id)
+    image_statuses = [status['image'] for status in record['page_status']]
+    audio_statuses = [status['audio'] for status in record['page_status']]
+    if story_is_complete(record):
+        return {'images_generated': image_statuses.count('ready'), 'image_placeholders': image_statuses.count('placeholder'),
+                'audio_generated': audio_statuses.count('ready'), 'total_pages': len(image_statuses),
+                'pdf_created': bool(record.get('pdf_path')), 'draft': record.get('draft', False)}
+    if task_queue.pending(story_id, PAGE_TASK_KINDS):
+        raise TaskDeferred(5)
+    # A page whose illustration never arrived keeps the placeholder it was given
+    image_statuses = ['placeholder' if status == 'deferred' else status for status in image_statuses]
+    return complete_story(story_id, record['story_data'], image_statuses, audio_statuses, draft=task['payload']['draft'])
+
+def story_pdf_finished(task, result, error):
+    """Settle a story finished by the queue, and its batch entry, as the worker that started it would have"""
+    story_id = task['group']
+    if error:
+        update_story_record(story_id, lambda record: record.update(status='failed'))
+    batch = load_story_record(story_id).get('batch')
+    if batch and error:
+        set_batch_story(batch['batch_id'], batch['index'], status='failed', error=error, finished_at=time.time())
+    elif batch:
+        set_batch_story(batch['batch_id'], batch['index'], status='complete', stats=result, finished_at=time.time(),
+                        pdf_url=f'/download-pdf/{story_id}')
+
+def run_batch_story_task(task):
+    """Queue handler for a batch story; it counts against the admission budget like an interactive story"""
+    # Waiting for a slot here would hold a scheduler thread that running stories need for their pages
+    ticket = admission.admit_background(min(INTERACTIVE_RESERVED_SLOTS, admission.max_inflight - 1))
+    if not ticket:
+        raise TaskDeferred(max(TASK_POLL_SECONDS, admission.estimated_wait()), "waiting for an admission slot")
+    try:
+        return run_batch_story(task['payload']['batch_id'], task['payload']['index'], task['payload']['lane'], ticket)
+    except BaseException:
+        ticket.finish()
+        raise
+
+def batch_story_finished(task, result, error):
+    if error:
+        set_batch_story(task['payload']['batch_id'], task['payload']['index'], status='failed', error=error, finished_at=time.time())
+
+task_worker.register('story', run_batch_story_task, batch_story_finished)
+task_worker.register('page_image', run_page_task, page_task_finished)
+task_worker.register('tts', run_page_task, page_task_finished)
+task_worker.register('pdf', run_story_pdf_task, story_pdf_finished)
+
+_task_worker_pid = None
+
+def start_task_worker():
+    """Start leasing queued tasks in this process once; gunicorn calls it after forking each worker
+
+    Tasks run on the fair scheduler, and a new one is only leased while the
+    scheduler has an idle thread, so extra workers and nodes add capacity.
+    """
+    global _task_worker_pid
+    if not TASK_WORKER or _task_worker_pid == os.getpid():
+        return
+    _task_worker_pid = os.getpid()
+    
+    def run(task):
+        task_worker.run(task)
+        # A worker that only runs queued pages never finishes an admission ticket, so it checks for recycling here
+        if not task_worker.held() and not (admission.inflight or admission.queued):
+            memory_profiler.maybe_recycle()
     
-    # Extract all words and keep their original order
-    words = re.findall(r'\b\w+\b', text.lower())
-    
-    # Process words with context awareness
-    scene_elements = []
-    for word in words:
-        if word not in stop_words and len(word) > 2:
-            # Prioritize words based on their category
-            if word in emotion_words:
-                scene_elements.insert(0, word)  # Emotions get high priority
-            elif word in action_words or word.endswith('ing'):
-                scene_elements.append(word)
-            elif word in object_words:
-                scene_elements.append(word)
-            elif word.endswith('ly'):  # Adverbs for action description
-                scene_elements.append(word)
-    
-    # Build scene description with context markers
-    scene_desc = []
-    emotions = [w for w in scene_elements if w in emotion_words]
-    actions = [w for w in scene_elements if w in action_words or w.endswith('ing')]
-    objects = [w for w in scene_elements if w in object_words]
-    
-    # Construct a more natural scene description
-    if emotions:
-        scene_desc.append(f"feeling {emotions[0]}")
-    if actions:
-        scene_desc.append(actions[0])
-    if objects:
-        scene_desc.extend(objects[:2])
-    
-    # Add remaining important words
-    remaining_words = [w for w in scene_elements if w not in (emotions + actions + objects)]
-    scene_desc.extend(remaining_words[:3])
-    
-    final_desc = ' '.join(scene_desc)
-    
-    # Add scene type hints
-    if any(word in final_desc for word in ['run', 'jump', 'chase', 'dance']):
-        final_desc += ", dynamic action scene"
-    elif any(word in emotion_words for word in words):
-        final_desc += ", emotional moment"
-    elif any(word in ['forest', 'garden', 'beach', 'mountain'] for word in words):
-        final_desc += ", nature scene"
-    elif any(word in ['castle', 'house', 'shop', 'school'] for word in words):
-        final_desc += ", architectural setting"
-    
-    return final_desc if final_desc else None
-
- 
+    def submit(task):
+        page_scheduler.submit(task['payload'].get('lane') or task['group'], run, task)
+    
+    def has_capacity():
+        stats = page_scheduler.stats()
+        return stats['active'] + stats['queued'] < stats['workers']
+    task_worker.start(submit, has_capacity, TASK_POLL_SECONDS)
+
+def audiobook_path(story_id):
+    """Path of the cached audiobook archive for a story"""
+    return os.path.join("uploads", f"audiobook_{story_id}.zip")
+
+def invalidate_derived_artifacts(story_id, record):
+    """Drop the PDF and audiobook archive so they are rebuilt from current page assets"""
+    for path in (record.get('pdf_path'), audiobook_path(story_id)):
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f" Could not remove stale artifact {path}: {e}")
+    record['pdf_path'] = None
+
+# Serializes one story's PDF builds and removals so a stale provisional PDF never replaces a newer one
+_pdf_build_locks = [threading.Lock() for _ in range(64)]
+
+def pdf_build_lock(story_id):
+    """The lock for one story's PDF; stories are striped over a fixed table so builds of different stories run in parallel"""
+    return _pdf_build_locks[hash(story_id) % len(_pdf_build_locks)]
+
+def discard_story_pdf(story_id):
+    """Remove a story's PDF so the next download rebuilds it from the current page assets"""
+    filepath = os.path.join("uploads", f"storybook_{story_id}.pdf")
+    with pdf_build_lock(story_id):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+def ensure_storybook_pdf(story_id):
+    """Return the story PDF, rebuilding it from the stored record if it was invalidated
+
+    Partial stories get a provisional PDF with placeholders for the pages that
+    are still being backfilled.
+    """
+    filepath = os.path.join("uploads", f"storybook_{story_id}.pdf")
+    if os.path.exists(filepath):
+        return filepath
+
+    with pdf_build_lock(story_id):
+        if os.path.exists(filepath):
+            return filepath
+        record = load_story_record(story_id)
+        if not story_is_complete(record) and record.get('status') != 'partial':
+            return None
+        with memory_profiler.stage(story_id, 'pdf'):
+            filepath = create_storybook_pdf(record['story_data'], record.get('image_paths', []), story_id)
+        update_story_record(story_id, lambda current: current.update(pdf_path=filepath))
+    return filepath
+
+def ensure_audiobook(story_id):
+    """Return the audiobook archive for a story, building it once from the page audio"""
+    import zipfile
+
+    filepath = audiobook_path(story_id)
+    if os.path.exists(filepath):
+        return filepath
+    if os.path.exists(story_record_path(story_id)) and not story_is_complete(load_story_record(story_id)):
+        return None
+
+    # The record knows each page's file; older stories without one are found by the backend's extension
+    audio_paths = []
+    if os.path.exists(story_record_path(story_id)):
+        audio_paths = load_story_record(story_id).get('audio_paths') or []
+
+    # atomic_output removes the temporary archive if building it fails
+    with memory_profiler.stage(story_id, 'audiobook'), atomic_output(filepath) as temp_path:
+        with zipfile.ZipFile(temp_path, 'w') as zip_file:
+            for i in range(1, max(len(audio_paths), 14) + 1):
+                audio_path = audio_paths[i - 1] if i <= len(audio_paths) else None
+                audio_path = audio_path or os.path.join("uploads", f"page_{i}_{story_id}.{speech.backend.extension}")
+                if os.path.exists(audio_path):
+                    zip_file.write(audio_path, f"Page_{i}{os.path.splitext(audio_path)[1]}")
+    return filepath
+
+def regenerate_story_page(story_id, page_number, assets):
+    """Regenerate selected assets for one page and update the stored story record"""
+    record = load_story_record(story_id)
+    story_data = record['story_data']
+    pages = story_data['pages']
+    if page_number < 1 or page_number > len(pages):
+        raise ValueError(f"Page {page_number} does not exist in story {story_id}")
+    if not story_is_complete(record):
+        raise StoryBusyError(f"Story {story_id} is still being generated")
+
+    index = page_number - 1
+    page = pages[index]
+    assets = set(assets)
+    # Narration has to match the page text, so new text always means new audio
+    if 'text' in assets:
+        assets.add('audio')
+
+    result = {'page': page_number, 'regenerated': [], 'failed': []}
+    changes = {}
+
+    if 'text' in assets:
+        text_metrics = {}
+        page['text'] = regenerate_page_text(story_data, page_number, text_metrics)
+        changes['text'] = page['text']
+        result['regenerated'].append('text')
+        result['text_metrics'] = text_metrics
+
+    if 'image' in assets:
+        image_path, image_status, image_meta = generate_page_image_with_status(
+            story_data['character_description'],
+            page['text'],
+            page['page'],
+            story_id,
+            story_data.get('setting', '')
+        )
+        previous_image = (record.get('image_paths') or [None] * len(pages))[index]
+        if image_status == 'ready' or not (previous_image and os.path.exists(previous_image)):
+            changes['image'] = (image_path, image_status)
+            changes['image_meta'] = image_meta
+        elif image_path and image_path != previous_image and os.path.exists(image_path):
+            # The page keeps its current illustration instead of trading it for a placeholder
+            os.remove(image_path)
+        result['regenerated' if image_status == 'ready' else 'failed'].append('image')
+        result['image_generated'] = image_status == 'ready'
+
+    if 'audio' in assets:
+        # Narration is written to a temporary file, so a failure leaves the current track in place
+        audio_path = generate_speech_for_page(page['text'], page['page'], story_id, narration=story_narration(story_id))
+        if audio_path:
+            changes['audio'] = (audio_path, 'ready')
+        elif 'text' in changes:
+            # Never leave narration for the old text behind
+            changes['audio'] = (None, 'failed')
+        result['regenerated' if audio_path else 'failed'].append('audio')
+        result['audio_generated'] = bool(audio_path)
+
+    def apply_changes(current):
+        current_pages = current['story_data']['pages']
+        for key in ('image_paths', 'audio_paths'):
+            current.setdefault(key, [])
+            while len(current[key]) < len(current_pages):
+                current[key].append(None)
+        page_status = current.setdefault('page_status', [])
+        while len(page_status) < len(current_pages):
+            page_status.append({'image': 'ready', 'audio': 'ready'})
+
+        if 'text' in changes:
+            current_pages[index]['text'] = changes['text']
+        for kind in ('image', 'audio'):
+            if kind in changes:
+                path, status = changes[kind]
+                # A new image may be in a different format, so the old file would be orphaned
+                previous = current[f'{kind}_paths'][index]
+                if previous and previous != path and os.path.exists(previous):
+                    os.remove(previous)
+                current[f'{kind}_paths'][index] = path
+                page_status[index][kind] = status
+        if 'image' in changes:
+            image_meta = current.setdefault('image_meta', [])
+            while len(image_meta) < len(current_pages):
+                image_meta.append(None)
+            image_meta[index] = changes['image_meta']
+        invalidate_derived_artifacts(story_id, current)
+
+    record = update_story_record(story_id, apply_changes)
+
+    result['page_data'] = record['story_data']['pages'][index]
+    return result
+
+# Story archives: a tar stream of stories/<id>.json manifests, each followed by the
+# blobs/<sha256> asset bodies not already sent, and a closing export.json summary
+ARCHIVE_CHUNK_BYTES = 1024 * 1024
+# /api/export and /api/import hand out and replace whole stories, so they are only served with a token
+ARCHIVE_TOKEN = os.getenv("ARCHIVE_TOKEN", "")
+
+def archive_auth_error():
+    """An error response unless the request carries ARCHIVE_TOKEN; None when it may proceed"""
+    if not ARCHIVE_TOKEN:
+        return jsonify({'error': 'Story archives are only served with ARCHIVE_TOKEN set; use cli.py export/import instead'}), 503
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {ARCHIVE_TOKEN}"):
+        return jsonify({'error': 'Invalid archive token'}), 401
+    return None
+
+def parse_archive_time(value):
+    """Epoch seconds or an ISO 8601 date/time, as epoch seconds; None passes through"""
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    from datetime import datetime
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        raise ValueError(f"Invalid time {value!r}: use epoch seconds or ISO 8601")
+
+def story_created_at(story_id, record):
+    """When a story was created; records from before created_at existed use the record file's mtime"""
+    return record.get('created_at') or os.path.getmtime(story_record_path(story_id))
+
+def select_archive_stories(story_ids=None, since=None, until=None):
+    """Story ids to export: the given ids, or every stored story, limited to a creation time range"""
+    if not story_ids:
+        prefix, suffix = 'story_data_', '.json'
+        story_ids = [name[len(prefix):-len(suffix)] for name in os.listdir('uploads')
+                     if name.startswith(prefix) and name.endswith(suffix)] if os.path.isdir('uploads') else []
+    selected = []
+    for story_id in dict.fromkeys(story_ids):
+        try:
+            record = load_story_record(story_id)
+        except FileNotFoundError:
+            continue
+        created_at = story_created_at(story_id, record)
+        if (since is None or created_at >= since) and (until is None or created_at < until):
+            selected.append((created_at, story_id))
+    return [story_id for _, story_id in sorted(selected)]
+
+def file_sha256(filepath):
+    """Content hash and size of a file, read in chunks"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(ARCHIVE_CHUNK_BYTES), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+def story_archive_assets(record):
+    """(field, index, path) for every asset file a story record points at"""
+    assets = []
+    for field in ('image_paths', 'audio_paths'):
+        for index, path in enumerate(record.get(field) or []):
+            if path:
+                assets.append((field, index, path))
+    if record.get('pdf_path'):
+        assets.append(('pdf_path', None, record['pdf_path']))
+    return assets
+
+def archive_asset_pattern(story_id):
+    """File names a story's own export can contain; an archive naming anything else is refused"""
+    story = re.escape(story_id)
+    extensions = '|'.join(sorted({extension.lstrip('.') for extension in IMAGE_EXTENSIONS.values()} | {'mp3', 'wav', speech.backend.extension}))
+    return re.compile(rf"page_\d+_{story}(?:_pending)?\.(?:{extensions})|storybook_{story}\.pdf")
+
+def set_record_path(record, field, index, path):
+    if index is None:
+        record[field] = path
+    else:
+        record[field][index] = path
+
+def tar_header(name, size):
+    """A tar header block for a regular file member"""
+    import tarfile
+    
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+def tar_padding(size):
+    import tarfile
+    return b'\0' * (-size % tarfile.BLOCKSIZE)
+
+def tar_bytes_member(name, data):
+    yield tar_header(name, len(data))
+    yield data
+    yield tar_padding(len(data))
+
+def export_story_archive(story_ids, stats=None):
+    """Yield a tar archive of the stories' records and asset files, one chunk at a time
+
+    Memory stays constant whatever the archive size: headers are built per
+    member and file bodies are streamed in ARCHIVE_CHUNK_BYTES pieces. Each
+    distinct asset is sent once, named by its SHA-256, however many pages or
+    stories share it. Stories still generating are skipped.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(stories=0, assets=0, bytes=0, deduplicated=0, skipped=[], missing=[])
+    started = time.time()
+    sent = set()
+
+    for story_id in story_ids:
+        try:
+            record = load_story_record(story_id)
+        except FileNotFoundError:
+            stats['missing'].append(story_id)
+            continue
+        if record.get('status') in ('generating', 'partial'):
+            stats['skipped'].append(story_id)
+            continue
+
+        assets = []
+        for field, index, path in story_archive_assets(record):
+            if not os.path.exists(path):
+                set_record_path(record, field, index, None)
+                continue
+            sha256, size = file_sha256(path)
+            assets.append({'field': field, 'index': index, 'name': os.path.basename(path),
+                           'sha256': sha256, 'size': size, 'path': path})
+        manifest = {
+            'story_id': story_id,
+            'record': record,
+            'assets': [{key: value for key, value in asset.items() if key != 'path'} for asset in assets]
+        }
+        yield from tar_bytes_member(f"stories/{story_id}.json", json.dumps(manifest).encode('utf-8'))
+
+        for asset in assets:
+            if asset['sha256'] in sent:
+                stats['deduplicated'] += 1
+                continue
+            sent.add(asset['sha256'])
+            yield tar_header(f"blobs/{asset['sha256']}", asset['size'])
+            digest = hashlib.sha256()
+            remaining = asset['size']
+            with open(asset['path'], 'rb') as f:
+                while remaining:
+                    chunk = f.read(min(ARCHIVE_CHUNK_BYTES, remaining))
+                    if not chunk:
+                        raise IOError(f"{asset['path']} shrank during export")
+                    digest.update(chunk)
+                    remaining -= len(chunk)
+                    yield chunk
+            # The header is already out, so a file rewritten mid-export aborts the archive
+            if digest.hexdigest() != asset['sha256']:
+                raise IOError(f"{asset['path']} changed during export")
+            yield tar_padding(asset['size'])
+            stats['assets'] += 1
+            stats['bytes'] += asset['size']
+        stats['stories'] += 1
+
+    stats['seconds'] = round(time.time() - started, 3)
+    stats['mb_per_second'] = round(stats['bytes'] / 1e6 / stats['seconds'], 2) if stats['seconds'] else None
+    yield from tar_bytes_member('export.json', json.dumps(stats).encode('utf-8'))
+    # End-of-archive marker
+    yield b'\0' * 1024
+    print(f"📦 Exported {stats['stories']} stories, {stats['assets']} assets ({stats['bytes']} bytes, "
+          f"{stats['deduplicated']} deduplicated) in {stats['seconds']} s")
+
+def import_story_archive(fileobj, overwrite=False):
+    """Read a story archive from fileobj and store its stories, returning import stats
+
+    The archive is read as a stream, so memory stays constant. Every asset
+    body is checked against its SHA-256 before it is moved into place.
+    Assets the destination already has under the same name and hash are not
+    rewritten, and identical assets are hard-linked. Existing stories are left
+    alone unless overwrite is set.
+    """
+    import tarfile
+    
+    stats = {'stories': 0, 'assets': 0, 'bytes': 0, 'already_present': 0, 'linked': 0,
+             'skipped': [], 'failed': [], 'source': None}
+    started = time.time()
+    os.makedirs('uploads', exist_ok=True)
+    local = {}    # sha256 -> a file in uploads known to hold that content
+    waiting = {}  # sha256 -> [(story_id, target path)] still to be written
+    pending = {}  # story_id -> (record, set of sha256 not yet in place)
+    staged = []   # bodies kept only because a later story may share them
+
+    def place(sha256, target):
+        # Link to content already in uploads instead of writing it again
+        if os.path.abspath(local[sha256]) != os.path.abspath(target):
+            link_shared_file(local[sha256], target)
+            stats['linked'] += 1
+
+    def finish(story_id):
+        record, _ = pending.pop(story_id)
+        save_story_record(story_id, record)
+        if os.path.exists(audiobook_path(story_id)):
+            os.remove(audiobook_path(story_id))
+        stats['stories'] += 1
+
+    def add_story(manifest):
+        story_id = str(manifest.get('story_id') or '')
+        # No underscores, so one story's file names can never spell another's
+        if not re.fullmatch(r'[A-Za-z0-9-]+', story_id):
+            raise ValueError(f"Invalid story id {story_id!r} in archive")
+        record = manifest['record']
+        allowed_names = archive_asset_pattern(story_id)
+        exists = os.path.exists(story_record_path(story_id))
+        if exists and not overwrite:
+            stats['skipped'].append(story_id)
+        missing = set()
+        archived = set()
+        for asset in manifest['assets']:
+            name = asset['name']
+            if not allowed_names.fullmatch(name):
+                raise ValueError(f"Invalid asset name {name!r} for story {story_id} in archive")
+            target = os.path.join('uploads', name)
+            archived.add((asset['field'], asset['index']))
+            set_record_path(record, asset['field'], asset['index'], target)
+            sha256 = asset['sha256']
+            if sha256 not in local and os.path.exists(target) and os.path.getsize(target) == asset['size'] \
+                    and file_sha256(target)[0] == sha256:
+                local[sha256] = target
+                stats['already_present'] += 1
+                continue
+            if exists and not overwrite:
+                # The body arrives once, after the first story that uses it; a later story may need it
+                if sha256 not in local:
+                    waiting.setdefault(sha256, [])
+                continue
+            if sha256 in local:
+                place(sha256, target)
+            else:
+                waiting.setdefault(sha256, []).append((story_id, target))
+                missing.add(sha256)
+        # Paths the source could not export would point at nothing here
+        for field, index, _ in story_archive_assets(record):
+            if (field, index) not in archived:
+                set_record_path(record, field, index, None)
+        if exists and not overwrite:
+            return
+        pending[story_id] = (record, missing)
+        if not missing:
+            finish(story_id)
+
+    def add_blob(member, body):
+        sha256 = member.name[len('blobs/'):]
+        if sha256 not in waiting:
+            return
+        targets = waiting.pop(sha256)
+        if targets:
+            first_target = targets[0][1]
+        else:
+            # Only skipped stories use it so far; keep it until the archive ends
+            first_target = os.path.join('uploads', f"import_{uuid.uuid4().hex[:8]}.blob")
+            staged.append(first_target)
+        digest = hashlib.sha256()
+        with atomic_output(first_target) as temp_path:
+            with open(temp_path, 'wb') as f:
+                for chunk in iter(lambda: body.read(ARCHIVE_CHUNK_BYTES), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            if digest.hexdigest() != sha256:
+                raise ValueError(f"Checksum mismatch for {os.path.basename(first_target)}")
+        local[sha256] = first_target
+        stats['assets'] += 1
+        stats['bytes'] += member.size
+        for story_id, target in targets:
+            place(sha256, target)
+            if story_id in pending:
+                pending[story_id][1].discard(sha256)
+                if not pending[story_id][1]:
+                    finish(story_id)
+
+    try:
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                body = archive.extractfile(member)
+                if member.name.startswith('stories/'):
+                    add_story(json.load(body))
+                elif member.name.startswith('blobs/'):
+                    add_blob(member, body)
+                elif member.name == 'export.json':
+                    stats['source'] = json.load(body)
+    finally:
+        # Stories that used a staged body hold their own hard links to it
+        for path in staged:
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Stories whose asset bodies never arrived are not stored
+    stats['failed'].extend(pending)
+    stats['seconds'] = round(time.time() - started, 3)
+    stats['mb_per_second'] = round(stats['bytes'] / 1e6 / stats['seconds'], 2) if stats['seconds'] else None
+    print(f"📦 Imported {stats['stories']} stories, {stats['assets']} assets ({stats['bytes']} bytes, "
+          f"{stats['already_present']} already present, {stats['linked']} linked) in {stats['seconds']} s")
+    return stats
+
+# Warm library: the most requested /generate prompts get a finished story pre-generated
+# while the instance is idle, and matching requests get a copy of it instantly
+WARM_LIBRARY = os.getenv("WARM_LIBRARY", "").lower() in ('1', 'true', 'yes')
+WARM_LIBRARY_DB_PATH = os.getenv("WARM_LIBRARY_DB_PATH", os.path.join("uploads", "warm_library.sqlite3"))
+WARM_LIBRARY_MIN_REQUESTS = int(os.getenv("WARM_LIBRARY_MIN_REQUESTS", "3"))
+WARM_LIBRARY_TOP_PROMPTS = int(os.getenv("WARM_LIBRARY_TOP_PROMPTS", "20"))
+WARM_LIBRARY_HALF_LIFE_HOURS = float(os.getenv("WARM_LIBRARY_HALF_LIFE_HOURS", "72"))
+WARM_LIBRARY_MAX_AGE_HOURS = float(os.getenv("WARM_LIBRARY_MAX_AGE_HOURS", "168"))
+WARM_LIBRARY_IDLE_SECONDS = float(os.getenv("WARM_LIBRARY_IDLE_SECONDS", "120"))
+WARM_LIBRARY_INTERVAL_SECONDS = float(os.getenv("WARM_LIBRARY_INTERVAL_SECONDS", "30"))
+# Budgets: disk used by library stories, and provider spend per UTC day (0 = unlimited)
+WARM_LIBRARY_MAX_MB = float(os.getenv("WARM_LIBRARY_MAX_MB", "500"))
+WARM_LIBRARY_DAILY_STORIES = int(os.getenv("WARM_LIBRARY_DAILY_STORIES", "20"))
+WARM_LIBRARY_DAILY_TOKENS = int(os.getenv("WARM_LIBRARY_DAILY_TOKENS", "0"))
+# A prompt whose pre-generation failed is not retried for this long
+WARM_LIBRARY_RETRY_SECONDS = 3600
+
+def library_prompt_key(prompt, story_length, narration, draft=False):
+    """Requests with the same words apart from case, punctuation and filler words share a key
+
+    Drafts and full stories never share one, so neither is served in place of the other.
+    """
+    words = [word for word in re.findall(r"[a-z0-9']+", prompt.lower()) if word not in STOP_WORDS]
+    return f"{'draft' if draft else 'full'}|{story_length}|{narration['voice']}|{narration['speed']}|{' '.join(words)}"
+
+def library_key_is_draft(key):
+    return key.startswith('draft|')
+
+class WarmLibrary:
+    """Prompt popularity, pre-generated stories and spend, in SQLite shared by every worker
+
+    Popularity is a request count that halves every half_life seconds, so
+    yesterday's fad gives way to today's. An entry is claimed with a lease
+    before its story is generated, so only one worker generates it.
+    """
+
+    def __init__(self, path, half_life, max_age):
+        self.path = path
+        self.half_life = half_life
+        self.max_age = max_age
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute("""CREATE TABLE IF NOT EXISTS prompts (
+            key TEXT PRIMARY KEY,
+            prompt TEXT NOT NULL,
+            story_length TEXT NOT NULL,
+            narration TEXT NOT NULL,
+            score REAL NOT NULL,
+            requests INTEGER NOT NULL,
+            hits INTEGER NOT NULL,
+            last_requested REAL NOT NULL
+        )""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            story_id TEXT,
+            state TEXT NOT NULL,
+            lease_expires REAL,
+            created_at REAL,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            stats TEXT,
+            served INTEGER NOT NULL DEFAULT 0,
+            failed_at REAL
+        )""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS spend (
+            day TEXT PRIMARY KEY,
+            stories INTEGER NOT NULL,
+            llm_tokens INTEGER NOT NULL,
+            images INTEGER NOT NULL,
+            audio INTEGER NOT NULL
+        )""")
+        return conn
+
+    def decayed(self, score, last_requested, now):
+        return score * 0.5 ** ((now - last_requested) / self.half_life)
+
+    def request(self, key, prompt, story_length, narration):
+        """Count a request for key; returns the library entry when a fresh ready story exists"""
+        now = time.time()
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                entry = conn.execute(
+                    "SELECT * FROM entries WHERE key = ? AND state = 'ready' AND created_at >= ?",
+                    (key, now - self.max_age)
+                ).fetchone()
+                row = conn.execute('SELECT score, last_requested FROM prompts WHERE key = ?', (key,)).fetchone()
+                score = (self.decayed(row['score'], row['last_requested'], now) if row else 0) + 1
+                conn.execute(
+                    "INSERT INTO prompts (key, prompt, story_length, narration, score, requests, hits, last_requested) "
+                    "VALUES (?, ?, ?, ?, ?, 1, ?, ?) ON CONFLICT(key) DO UPDATE SET prompt = excluded.prompt, "
+                    "score = excluded.score, requests = requests + 1, hits = hits + excluded.hits, "
+                    "last_requested = excluded.last_requested",
+                    (key, prompt, story_length, json.dumps(narration), score, 1 if entry else 0, now)
+                )
+                if entry:
+                    conn.execute('UPDATE entries SET served = served + 1 WHERE key = ?', (key,))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return dict(entry) if entry else None
+
+    def forget_hit(self, key):
+        """Undo the hit counted for an entry whose story could not be copied, and drop the entry"""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('UPDATE prompts SET hits = hits - 1 WHERE key = ? AND hits > 0', (key,))
+            conn.execute("DELETE FROM entries WHERE key = ? AND state = 'ready'", (key,))
+
+    def seconds_since_last_request(self):
+        with contextlib.closing(self._connect()) as conn:
+            last = conn.execute('SELECT MAX(last_requested) FROM prompts').fetchone()[0]
+        return time.time() - last if last else float('inf')
+
+    def popular_prompts(self, limit, min_requests=1):
+        """The prompts with the highest decayed popularity, most popular first"""
+        now = time.time()
+        with contextlib.closing(self._connect()) as conn:
+            rows = [dict(row) for row in conn.execute(
+                'SELECT p.*, e.state, e.story_id, e.created_at, e.served, e.failed_at, e.lease_expires '
+                'FROM prompts p LEFT JOIN entries e ON e.key = p.key WHERE p.requests >= ?', (min_requests,)
+            )]
+        for row in rows:
+            row['score'] = self.decayed(row['score'], row['last_requested'], now)
+        return sorted(rows, key=lambda row: row['score'], reverse=True)[:limit]
+
+    def claim_candidate(self, limit, min_requests, retry_after, lease):
+        """Claim the most popular prompt without a fresh story; None when every top prompt has one"""
+        now = time.time()
+        for row in self.popular_prompts(limit, min_requests):
+            fresh = row['state'] == 'ready' and row['created_at'] >= now - self.max_age
+            leased = (row['lease_expires'] or 0) > now
+            failed_recently = (row['failed_at'] or 0) > now - retry_after
+            if fresh or leased or failed_recently:
+                continue
+            with contextlib.closing(self._connect()) as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    current = conn.execute('SELECT lease_expires FROM entries WHERE key = ?', (row['key'],)).fetchone()
+                    if current and (current['lease_expires'] or 0) > now:
+                        conn.execute('ROLLBACK')
+                        continue
+                    if current:
+                        # An expired story keeps its row, and is deleted once its replacement is ready
+                        conn.execute('UPDATE entries SET lease_expires = ? WHERE key = ?', (now + lease, row['key']))
+                    else:
+                        conn.execute("INSERT INTO entries (key, state, lease_expires) VALUES (?, 'generating', ?)",
+                                     (row['key'], now + lease))
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+            row['narration'] = json.loads(row['narration'])
+            return row
+        return None
+
+    def finish(self, key, story_id, size, stats):
+        """Make story_id the entry's story; returns the story it replaced, if any"""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                previous = conn.execute('SELECT story_id FROM entries WHERE key = ?', (key,)).fetchone()
+                conn.execute(
+                    "INSERT INTO entries (key, story_id, state, created_at, bytes, stats, served) VALUES (?, ?, 'ready', ?, ?, ?, 0) "
+                    "ON CONFLICT(key) DO UPDATE SET story_id = excluded.story_id, state = 'ready', lease_expires = NULL, "
+                    "created_at = excluded.created_at, bytes = excluded.bytes, stats = excluded.stats, served = 0, failed_at = NULL",
+                    (key, story_id, time.time(), size, json.dumps(stats, default=str))
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return previous['story_id'] if previous and previous['story_id'] != story_id else None
+
+    def release(self, key):
+        """Give up a claim without counting it as a failure"""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('UPDATE entries SET lease_expires = NULL WHERE key = ?', (key,))
+
+    def fail(self, key):
+        """Record a failed pre-generation; an older ready story for the key stays servable"""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("UPDATE entries SET state = CASE WHEN story_id IS NULL THEN 'failed' ELSE 'ready' END, "
+                         "lease_expires = NULL, failed_at = ? WHERE key = ?", (time.time(), key))
+
+    def reserve_story(self, max_stories, max_tokens):
+        """Count one more story against today's budgets if both still have room (0 = unlimited)
+
+        A single UPDATE checks and counts, so concurrent workers cannot overrun
+        the budget between them. Returns whether the story may be generated.
+        """
+        day = time.strftime('%Y-%m-%d', time.gmtime())
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("INSERT OR IGNORE INTO spend (day, stories, llm_tokens, images, audio) VALUES (?, 0, 0, 0, 0)", (day,))
+            cursor = conn.execute(
+                "UPDATE spend SET stories = stories + 1 WHERE day = ? AND (? = 0 OR stories < ?) AND (? = 0 OR llm_tokens < ?)",
+                (day, max_stories, max_stories, max_tokens, max_tokens)
+            )
+        return cursor.rowcount == 1
+
+    def add_spend(self, llm_tokens, images, audio):
+        """Add what a reserved story actually spent"""
+        day = time.strftime('%Y-%m-%d', time.gmtime())
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO spend (day, stories, llm_tokens, images, audio) VALUES (?, 0, ?, ?, ?) "
+                "ON CONFLICT(day) DO UPDATE SET llm_tokens = llm_tokens + excluded.llm_tokens, "
+                "images = images + excluded.images, audio = audio + excluded.audio",
+                (day, llm_tokens, images, audio)
+            )
+
+    def spend_today(self):
+        day = time.strftime('%Y-%m-%d', time.gmtime())
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute('SELECT * FROM spend WHERE day = ?', (day,)).fetchone()
+        return dict(row) if row else {'day': day, 'stories': 0, 'llm_tokens': 0, 'images': 0, 'audio': 0}
 
-def try_fallback_tts(text, filename):
-    """Enhanced fallback TTS with multiple options"""
-    print("Attempting fallback TTS solution...")
+    def evict(self, max_bytes):
+        """Drop the least popular ready stories until the library fits max_bytes; returns their story ids"""
+        now = time.time()
+        with contextlib.closing(self._connect()) as conn:
+            rows = [dict(row) for row in conn.execute(
+                "SELECT e.key, e.story_id, e.bytes, p.score, p.last_requested FROM entries e "
+                "LEFT JOIN prompts p ON p.key = e.key WHERE e.state = 'ready'"
+            )]
+            total = sum(row['bytes'] for row in rows)
+            rows.sort(key=lambda row: self.decayed(row['score'] or 0, row['last_requested'] or now, now))
+            evicted = []
+            for row in rows:
+                if total <= max_bytes:
+                    break
+                conn.execute('DELETE FROM entries WHERE key = ?', (row['key'],))
+                total -= row['bytes']
+                evicted.append(row['story_id'])
+        return evicted
+
+    def stats(self, top=10):
+        with contextlib.closing(self._connect()) as conn:
+            totals = conn.execute('SELECT COALESCE(SUM(requests), 0) AS requests, COALESCE(SUM(hits), 0) AS hits FROM prompts').fetchone()
+            library = conn.execute("SELECT COUNT(*) AS stories, COALESCE(SUM(bytes), 0) AS bytes, COALESCE(SUM(served), 0) AS served "
+                                   "FROM entries WHERE state = 'ready'").fetchone()
+        return {
+            'requests': totals['requests'],
+            'hits': totals['hits'],
+            'hit_rate': round(totals['hits'] / totals['requests'], 3) if totals['requests'] else None,
+            'stories': library['stories'],
+            'bytes': library['bytes'],
+            'served': library['served'],
+            'spend_today': self.spend_today(),
+            'top_prompts': [
+                {'prompt': row['prompt'], 'length': row['story_length'], 'requests': row['requests'], 'hits': row['hits'],
+                 'popularity': round(row['score'], 2), 'state': row['state'], 'story_id': row['story_id']}
+                for row in self.popular_prompts(top)
+            ]
+        }
+
+warm_library = WarmLibrary(WARM_LIBRARY_DB_PATH, WARM_LIBRARY_HALF_LIFE_HOURS * 3600, WARM_LIBRARY_MAX_AGE_HOURS * 3600)
+
+def story_asset_bytes(story_id):
+    """Bytes on disk used by a story's record and asset files"""
+    record = load_story_record(story_id)
+    paths = [story_record_path(story_id)] + [path for _, _, path in story_archive_assets(record)]
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+def delete_story_files(story_id):
+    """Remove a story's record, assets and derived archives"""
     try:
-        from gtts import gTTS
-        tts = gTTS(text=text, lang='en', slow=False)
-        tts.save(filename)
-        print(f" Fallback speech saved as {filename}")
-        return filename
-    except ImportError:
-        print("gTTS not installed. Install with: pip install gtts")
+        record = load_story_record(story_id)
+    except FileNotFoundError:
+        return
+    paths = [path for _, _, path in story_archive_assets(record)]
+    paths += [audiobook_path(story_id), os.path.join("uploads", f"storybook_{story_id}.pdf"), story_record_path(story_id),
+              os.path.join("uploads", "locks", f"{os.path.basename(story_record_path(story_id))}.lock")]
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+def clone_story(source_id):
+    """Copy a story under a new id, hard-linking its assets; returns (story_id, record)
+
+    The copy can be regenerated page by page without touching the source,
+    because asset files are always replaced by rename rather than rewritten.
+    """
+    record = load_story_record(source_id)
+    assets = story_archive_assets(record)
+    # Check every asset before linking any, so a broken source leaves no stray copies behind
+    for _, _, path in assets:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+    story_id = str(uuid.uuid4())[:8]
+    linked = []
+    try:
+        for field, index, path in assets:
+            clone_path = os.path.join("uploads", os.path.basename(path).replace(source_id, story_id))
+            link_shared_file(path, clone_path)
+            linked.append(clone_path)
+            set_record_path(record, field, index, clone_path)
+        record.pop('library', None)
+        record.pop('memory', None)
+        record['created_at'] = time.time()
+        record['library_source'] = source_id
+        save_story_record(story_id, record)
+    except BaseException:
+        # Without a record nothing would ever find these links again
+        for clone_path in linked:
+            if os.path.exists(clone_path):
+                os.remove(clone_path)
+        raise
+    return story_id, record
+
+def serve_from_warm_library(prompt, story_length, narration, draft=False):
+    """Count the request and return (story_id, record, stats) for a copy of a pre-generated story, or None"""
+    key = library_prompt_key(prompt, story_length, narration, draft)
+    entry = warm_library.request(key, prompt, story_length, narration)
+    if not entry:
         return None
-    except Exception as e:
-        print(f" Fallback TTS also failed: {e}")
+    try:
+        story_id, record = clone_story(entry['story_id'])
+    except FileNotFoundError:
+        # The library copy is broken; drop its entry and whatever files it still has
+        warm_library.forget_hit(key)
+        delete_story_files(entry['story_id'])
         return None
+    except OSError as e:
+        # Not the library's fault (a full disk, say); generate the story as usual
+        print(f"⚠️ Could not copy library story {entry['story_id']}: {e}")
+        warm_library.forget_hit(key)
+        return None
+    print(f"🔥 Served story {story_id} from the warm library ({entry['story_id']})")
+    return story_id, record, json.loads(entry['stats'] or '{}')
 
-def generate_speech_for_page(text, page_number, story_id):
-    """Generate speech for a specific page using gTTS"""
-    print(f"\n Generating TTS for page {page_number}")
-    
-    # Ensure uploads directory exists
-    os.makedirs('uploads', exist_ok=True)
+def pregenerate_popular_story():
+    """Generate one story for the most popular prompt lacking one, if the instance is idle and budgets allow
+
+    Returns the new library story id, or None when there was nothing to do.
+    """
+    if admission.inflight or admission.queued:
+        return None
+    if warm_library.seconds_since_last_request() < WARM_LIBRARY_IDLE_SECONDS:
+        return None
     
-    filename = f"page_{page_number}_{story_id}.mp3"
-    filepath = os.path.join("uploads", filename)
+    lease = GENERATION_BUDGETS['extended'] * 4
+    candidate = warm_library.claim_candidate(WARM_LIBRARY_TOP_PROMPTS, WARM_LIBRARY_MIN_REQUESTS, WARM_LIBRARY_RETRY_SECONDS, lease)
+    if not candidate:
+        return None
+    ticket = admission.admit()
+    if not ticket:
+        warm_library.release(candidate['key'])
+        return None
+    if not warm_library.reserve_story(WARM_LIBRARY_DAILY_STORIES, WARM_LIBRARY_DAILY_TOKENS):
+        ticket.finish()
+        warm_library.release(candidate['key'])
+        return None
     
+    draft = library_key_is_draft(candidate['key'])
+    story_id = str(uuid.uuid4())[:8]
+    text_metrics = {}
+    stats = {}
     try:
-        # Generate speech using gTTS
-        tts = gTTS(text=text, lang='en', slow=False)
-        tts.save(filepath)
-        print(f" TTS audio saved as {filepath}")
-        return filepath
+        ticket.start()
+        print(f"🔥 Pre-generating {candidate['story_length']} story {story_id} for popular prompt: {candidate['prompt']}")
+        story_data = generate_story_pages(candidate['prompt'], candidate['story_length'], text_metrics)
+        record = new_story_record(story_data, candidate['story_length'], draft, candidate['narration'])
+        record['library'] = True
+        save_story_record(story_id, record)
+        # One lane for all pre-generation, so it never crowds out interactive stories
+        stats = submit_story_assets(story_id, story_data, lane='warm-library', draft=draft).result()
+        if draft and stats['image_placeholders'] < stats['total_pages']:
+            raise RuntimeError("not every page got its draft placeholder")
+        if not draft and (stats['images_generated'] < stats['total_pages'] or stats['audio_generated'] < stats['total_pages']):
+            raise RuntimeError("not every page got artwork and narration")
+        replaced = warm_library.finish(candidate['key'], story_id, story_asset_bytes(story_id), stats)
+        for old_story_id in [replaced] + warm_library.evict(int(WARM_LIBRARY_MAX_MB * 1024 * 1024)):
+            if old_story_id:
+                delete_story_files(old_story_id)
+        return story_id
     except Exception as e:
-        print(f"❌ Error generating audio: {e}")
+        print(f"⚠️ Pre-generation for {candidate['prompt']!r} failed: {e}")
+        warm_library.fail(candidate['key'])
+        delete_story_files(story_id)
         return None
+    finally:
+        ticket.finish()
+        warm_library.add_spend(
+            text_metrics.get('prompt_tokens', 0) + text_metrics.get('completion_tokens', 0),
+            stats.get('images_generated', 0),
+            stats.get('audio_generated', 0)
+        )
 
-def create_storybook_pdf(story_data, image_paths, story_id):
-    """Create enhanced PDF storybook with better formatting"""
-    # Ensure uploads directory exists
-    os.makedirs('uploads', exist_ok=True)
-    
-    filename = f"storybook_{story_id}.pdf"
-    filepath = os.path.join("uploads", filename)
-    
-    doc = SimpleDocTemplate(filepath, pagesize=A4, topMargin=0.5*inch, bottomMargin=0.5*inch)
-    styles = getSampleStyleSheet()
-    
-    # Enhanced custom styles
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=28,
-        spaceAfter=30,
-        alignment=1,  # Center
-        textColor=colors.darkblue,
-        fontName='Helvetica-Bold'
-    )
-    
-    story_style = ParagraphStyle(
-        'StoryText',
-        parent=styles['Normal'],
-        fontSize=16,
-        spaceAfter=20,
-        alignment=0,  # Left
-        leftIndent=30,
-        rightIndent=30,
-        leading=22
-    )
-    
-    moral_style = ParagraphStyle(
-        'MoralText',
-        parent=styles['Normal'],
-        fontSize=14,
-        spaceAfter=15,
-        alignment=1,  # Center
-        leftIndent=40,
-        rightIndent=40,
-        textColor=colors.darkgreen,
-        fontName='Helvetica-Oblique'
-    )
-    
-    story = []
-    
-    # Title page
-    story.append(Paragraph(story_data['title'], title_style))
-    story.append(Spacer(1, 30))
-    
-    # Add moral/message if available
-    if 'moral' in story_data and story_data['moral']:
-        story.append(Paragraph(f"<i>Lesson: {story_data['moral']}</i>", moral_style))
-        story.append(Spacer(1, 20))
+_warm_library_pid = None
+
+def start_warm_library():
+    """Start this process's pre-generation thread once; gunicorn calls it after forking each worker"""
+    global _warm_library_pid
+    if not WARM_LIBRARY or _warm_library_pid == os.getpid():
+        return
+    _warm_library_pid = os.getpid()
     
-    # Story pages with enhanced layout
-    for i, page in enumerate(story_data['pages']):
-        page_num = page['page']
-        
-        # Add page break between pages (except first)
-        if i > 0:
-            story.append(Spacer(1, 30))
-        
-        # Add page title
-        story.append(Paragraph(f"Page {page_num}", styles['Heading2']))
-        story.append(Spacer(1, 15))
-        
-        # Add image if available
-        if i < len(image_paths) and image_paths[i] and os.path.exists(image_paths[i]):
+    def loop():
+        while True:
+            time.sleep(WARM_LIBRARY_INTERVAL_SECONDS)
             try:
-                # Enhanced image sizing
-                img = RLImage(image_paths[i], width=5*inch, height=3.75*inch)
-                story.append(img)
-                story.append(Spacer(1, 15))
+                pregenerate_popular_story()
             except Exception as e:
-                print(f"Could not add image for page {page_num}: {e}")
-                # Add placeholder text when image fails
-                story.append(Paragraph(f"<i>[Image placeholder for page {page_num}]</i>", styles['Italic']))
-                story.append(Spacer(1, 15))
-        else:
-            # Add placeholder when no image is available
-            story.append(Paragraph(f"<i>[Image placeholder for page {page_num}]</i>", styles['Italic']))
-            story.append(Spacer(1, 15))
-        
-        # Add text with better formatting
-        story.append(Paragraph(page['text'], story_style))
-        story.append(Spacer(1, 20))
-    
-    doc.build(story)
-    print(f"✅ Enhanced PDF created: {filepath}")
-    return filepath
+                print(f"⚠️ Warm library: {e}")
+    threading.Thread(target=loop, name="warm-library", daemon=True).start()
+
 
- 
 
 @app.route('/')
 def home():
@@ -663,16 +3158,119 @@ def home():
 
 @app.route('/health')
 def health_check():
-    """Health check endpoint for monitoring"""
-    return jsonify({
-        'status': 'healthy',
+    """Health check endpoint for monitoring
+
+    Pass ?strict=1 to get a 503 while the instance is saturated, so a load
+    balancer can route new generations elsewhere.
+    """
+    load = admission.snapshot()
+    load['scheduler'] = page_scheduler.stats()
+    load['stage_latency'] = stage_latencies.snapshot()
+    load['rss_bytes'] = current_rss_bytes()
+    try:
+        tasks = task_queue.stats()
+        load['tasks'] = {key: tasks[key] for key in ('queued', 'leased', 'dead', 'expired_leases', 'oldest_queued_seconds')}
+        load['tasks']['held'] = task_worker.held()
+    except (TaskQueueError, sqlite3.Error) as e:
+        load['tasks'] = {'error': str(e)}
+    if WARM_LIBRARY:
+        library = warm_library.stats(top=0)
+        load['warm_library'] = {key: library[key] for key in ('requests', 'hits', 'hit_rate', 'stories', 'bytes')}
+    response = jsonify({
+        'status': 'saturated' if load['saturated'] else 'healthy',
         'timestamp': time.time(),
         'uploads_dir_exists': os.path.exists('uploads'),
         'api_keys_configured': {
             'openrouter': bool(OPENROUTER_API_KEY),
             'freepik': bool(FREEPIK_API_KEY)
-        }
+        },
+        'load': load
     })
+    if load['saturated'] and request_flag(request.args, 'strict'):
+        response.status_code = 503
+        response.headers['Retry-After'] = str(max(1, load['estimated_wait_seconds']))
+    return response
+
+@app.route('/debug/memory')
+def debug_memory():
+    """Memory use of this worker: RSS, per-stage totals and the top allocation sites
+
+    Only available with MEMORY_PROFILING=1. ?limit= sets how many sites are
+    listed; ?compare=baseline (default) ranks growth since startup, =previous
+    growth since the last call, and =none the largest sites overall.
+    """
+    if not memory_profiler.enabled:
+        return jsonify({'error': 'Memory profiling is disabled; set MEMORY_PROFILING=1'}), 404
+    compare = request.args.get('compare', 'baseline')
+    if compare not in ('baseline', 'previous', 'none'):
+        return jsonify({'error': 'compare must be baseline, previous or none'}), 400
+    limit = max(1, min(request.args.get('limit', 20, type=int), 200))
+    
+    report = memory_profiler.snapshot()
+    report['pid'] = os.getpid()
+    report['top_allocations'] = memory_profiler.top_allocations(limit, compare)
+    # Temporary files left behind by interrupted writes hold disk, and often a leak's trail
+    report['temp_files'] = {'count': 0, 'bytes': 0}
+    for name in os.listdir('uploads') if os.path.isdir('uploads') else []:
+        if name.endswith('.tmp'):
+            try:
+                report['temp_files']['bytes'] += os.path.getsize(os.path.join('uploads', name))
+                report['temp_files']['count'] += 1
+            except OSError:
+                pass  # Finished and renamed since the listing
+    return jsonify(report)
+
+@app.route('/api/library')
+def library_stats():
+    """Warm library hit rate, size, today's pre-generation spend against its budgets, and the top prompts"""
+    if not WARM_LIBRARY:
+        return jsonify({'error': 'The warm library is disabled; set WARM_LIBRARY=1'}), 404
+    stats = warm_library.stats(top=max(0, min(request.args.get('top', 10, type=int), 100)))
+    stats['budgets'] = {
+        'max_bytes': int(WARM_LIBRARY_MAX_MB * 1024 * 1024),
+        'daily_stories': WARM_LIBRARY_DAILY_STORIES or None,
+        'daily_llm_tokens': WARM_LIBRARY_DAILY_TOKENS or None
+    }
+    return jsonify(stats)
+
+@app.route('/api/tasks')
+def task_queue_stats():
+    """Durable task counts by kind and state, expired leases and the latest dead letters (?limit=)"""
+    limit = max(0, min(request.args.get('limit', 20, type=int), 200))
+    try:
+        stats = task_queue.stats()
+        stats['dead_letters'] = task_queue.dead_letters(limit) if limit else []
+    except TaskQueueError as e:
+        return jsonify({'error': str(e)}), 502
+    stats['held_by_this_worker'] = task_worker.held()
+    return jsonify(stats)
+
+@app.route('/api/tasks/<task_id>/retry', methods=['POST'])
+def retry_dead_task(task_id):
+    """Requeue a dead-lettered task with fresh attempts"""
+    try:
+        retried = task_queue.retry(task_id)
+    except TaskQueueError as e:
+        return jsonify({'error': str(e)}), 502
+    if not retried:
+        return jsonify({'error': 'No dead-lettered task with that id, or its work was queued again since'}), 404
+    task_worker.poke()
+    return jsonify({'success': True, 'task_id': task_id})
+
+@app.route('/api/task-queue/<operation>', methods=['POST'])
+def serve_task_queue(operation):
+    """Queue server for nodes started with TASK_QUEUE_URL pointing here; only with TASK_QUEUE_SERVE=1"""
+    if not TASK_QUEUE_SERVE:
+        return jsonify({'error': 'This instance does not serve the task queue; set TASK_QUEUE_SERVE=1'}), 404
+    if not TASK_QUEUE_TOKEN:
+        # Without a token anyone could complete, fail or requeue tasks
+        return jsonify({'error': 'The task queue is only served with TASK_QUEUE_TOKEN set'}), 503
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {TASK_QUEUE_TOKEN}"):
+        return jsonify({'error': 'Invalid queue token'}), 401
+    try:
+        return jsonify(dispatch_task_queue(task_queue, operation, request.get_json(silent=True) or {}))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
 @app.route('/test-story')
 def test_story():
@@ -711,8 +3309,61 @@ def test_story():
             'error': str(e)
         }), 500
 
+def run_streaming_generation(prompt, story_length, events, ticket=None, draft=False, narration=None):
+    """Run the whole pipeline, putting (event, payload) tuples on the events queue; None marks the end
+
+    The ticket must already be running; it is released when the pipeline ends.
+    """
+    try:
+        story_id = str(uuid.uuid4())[:8]
+        events.put(('started', {'story_id': story_id, 'length': story_length}))
+        
+        text_metrics = {}
+        memory_profiler.begin_story(story_id)
+        with memory_profiler.stage(story_id, 'story_text'):
+            story_data = generate_story_pages(prompt, story_length, text_metrics)
+        save_story_record(story_id, new_story_record(story_data, story_length, draft, narration))
+        events.put(('story', {
+            'story_id': story_id,
+            'story_data': story_data,
+            'text_metrics': text_metrics,
+            'reader_url': f'/reader/{story_id}',
+            'status_url': f'/api/story/{story_id}/status'
+        }))
+        
+        stats = generate_story_assets(story_id, story_data, on_event=lambda event, payload: events.put((event, payload)), draft=draft)
+        complete = {'story_id': story_id, 'stats': stats, 'reader_url': f'/reader/{story_id}'}
+        if stats['pdf_created']:
+            complete['pdf_url'] = f'/download-pdf/{story_id}'
+        if stats['audio_generated'] > 0:
+            complete['audiobook_url'] = f'/download-audiobook/{story_id}'
+        events.put(('complete', complete))
+    except Exception as e:
+        print(f" Error generating story: {e}")
+        events.put(('error', {'error': f'Story generation failed: {str(e)}'}))
+    finally:
+        if ticket:
+            ticket.finish()
+        events.put(None)
+
+def format_stream_event(event, payload, use_sse):
+    """Encode one event as a server-sent event or a newline-delimited JSON line"""
+    if use_sse:
+        return f"event: {event}\ndata: {json.dumps(payload, default=str)}\n\n"
+    return json.dumps({'event': event, **payload}, default=str) + "\n"
+
+def request_flag(data, name):
+    """Read a boolean option from JSON (true/false) or form data ('1', 'true', 'on')"""
+    value = data.get(name) if data else None
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
 @app.route('/generate', methods=['POST'])
 def generate_storybook():
+    ticket = None
+    idempotency_key = None
+    story_id = None
     try:
         # Ensure uploads directory exists at the start
         os.makedirs('uploads', exist_ok=True)
@@ -723,123 +3374,288 @@ def generate_storybook():
             prompt = data.get('prompt')
             story_length = data.get('length', 'normal')
         else:
+            data = request.form
             prompt = request.form.get('prompt')
             story_length = request.form.get('length', 'normal')
+        progressive = request_flag(data, 'progressive')
+        draft = request_flag(data, 'draft')
         
         if not prompt:
             return jsonify({'error': 'Prompt is required'}), 400
+        try:
+            narration = narration_settings(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
+        budget = GENERATION_BUDGETS.get(story_length, GENERATION_BUDGETS['normal'])
         story_id = str(uuid.uuid4())[:8]
         
-        print(f" Generating {story_length} story: {prompt}")
-        
-        # Generate enhanced story text
-        story_data = generate_story_pages(prompt, story_length)
-        
-        # Generate images for each page with enhanced consistency
-        image_paths = []
-        successful_images = 0
-        total_pages = len(story_data['pages'])
+        # Retries with the same key attach to the original request instead of paying for a new story
+        requested_key = request.headers.get('Idempotency-Key', '').strip()
+        if len(requested_key) > 255:
+            return jsonify({'error': 'Idempotency-Key must be at most 255 characters'}), 400
+        if requested_key:
+            fingerprint = hashlib.sha256(json.dumps([prompt, story_length, progressive, draft, narration]).encode()).hexdigest()
+            while True:
+                claimed, existing = idempotency_store.claim(requested_key, fingerprint, story_id)
+                if claimed:
+                    idempotency_key = requested_key
+                    break
+                if existing['fingerprint'] != fingerprint:
+                    return jsonify({'error': 'Idempotency-Key was already used for a different request'}), 422
+                existing = idempotency_store.wait(requested_key, budget)
+                if existing is None:
+                    continue  # The original attempt failed and released the key
+                if existing['state'] == 'done':
+                    return replay_idempotent_response(existing)
+                return jsonify({
+                    'success': True,
+                    'story_id': existing['story_id'],
+                    'status': 'generating',
+                    'reader_url': f"/reader/{existing['story_id']}",
+                    'status_url': f"/api/story/{existing['story_id']}/status"
+                }), 202
         
-        for page in story_data['pages']:
-            try:
-                image_path = generate_page_image(
-                    story_data['character_description'],
-                    page['text'],
-                    page['page'],
-                    story_id,
-                    story_data.get('setting', '')
-                )
-                if image_path:
-                    image_paths.append(image_path)
-                    successful_images += 1
-                else:
-                    # Create placeholder image if generation fails
-                    placeholder_path = create_placeholder_image(
-                        os.path.join('uploads', f'page_{page["page"]}_{story_id}.png'),
-                        page['page'],
-                        page['text']
-                    )
-                    image_paths.append(placeholder_path)
-            except Exception as e:
-                print(f"❌ Error generating image for page {page['page']}: {e}")
-                # Create placeholder image on error
-                placeholder_path = create_placeholder_image(
-                    os.path.join('uploads', f'page_{page["page"]}_{story_id}.png'),
-                    page['page'],
-                    page['text']
-                )
-                image_paths.append(placeholder_path)
+        def respond(payload, status_code=200):
+            if idempotency_key:
+                idempotency_store.complete(idempotency_key, story_id, payload, status_code)
+            return jsonify(payload), status_code
         
-        print(f"✅ Generated {successful_images}/{total_pages} images successfully")
+        # A popular prompt may have a finished story waiting; a copy of it costs nothing
+        library_story = serve_from_warm_library(prompt, story_length, narration, draft) if WARM_LIBRARY else None
+        if library_story:
+            copy_id, record, stats = library_story
+            library_response = {
+                'success': True,
+                'story_id': copy_id,
+                'story_data': record['story_data'],
+                'text_metrics': {},
+                'draft': draft,
+                'narration': record['narration'],
+                'reader_url': f'/reader/{copy_id}',
+                'status_url': f'/api/story/{copy_id}/status',
+                'status': 'complete',
+                'stats': stats,
+                'pdf_url': f'/download-pdf/{copy_id}',
+                'warm_library': True
+            }
+            if draft:
+                library_response['upgrade_url'] = f'/api/story/{copy_id}/upgrade'
+            if stats.get('audio_generated'):
+                library_response['audiobook_url'] = f'/download-audiobook/{copy_id}'
+            return respond(library_response)
         
-        # Generate speech for each page
-        audio_paths = []
-        successful_audio = 0
-        for page in story_data['pages']:
-            try:
-                audio_path = generate_speech_for_page(
-                    page['text'],
-                    page['page'],
-                    story_id
-                )
-                audio_paths.append(audio_path)
-                if audio_path:
-                    successful_audio += 1
-            except Exception as e:
-                print(f" Error generating audio for page {page['page']}: {e}")
-                audio_paths.append(None)
+        # Shed load before spending anything on providers
+        ticket = admission.admit()
+        if not ticket:
+            return busy_response()
+        # However long the wait for a slot, the key's claim must not lapse and let a retry start a second story
+        while not ticket.start(timeout=IDEMPOTENCY_LEASE_SECONDS / 4):
+            if idempotency_key:
+                idempotency_store.renew(idempotency_key, story_id)
+        if idempotency_key:
+            idempotency_store.renew(idempotency_key, story_id)
+        deadline = time.time() + budget
         
-        print(f" Generated {successful_audio}/{len(story_data['pages'])} audio files successfully")
+        print(f" Generating {story_length} story: {prompt}")
         
-        # Create enhanced PDF (this should work even without images)
-        try:
-            pdf_path = create_storybook_pdf(story_data, image_paths, story_id)
-        except Exception as e:
-            print(f" Error creating PDF: {e}")
-            pdf_path = None
+        # Generate enhanced story text
+        text_metrics = {}
+        memory_profiler.begin_story(story_id)
+        with memory_profiler.stage(story_id, 'story_text'):
+            story_data = generate_story_pages(prompt, story_length, text_metrics)
         
-        # Store story data for viewing
-        story_file = os.path.join("uploads", f"story_data_{story_id}.json")
-        try:
-            with open(story_file, 'w') as f:
-                json.dump({
-                    'story_data': story_data,
-                    'image_paths': image_paths,
-                    'audio_paths': audio_paths,
-                    'pdf_path': pdf_path,
-                    'story_length': story_length
-                }, f)
-        except Exception as e:
-            print(f" Error saving story data: {e}")
+        # The story is readable as soon as its text exists; assets fill in as they finish
+        save_story_record(story_id, new_story_record(story_data, story_length, draft, narration))
         
-        # Return success even if some components failed
         response_data = {
             'success': True,
             'story_id': story_id,
             'story_data': story_data,
-            'stats': {
-                'images_generated': successful_images,
-                'audio_generated': successful_audio,
-                'total_pages': len(story_data['pages'])
-            }
+            'text_metrics': text_metrics,
+            'draft': draft,
+            'narration': narration,
+            'reader_url': f'/reader/{story_id}',
+            'status_url': f'/api/story/{story_id}/status'
         }
+        if draft:
+            response_data['upgrade_url'] = f'/api/story/{story_id}/upgrade'
+        
+        if progressive:
+            # The background job now owns the ticket and releases it when the assets are done
+            run_story_assets_in_background(story_id, story_data, ticket, draft)
+            ticket = None
+            response_data['status'] = 'generating'
+            return respond(response_data, 202)
         
-        if pdf_path:
+        assets = submit_story_assets(story_id, story_data, draft=draft)
+        try:
+            stats = assets.result(timeout=max(0, deadline - time.time()))
+        except FutureTimeoutError:
+            # Answer now with placeholders; the page tasks keep running and backfill the story
+            response_data['status'] = 'partial'
+            response_data['deferred_pages'] = defer_pending_images(story_id, story_data)
             response_data['pdf_url'] = f'/download-pdf/{story_id}'
+            print(f"⏱️ Budget for story {story_id} expired, backfilling pages {response_data['deferred_pages']}")
+            
+            # The backfill keeps the admission slot until it finishes
+            backfill_ticket, ticket = ticket, None
+            def backfill_done(future):
+                if future.exception():
+                    print(f" Backfill failed for story {story_id}: {future.exception()}")
+                    update_story_record(story_id, lambda record: record.update(status='failed'))
+                backfill_ticket.finish()
+            assets.add_done_callback(backfill_done)
+            return respond(response_data)
         
-        if successful_audio > 0:
-            response_data['audiobook_url'] = f'/download-audiobook/{story_id}'
+        # Return success even if some components failed
+        response_data['status'] = 'complete'
+        response_data['stats'] = stats
         
-        response_data['reader_url'] = f'/reader/{story_id}'
+        if stats['pdf_created']:
+            response_data['pdf_url'] = f'/download-pdf/{story_id}'
+        
+        if stats['audio_generated'] > 0:
+            response_data['audiobook_url'] = f'/download-audiobook/{story_id}'
         
-        return jsonify(response_data)
+        return respond(response_data)
         
     except Exception as e:
         print(f" Error generating story: {e}")
         import traceback
         traceback.print_exc()
         return jsonify({'error': f'Story generation failed: {str(e)}'}), 500
+    finally:
+        if ticket:
+            ticket.finish()
+        if idempotency_key:
+            # No-op once a response was stored; otherwise lets a retry start over
+            idempotency_store.release(idempotency_key, story_id)
+
+@app.route('/generate/stream', methods=['POST'])
+def generate_storybook_stream():
+    """Streaming variant of /generate that reports each stage as it finishes
+
+    Responds with server-sent events when the client accepts text/event-stream
+    (or passes format=sse), otherwise with newline-delimited JSON.
+    """
+    os.makedirs('uploads', exist_ok=True)
+    
+    if request.is_json:
+        data = request.get_json()
+    else:
+        data = request.form
+    prompt = data.get('prompt')
+    story_length = data.get('length', 'normal')
+    draft = request_flag(data, 'draft')
+    if not prompt:
+        return jsonify({'error': 'Prompt is required'}), 400
+    try:
+        narration = narration_settings(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    stream_format = request.args.get('format') or data.get('format')
+    use_sse = stream_format == 'sse' or (not stream_format and 'text/event-stream' in request.headers.get('Accept', ''))
+    
+    print(f" Streaming {story_length} story: {prompt}")
+    
+    ticket = admission.admit()
+    if not ticket:
+        return busy_response()
+    
+    events = queue.Queue()
+    
+    def heartbeat():
+        # Keeps proxies and load balancers from closing an idle connection
+        if use_sse:
+            return ": heartbeat\n\n"
+        return format_stream_event('heartbeat', {'timestamp': time.time()}, use_sse)
+    
+    def stream():
+        # The slot is awaited here in the request thread: a background thread waiting for one would
+        # hold up the asset jobs of the stories that are running, and with them the slots they hold
+        if ticket.state == 'queued' and admission.inflight >= admission.max_inflight:
+            yield format_stream_event('queued', {'estimated_wait_seconds': admission.estimated_wait()}, use_sse)
+        while not ticket.start(timeout=STREAM_HEARTBEAT_SECONDS):
+            yield heartbeat()
+        background_executor.submit(run_streaming_generation, prompt, story_length, events, ticket, draft, narration)
+        while True:
+            try:
+                item = events.get(timeout=STREAM_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield heartbeat()
+                continue
+            if item is None:
+                return
+            yield format_stream_event(item[0], item[1], use_sse)
+    
+    mimetype = 'text/event-stream' if use_sse else 'application/x-ndjson'
+    response = Response(stream(), mimetype=mimetype, headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # A client that leaves before its story starts gives its place back; a started story releases its own ticket
+    response.call_on_close(lambda: ticket.finish() if ticket.state == 'queued' else None)
+    return response
+
+@app.route('/api/batch', methods=['POST'])
+def create_batch():
+    """Generate many stories at once; pages are scheduled fairly alongside interactive requests"""
+    data = request.get_json(silent=True) or {}
+    stories = data.get('stories')
+    if not isinstance(stories, list) or not stories:
+        return jsonify({'error': 'stories must be a non-empty list of {"prompt", "length"} objects'}), 400
+    if len(stories) > BATCH_MAX_STORIES:
+        return jsonify({'error': f'A batch can contain at most {BATCH_MAX_STORIES} stories'}), 400
+    # Each story takes an admission slot when it runs; refuse new batches while interactive requests are being shed
+    if not admission.has_room():
+        return busy_response()
+    
+    items = []
+    for index, story in enumerate(stories):
+        if isinstance(story, str):
+            story = {'prompt': story}
+        if not isinstance(story, dict) or not story.get('prompt'):
+            return jsonify({'error': f'Story {index} is missing a prompt'}), 400
+        try:
+            narration = narration_settings({'voice': story.get('voice', data.get('voice')), 'speed': story.get('speed', data.get('speed'))})
+        except ValueError as e:
+            return jsonify({'error': f'Story {index}: {e}'}), 400
+        items.append({'prompt': story['prompt'], 'length': story.get('length', data.get('length', 'normal')), 'narration': narration})
+    
+    os.makedirs('uploads', exist_ok=True)
+    batch_id = str(uuid.uuid4())[:8]
+    now = time.time()
+    with open(batch_record_path(batch_id), 'w') as f:
+        json.dump({
+            'batch_id': batch_id,
+            'status': 'running',
+            'created_at': now,
+            'finished_at': None,
+            'stories': [{'index': i, 'status': 'queued', **item} for i, item in enumerate(items)]
+        }, f)
+    
+    print(f" Starting batch {batch_id} with {len(items)} stories")
+    start_batch(batch_id, items)
+    
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'total_stories': len(items),
+        'status_url': f'/api/batch/{batch_id}'
+    }), 202
+
+@app.route('/api/batch/<batch_id>')
+def get_batch(batch_id):
+    """Per-story results and aggregate stats for a batch"""
+    try:
+        with open(batch_record_path(secure_filename(batch_id)), 'r') as f:
+            record = json.load(f)
+    except FileNotFoundError:
+        return jsonify({'error': 'Batch not found'}), 404
+    record['summary'] = batch_summary(record)
+    return jsonify(record)
 
 # Keep all existing download routes...
 @app.route('/download/<filename>')
@@ -849,16 +3665,7 @@ def download_file(filename):
         if not os.path.exists(filepath):
             return "File not found", 404
         
-        if filename.lower().endswith('.pdf'):
-            mimetype = 'application/pdf'
-        elif filename.lower().endswith('.mp3'):
-            mimetype = 'audio/mpeg'
-        elif filename.lower().endswith('.wav'):
-            mimetype = 'audio/wav'
-        elif filename.lower().endswith('.zip'):
-            mimetype = 'application/zip'
-        else:
-            mimetype = 'application/octet-stream'
+        mimetype = mimetypes.guess_type(filepath)[0] or 'application/octet-stream'
             
         return send_file(filepath, as_attachment=True, mimetype=mimetype)
     except Exception as e:
@@ -867,10 +3674,12 @@ def download_file(filename):
 @app.route('/download-pdf/<story_id>')
 def download_pdf(story_id):
     try:
-        pdf_filename = f"storybook_{story_id}.pdf"
-        filepath = os.path.join("uploads", pdf_filename)
-        if not os.path.exists(filepath):
+        try:
+            filepath = ensure_storybook_pdf(story_id)
+        except FileNotFoundError:
             return "PDF not found", 404
+        if not filepath:
+            return "PDF is still being generated", 409
         
         try:
             return send_file(filepath, 
@@ -888,30 +3697,17 @@ def download_pdf(story_id):
 @app.route('/download-audiobook/<story_id>')
 def download_audiobook(story_id):
     try:
-        import zipfile
-        import tempfile
-        
-        temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-        
-        with zipfile.ZipFile(temp_zip.name, 'w') as zip_file:
-            # Check for both .wav and .mp3 files
-            for i in range(1, 15):  # Support up to 15 pages
-                for ext in ['.wav', '.mp3']:
-                    audio_file = f"page_{i}_{story_id}{ext}"
-                    audio_path = os.path.join("uploads", audio_file)
-                    if os.path.exists(audio_path):
-                        zip_file.write(audio_path, f"Page_{i}{ext}")
-                        break  # Use first found format
-        
-        temp_zip.close()
+        filepath = ensure_audiobook(story_id)
+        if not filepath:
+            return "Audiobook is still being generated", 409
         
         try:
-            return send_file(temp_zip.name, 
+            return send_file(filepath, 
                             as_attachment=True, 
                             download_name=f"audiobook_{story_id}.zip",
                             mimetype='application/zip')
         except TypeError:
-            return send_file(temp_zip.name, 
+            return send_file(filepath, 
                             as_attachment=True, 
                             attachment_filename=f"audiobook_{story_id}.zip",
                             mimetype='application/zip')
@@ -922,9 +3718,7 @@ def download_audiobook(story_id):
 def story_reader(story_id):
     """Enhanced story reader with improved functionality"""
     try:
-        story_file = os.path.join("uploads", f"story_data_{story_id}.json")
-        with open(story_file, 'r') as f:
-            story_info = json.load(f)
+        story_info = load_story_record(story_id)
             
         print("Loaded story_info:", json.dumps(story_info, indent=2))
         
@@ -970,7 +3764,9 @@ def story_reader(story_id):
                              story_data=story_info['story_data'],
                              image_paths=image_paths,
                              audio_paths=audio_paths,
-                             story_id=story_id)
+                             story_id=story_id,
+                             story_status=story_info.get('status', 'complete'),
+                             story_draft=story_info.get('draft', False))
             
         # Clean up paths to use forward slashes and remove 'uploads' prefix
         image_paths = [path.replace('\\', '/').replace('uploads/', '') for path in story_info['image_paths']]
@@ -1011,10 +3807,7 @@ def serve_audio(filename):
         if not os.path.exists(filepath):
             return "Audio file not found", 404
             
-        if filename.lower().endswith('.mp3'):
-            mimetype = "audio/mpeg"
-        else:
-            mimetype = "audio/wav"
+        mimetype = mimetypes.guess_type(filepath)[0] or "audio/mpeg"
         return send_file(filepath, mimetype=mimetype)
     except Exception as e:
         print(f"Error serving audio: {e}")
@@ -1037,7 +3830,8 @@ def serve_image(filename):
         if not os.path.exists(filepath):
             return "Image file not found", 404
             
-        return send_file(filepath, mimetype="image/png")
+        mimetype = mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+        return send_file(filepath, mimetype=mimetype)
     except Exception as e:
         print(f"Error serving image: {e}")
         return "Error serving image file", 500
@@ -1047,13 +3841,123 @@ def serve_image(filename):
 def get_story_data(story_id):
     """API endpoint to get story data as JSON"""
     try:
-        story_file = os.path.join("uploads", f"story_data_{story_id}.json")
-        with open(story_file, 'r') as f:
-            story_info = json.load(f)
+        story_info = load_story_record(story_id)
         return jsonify(story_info)
     except FileNotFoundError:
         return jsonify({'error': 'Story not found'}), 404
 
+@app.route('/api/story/<story_id>/status')
+def get_story_status(story_id):
+    """Per-page status and asset URLs so the reader can fill pages in as they finish"""
+    try:
+        story_info = load_story_record(story_id)
+    except FileNotFoundError:
+        # A retried request was told to poll this id before the original request has written the story's text
+        if idempotency_store.is_running(story_id):
+            return jsonify({'story_id': story_id, 'status': 'pending', 'title': '', 'pages': []})
+        return jsonify({'error': 'Story not found'}), 404
+    return jsonify(story_status_payload(story_id, story_info))
+
+@app.route('/api/story/<story_id>/pages/<int:page_number>/regenerate', methods=['POST'])
+def regenerate_page(story_id, page_number):
+    """Regenerate the image, audio and/or text of one page without redoing the story"""
+    data = request.get_json(silent=True) or {}
+    assets = data.get('assets', ['image'])
+    if isinstance(assets, str):
+        assets = [assets]
+
+    invalid_assets = [asset for asset in assets if asset not in ('image', 'audio', 'text')]
+    if not assets or invalid_assets:
+        return jsonify({'error': "assets must be a list containing 'image', 'audio' and/or 'text'"}), 400
+
+    try:
+        result = regenerate_story_page(story_id, page_number, assets)
+    except FileNotFoundError:
+        return jsonify({'error': 'Story not found'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    except StoryBusyError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        print(f" Error regenerating page {page_number} of story {story_id}: {e}")
+        return jsonify({'error': f'Page regeneration failed: {str(e)}'}), 500
+
+    result.update({
+        'success': not result['failed'],
+        'story_id': story_id,
+        'pdf_url': f'/download-pdf/{story_id}',
+        'audiobook_url': f'/download-audiobook/{story_id}',
+        'reader_url': f'/reader/{story_id}'
+    })
+    if result['failed']:
+        # Whatever did succeed is saved; the page keeps its previous version of the rest
+        result['error'] = f"Could not regenerate {' and '.join(result['failed'])} for page {page_number}"
+        return jsonify(result), 502
+    return jsonify(result)
+
+@app.route('/api/story/<story_id>/upgrade', methods=['POST'])
+def upgrade_story(story_id):
+    """Replace a draft story's placeholder art with full-quality illustrations and add narration"""
+    if not os.path.exists(story_record_path(story_id)):
+        return jsonify({'error': 'Story not found'}), 404
+    
+    ticket = admission.admit()
+    if not ticket:
+        return busy_response()
+    try:
+        ticket.start()
+        upgrade_draft_story(story_id, ticket)
+    except (ValueError, StoryBusyError) as e:
+        ticket.finish()
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        ticket.finish()
+        print(f" Error upgrading story {story_id}: {e}")
+        return jsonify({'error': f'Story upgrade failed: {str(e)}'}), 500
+    
+    return jsonify({
+        'success': True,
+        'story_id': story_id,
+        'status': 'partial',
+        'reader_url': f'/reader/{story_id}',
+        'status_url': f'/api/story/{story_id}/status'
+    }), 202
+
+@app.route('/api/export')
+def export_stories():
+    """Stream stories as one tar archive: ?story_id=<id> (repeatable or comma-separated), ?since=, ?until="""
+    auth_error = archive_auth_error()
+    if auth_error:
+        return auth_error
+    story_ids = [story_id for value in request.args.getlist('story_id') for story_id in value.split(',') if story_id]
+    try:
+        since = parse_archive_time(request.args.get('since'))
+        until = parse_archive_time(request.args.get('until'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    selected = select_archive_stories(story_ids, since, until)
+    if not selected:
+        return jsonify({'error': 'No stories match'}), 404
+    
+    filename = f"stories_{time.strftime('%Y%m%d_%H%M%S')}.tar"
+    return Response(export_story_archive(selected), mimetype='application/x-tar',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/api/import', methods=['POST'])
+def import_stories():
+    """Store the stories in a tar archive sent as the request body; ?overwrite=1 replaces existing stories"""
+    import tarfile
+    
+    auth_error = archive_auth_error()
+    if auth_error:
+        return auth_error
+    try:
+        stats = import_story_archive(request.stream, overwrite=request_flag(request.args, 'overwrite'))
+    except (tarfile.TarError, ValueError, KeyError) as e:
+        return jsonify({'error': f'Invalid story archive: {e}'}), 400
+    return jsonify({'success': not stats['failed'], **stats})
+
 def check_environment():
     """Check all required environment variables and configurations"""
     required_vars = {
@@ -1075,6 +3979,34 @@ def check_environment():
         return False
     return True
 
+def preload_heavy_modules():
+    """Import ReportLab, Pillow and gTTS and build the shared PDF styles up front
+
+    Under gunicorn with preload_app this runs once in the master process, so
+    forked workers share the loaded modules and styles copy-on-write instead
+    of each paying for them on first use.
+    """
+    import PIL.Image
+    import PIL.ImageDraw
+    import PIL.ImageFont
+    import reportlab.platypus
+    import gtts
+    pdf_styles()
+    placeholder_base_image()
+
+# Heavy modules load lazily on first use unless the deployment asks for them up front
+if os.getenv('STORYBOOK_PRELOAD', '').lower() in ('1', 'true', 'yes'):
+    preload_heavy_modules()
+
+def start_background_threads():
+    """Start the warm library and task worker threads in a serving process
+
+    Never called at import, so the gunicorn master, the command-line tools and
+    anything else importing this module stay free of background threads.
+    """
+    start_warm_library()
+    start_task_worker()
+
 if __name__ == '__main__':
     # Check environment variables
     env_check = check_environment()
@@ -1101,6 +4033,9 @@ if __name__ == '__main__':
         print(f"\n🌐 Starting server on {host}:{port}")
         print(f"🔧 Debug mode: {'on' if debug else 'off'}")
         
+        # With the reloader on, only the child process that serves requests runs them
+        if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_background_threads()
         app.run(debug=debug, host=host, port=port)
     except Exception as e:
         print(f"\n❌ Failed to start application: {e}")
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Command-line tools for the Storybook app
+Runs the generation pipeline from app.py directly, without going through the web server
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import hashlib
+import tarfile
+import contextlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tts_backends import VOICES, SPEEDS
+
+STORY_LENGTHS = ('short', 'normal', 'long', 'extended')
+
+def read_batch_items(input_path):
+    """Read prompts from a JSONL file: one {"prompt": ..., "length": ..., "id": ...} object per line"""
+    items = []
+    with open(input_path, 'r') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{input_path}:{line_number}: invalid JSON ({e})")
+            if isinstance(entry, str):
+                entry = {'prompt': entry}
+            prompt = str(entry.get('prompt') or '').strip()
+            if not prompt:
+                raise ValueError(f"{input_path}:{line_number}: prompt is required")
+            length = entry.get('length', 'normal')
+            if length not in STORY_LENGTHS:
+                raise ValueError(f"{input_path}:{line_number}: length must be one of {', '.join(STORY_LENGTHS)}")
+            # The key identifies the entry across runs, so resuming skips finished stories
+            key = str(entry.get('id') or hashlib.sha256(f"{length}\n{prompt}".encode()).hexdigest()[:16])
+            narration = {'voice': entry.get('voice'), 'speed': entry.get('speed')}
+            if narration['voice'] and str(narration['voice']).lower() not in VOICES:
+                raise ValueError(f"{input_path}:{line_number}: voice must be one of {', '.join(VOICES)}")
+            if narration['speed'] and str(narration['speed']).lower() not in SPEEDS:
+                raise ValueError(f"{input_path}:{line_number}: speed must be one of {', '.join(SPEEDS)}")
+            items.append({'key': key, 'line': line_number, 'prompt': prompt, 'length': length, 'narration': narration})
+    return items
+
+def load_checkpoint(manifest_path):
+    """Keys of stories the manifest already records as complete"""
+    finished = set()
+    if not os.path.exists(manifest_path):
+        return finished
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # A run killed mid-write can leave a partial last line
+            if entry.get('status') == 'complete':
+                finished.add(entry['key'])
+    return finished
+
+def generate_one(app, item):
+    """Generate one story with the same pipeline as the server and return its manifest entry"""
+    started = time.time()
+    entry = {'key': item['key'], 'line': item['line'], 'prompt': item['prompt'], 'length': item['length']}
+    text_metrics = {}
+    try:
+        story_id = str(uuid.uuid4())[:8]
+        story_data = app.generate_story_pages(item['prompt'], item['length'], text_metrics)
+        app.save_story_record(story_id, app.new_story_record(story_data, item['length'], narration=item['narration']))
+        entry['story_id'] = story_id
+        entry['title'] = story_data.get('title', '')
+        entry['stats'] = app.generate_story_assets(story_id, story_data)
+        entry['pdf_path'] = app.load_story_record(story_id).get('pdf_path')
+        entry['status'] = 'complete'
+    except Exception as e:
+        entry['status'] = 'failed'
+        entry['error'] = str(e)
+    entry['text_metrics'] = text_metrics
+    entry['started_at'] = started
+    entry['seconds'] = round(time.time() - started, 2)
+    return entry
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def print_batch_stats(entries, skipped, elapsed):
+    """Print throughput and latency for the stories generated in this run"""
+    complete = [entry for entry in entries if entry['status'] == 'complete']
+    latencies = [entry['seconds'] for entry in complete]
+    pages = sum(entry['stats'].get('total_pages', 0) for entry in complete)
+    tokens = sum(entry['text_metrics'].get('prompt_tokens', 0) + entry['text_metrics'].get('completion_tokens', 0)
+                 for entry in entries)
+    minutes = elapsed / 60 if elapsed > 0 else 0
+
+    print("📊 Batch summary")
+    print(f"   stories     {len(complete)} complete, {len(entries) - len(complete)} failed, {skipped} skipped (already done)")
+    print(f"   elapsed     {elapsed:.1f} s")
+    if minutes:
+        print(f"   throughput  {len(complete) / minutes:.2f} stories/min, {pages / minutes:.1f} pages/min")
+    if latencies:
+        print(f"   latency     mean {sum(latencies) / len(latencies):.1f} s, p50 {percentile(latencies, 0.5):.1f} s, "
+              f"p90 {percentile(latencies, 0.9):.1f} s, max {max(latencies):.1f} s")
+    print(f"   LLM tokens  {tokens}")
+
+def run_batch(args):
+    items = read_batch_items(args.input)
+    manifest_path = args.manifest or f"{os.path.splitext(args.input)[0]}.manifest.jsonl"
+    if not args.resume and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    finished = load_checkpoint(manifest_path)
+    pending = [item for item in items if item['key'] not in finished]
+    skipped = len(items) - len(pending)
+
+    print(f"📚 {len(items)} stories in {args.input}: {len(pending)} to generate, {skipped} already complete")
+    print(f"   manifest: {manifest_path}, {args.workers} stories at a time")
+    if not pending:
+        return 0
+
+    # Imported here so --help and input errors do not pay for loading the app
+    import app
+
+    entries = []
+    manifest_lock = threading.Lock()
+    interrupted = False
+    started = time.time()
+    with open(manifest_path, 'a') as manifest, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        def record(future):
+            if future.cancelled():
+                return
+            entry = future.result()
+            with manifest_lock:
+                # Flushed per story so an interrupted run resumes where it stopped
+                manifest.write(json.dumps(entry, default=str) + "\n")
+                manifest.flush()
+                os.fsync(manifest.fileno())
+                entries.append(entry)
+                mark = "✅" if entry['status'] == 'complete' else "❌"
+                print(f"{mark} [{len(entries)}/{len(pending)}] line {entry['line']}: {entry.get('title') or entry.get('error')} ({entry['seconds']} s)")
+
+        futures = [executor.submit(generate_one, app, item) for item in pending]
+        for future in futures:
+            future.add_done_callback(record)
+        try:
+            for _ in as_completed(futures):
+                pass
+        except KeyboardInterrupt:
+            interrupted = True
+            print("⏹️  Interrupted; finishing the stories already in progress. Re-run to resume.")
+            for future in futures:
+                future.cancel()
+
+    print_batch_stats(entries, skipped, time.time() - started)
+    if interrupted:
+        return 130
+    return 0 if all(entry['status'] == 'complete' for entry in entries) else 1
+
+def run_export(args):
+    # The archive may go to stdout, so everything the app prints is sent to stderr
+    archive_stdout = sys.stdout.buffer
+    with contextlib.redirect_stdout(sys.stderr):
+        import app
+
+        since = app.parse_archive_time(args.since)
+        until = app.parse_archive_time(args.until)
+        story_ids = app.select_archive_stories(args.story_ids, since, until)
+        if not story_ids:
+            print("❌ No stories match")
+            return 1
+
+        stats = {}
+        output = archive_stdout if args.output == '-' else open(args.output, 'wb')
+        try:
+            for chunk in app.export_story_archive(story_ids, stats):
+                output.write(chunk)
+        finally:
+            if output is not archive_stdout:
+                output.close()
+        print(f"📦 {stats['stories']} stories, {stats['assets']} assets, {stats['bytes'] / 1e6:.1f} MB "
+              f"({stats['deduplicated']} deduplicated) in {stats['seconds']} s, {stats['mb_per_second']} MB/s")
+        for story_id in stats['skipped']:
+            print(f"⏭️  {story_id} is still generating; not exported")
+    return 0
+
+def run_import(args):
+    import app
+
+    source = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+    try:
+        stats = app.import_story_archive(source, overwrite=args.overwrite)
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+    print(f"📦 {stats['stories']} stories, {stats['assets']} assets, {stats['bytes'] / 1e6:.1f} MB written "
+          f"({stats['already_present']} already present, {stats['linked']} linked) in {stats['seconds']} s, "
+          f"{stats['mb_per_second']} MB/s")
+    if stats['skipped']:
+        print(f"⏭️  {len(stats['skipped'])} stories already exist (use --overwrite to replace them)")
+    for story_id in stats['failed']:
+        print(f"❌ {story_id}: archive ended before all of its assets")
+    return 1 if stats['failed'] else 0
+
+def main(argv=None):
+    # The tools run their own tasks in their own queue, so no server worker ever leases, resumes or repeats
+    # them, even after this process exits; an interrupted batch resumes from its manifest instead
+    os.environ.setdefault('TASK_WORKER', '0')
+    os.environ['TASK_QUEUE_URL'] = ''
+    os.environ['TASK_QUEUE_DB_PATH'] = os.getenv('CLI_TASK_QUEUE_DB_PATH', os.path.join("uploads", "cli_tasks.sqlite3"))
+    parser = argparse.ArgumentParser(description="Storybook command-line tools")
+    subcommands = parser.add_subparsers(dest='command', required=True)
+
+    batch = subcommands.add_parser('batch', help="Generate every story in a JSONL file of prompts")
+    batch.add_argument('input', help='JSONL file with one {"prompt": ..., "length": ...} object per line')
+    batch.add_argument('-j', '--workers', type=int, default=int(os.getenv("BACKGROUND_WORKERS", "4")),
+                       help='stories generated at once (default: BACKGROUND_WORKERS or 4)')
+    batch.add_argument('-m', '--manifest', help='results manifest and checkpoint (default: <input>.manifest.jsonl)')
+    batch.add_argument('--no-resume', dest='resume', action='store_false',
+                       help='start over instead of skipping stories the manifest records as complete')
+    batch.set_defaults(func=run_batch)
+
+    export = subcommands.add_parser('export', help="Write stories, with their images, audio and PDF, to a tar archive")
+    export.add_argument('story_ids', nargs='*', help='stories to export (default: every story)')
+    export.add_argument('-o', '--output', default='-', help='archive path, or - for stdout (default)')
+    export.add_argument('--since', help='only stories created at or after this time (epoch seconds or ISO 8601)')
+    export.add_argument('--until', help='only stories created before this time (epoch seconds or ISO 8601)')
+    export.set_defaults(func=run_export)
+
+    import_ = subcommands.add_parser('import', help="Store the stories in an archive written by export")
+    import_.add_argument('input', nargs='?', default='-', help='archive path, or - for stdin (default)')
+    import_.add_argument('--overwrite', action='store_true', help='replace stories that already exist')
+    import_.set_defaults(func=run_import)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except (OSError, ValueError, tarfile.TarError) as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
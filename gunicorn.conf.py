@@ -0,0 +1,30 @@
+"""
+Gunicorn settings for the Storybook app
+Loaded automatically when gunicorn is started from the project directory
+"""
+
+import gc
+import os
+
+# Import the app once in the master so workers share it copy-on-write
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1').lower() in ('1', 'true', 'yes')
+
+if preload_app:
+    # Let app.py import ReportLab, Pillow and gTTS before the workers fork
+    os.environ.setdefault('STORYBOOK_PRELOAD', '1')
+
+
+def pre_fork(server, worker):
+    # Move everything loaded so far out of the collector's reach; otherwise the
+    # first collection in each worker touches every object and un-shares its page
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    # Memory recycling measures growth from the size the worker had when it started, and
+    # background threads belong in the workers, never in the master
+    import app
+    if preload_app:
+        app.memory_profiler.baseline_rss()
+    app.start_background_threads()
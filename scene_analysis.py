@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Scene keyword extraction for illustration prompts
+Lexicons and the word pattern are compiled once at import; every page is classified in a single pass
+"""
+
+import re
+
+# Whole words of three or more characters; shorter words never contribute to a scene
+WORD_PATTERN = re.compile(r'\w{3,}')
+
+STOP_WORDS = frozenset({
+    'the', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'a', 'an',
+    'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had'
+})
+
+ACTION_WORDS = frozenset({
+    'run', 'walk', 'jump', 'fly', 'swim', 'dance', 'sing', 'play', 'laugh', 'smile', 'cry', 'sleep',
+    'eat', 'drink', 'climb', 'fall', 'sit', 'stand', 'look', 'see', 'find', 'meet', 'help', 'save',
+    'fight', 'hide', 'explore', 'discover', 'build', 'create', 'magic', 'adventure', 'chase', 'search',
+    'whisper', 'shout', 'giggle', 'dream', 'imagine', 'wonder', 'think', 'wish'
+})
+
+OBJECT_WORDS = frozenset({
+    'tree', 'flower', 'house', 'castle', 'forest', 'mountain', 'river', 'ocean', 'garden', 'bridge',
+    'door', 'window', 'book', 'treasure', 'crown', 'sword', 'wand', 'star', 'moon', 'sun', 'cloud',
+    'rainbow', 'path', 'road', 'street', 'shop', 'school', 'park', 'playground', 'beach', 'cave',
+    'island', 'ship', 'boat', 'train', 'car', 'bicycle', 'balloon', 'kite', 'toy', 'pet'
+})
+
+EMOTION_WORDS = frozenset({
+    'happy', 'sad', 'excited', 'scared', 'brave', 'worried', 'curious', 'proud', 'friendly',
+    'lonely', 'angry', 'peaceful', 'silly', 'surprised', 'confused', 'determined'
+})
+
+DYNAMIC_HINT_WORDS = ('run', 'jump', 'chase', 'dance')
+NATURE_WORDS = frozenset({'forest', 'garden', 'beach', 'mountain'})
+ARCHITECTURE_WORDS = frozenset({'castle', 'house', 'shop', 'school'})
+
+# One lookup classifies a lexicon word; emotions win over actions, actions over objects
+STOP, EMOTION, ACTION, OBJECT = range(4)
+WORD_CATEGORIES = {
+    **{word: OBJECT for word in OBJECT_WORDS},
+    **{word: ACTION for word in ACTION_WORDS},
+    **{word: EMOTION for word in EMOTION_WORDS},
+    **{word: STOP for word in STOP_WORDS},
+}
+
+def describe_scene(words):
+    """Build the scene description for one page from its lowercased words of three or more characters"""
+    emotion = None
+    action = None
+    objects = []
+    adverbs = []
+    nature = architecture = False
+    categories = WORD_CATEGORIES
+
+    for word in words:
+        category = categories.get(word)
+        if category == STOP:
+            continue
+        if category == EMOTION:
+            # The most recent emotion sets the mood
+            emotion = word
+        elif category == ACTION or word.endswith('ing'):
+            if action is None:
+                action = word
+        elif category == OBJECT:
+            if len(objects) < 2:
+                objects.append(word)
+            if word in NATURE_WORDS:
+                nature = True
+            elif word in ARCHITECTURE_WORDS:
+                architecture = True
+        elif word.endswith('ly') and len(adverbs) < 3:
+            adverbs.append(word)
+
+    scene_desc = []
+    if emotion:
+        scene_desc.append(f"feeling {emotion}")
+    if action:
+        scene_desc.append(action)
+    scene_desc.extend(objects)
+    scene_desc.extend(adverbs)
+    final_desc = ' '.join(scene_desc)
+
+    # Scene type hints
+    if any(word in final_desc for word in DYNAMIC_HINT_WORDS):
+        final_desc += ", dynamic action scene"
+    elif emotion:
+        final_desc += ", emotional moment"
+    elif nature:
+        final_desc += ", nature scene"
+    elif architecture:
+        final_desc += ", architectural setting"
+
+    return final_desc if final_desc else None
+
+def extract_scene_keywords(text):
+    """Extract key scene elements with enhanced context awareness"""
+    return describe_scene(WORD_PATTERN.findall(text.lower()))
+
+# Joins pages for the batch scan; lower() leaves no ASCII capitals, so it never collides with a real word
+PAGE_SEPARATOR = 'PAGEBREAK'
+
+def extract_scene_keywords_batch(texts):
+    """Scene keywords for many page texts, scanning them all with one regex pass"""
+    lowered = [text.lower() for text in texts]
+    words = WORD_PATTERN.findall(f' {PAGE_SEPARATOR} '.join(lowered))
+    words.append(PAGE_SEPARATOR)
+    results = []
+    start = 0
+    for _ in lowered:
+        end = words.index(PAGE_SEPARATOR, start)
+        results.append(describe_scene(words[start:end]))
+        start = end + 1
+    return results
+
+def story_scene_keywords(stories):
+    """Scene keywords for every page of every story: one list per story, in page order"""
+    stories = list(stories)
+    texts = [page['text'] for story in stories for page in story['pages']]
+    keywords = iter(extract_scene_keywords_batch(texts))
+    return [[next(keywords) for _ in story['pages']] for story in stories]
+
+def reference_extract_scene_keywords(text):
+    """The original per-call implementation, kept as the benchmark's reference for identical output"""
+    import re
+
+    stop_words = {'the', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'a', 'an',
+                 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had'}
+    action_words = set(ACTION_WORDS)
+    object_words = set(OBJECT_WORDS)
+    emotion_words = set(EMOTION_WORDS)
+
+    words = re.findall(r'\b\w+\b', text.lower())
+
+    scene_elements = []
+    for word in words:
+        if word not in stop_words and len(word) > 2:
+            if word in emotion_words:
+                scene_elements.insert(0, word)
+            elif word in action_words or word.endswith('ing'):
+                scene_elements.append(word)
+            elif word in object_words:
+                scene_elements.append(word)
+            elif word.endswith('ly'):
+                scene_elements.append(word)
+
+    scene_desc = []
+    emotions = [w for w in scene_elements if w in emotion_words]
+    actions = [w for w in scene_elements if w in action_words or w.endswith('ing')]
+    objects = [w for w in scene_elements if w in object_words]
+
+    if emotions:
+        scene_desc.append(f"feeling {emotions[0]}")
+    if actions:
+        scene_desc.append(actions[0])
+    if objects:
+        scene_desc.extend(objects[:2])
+
+    remaining_words = [w for w in scene_elements if w not in (emotions + actions + objects)]
+    scene_desc.extend(remaining_words[:3])
+
+    final_desc = ' '.join(scene_desc)
+
+    if any(word in final_desc for word in ['run', 'jump', 'chase', 'dance']):
+        final_desc += ", dynamic action scene"
+    elif any(word in emotion_words for word in words):
+        final_desc += ", emotional moment"
+    elif any(word in ['forest', 'garden', 'beach', 'mountain'] for word in words):
+        final_desc += ", nature scene"
+    elif any(word in ['castle', 'house', 'shop', 'school'] for word in words):
+        final_desc += ", architectural setting"
+
+    return final_desc if final_desc else None
+
+def benchmark_corpus(pages=20000, seed=7):
+    """Synthetic page texts mixing every lexicon with filler, -ing and -ly words"""
+    import random
+    rng = random.Random(seed)
+    vocabulary = (sorted(STOP_WORDS) * 6 + sorted(ACTION_WORDS) + sorted(OBJECT_WORDS) + sorted(EMOTION_WORDS)
+                  + ['little', 'bunny', 'quickly', 'slowly', 'running', 'singing', 'being', 'fly', 'hi', 'ok',
+                     'wondering', 'gently', 'Happy', 'CASTLE', 'café', 'naïve', 'kingdom', 'dragon', 'prune'])
+    corpus = []
+    for _ in range(pages):
+        sentences = []
+        for _ in range(rng.randint(1, 5)):
+            words = [rng.choice(vocabulary) for _ in range(rng.randint(4, 18))]
+            sentences.append(' '.join(words).capitalize() + rng.choice(['.', '!', '?', ', "Oh!"']))
+        corpus.append(' '.join(sentences))
+    return corpus
+
+def timed(func, *args, repeats=3):
+    """Best wall time of several runs, with the last run's result"""
+    import time
+
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    corpus = benchmark_corpus()
+    print(f"📊 Scene keyword benchmark over {len(corpus)} page texts (best of 3)")
+
+    reference_seconds, expected = timed(lambda: [reference_extract_scene_keywords(text) for text in corpus])
+    single_seconds, single = timed(lambda: [extract_scene_keywords(text) for text in corpus])
+    batch_seconds, batched = timed(extract_scene_keywords_batch, corpus)
+
+    mismatches = sum(1 for a, b, c in zip(expected, single, batched) if not (a == b == c))
+    print(f"   reference  {reference_seconds * 1000:8.1f} ms")
+    print(f"   compiled   {single_seconds * 1000:8.1f} ms  ({reference_seconds / single_seconds:.1f}x)")
+    print(f"   batch      {batch_seconds * 1000:8.1f} ms  ({reference_seconds / batch_seconds:.1f}x)")
+    print(f"   {'✅ identical output' if not mismatches else f'❌ {mismatches} mismatches'}")
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -9,6 +9,10 @@ document.addEventListener('DOMContentLoaded', function() {
         // Get form data
         const prompt = document.getElementById('prompt').value;
         const length = document.getElementById('length').value;
+        const draftInput = document.getElementById('draft');
+        const draft = draftInput ? draftInput.checked : false;
+        const voice = document.getElementById('voice')?.value;
+        const speed = document.getElementById('speed')?.value;
         
         // Show progress
         const progressCard = document.getElementById('progressCard');
@@ -24,64 +28,93 @@ document.addEventListener('DOMContentLoaded', function() {
         generateText.textContent = 'Generating...';
         
         try {
-            // Generate story
-            progressText.textContent = 'Creating your magical story...';
-            progressBar.style.width = '25%';
-            
-            // Update progress
-            progressBar.style.width = '25%';
             progressText.textContent = 'Generating story text...';
+            progressBar.style.width = '10%';
             
-            const response = await fetch('/generate', {
+            // One long-lived request that reports each page as it finishes
+            const response = await fetch('/generate/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'Accept': 'application/x-ndjson'
                 },
-                body: JSON.stringify({ prompt, length })
+                body: JSON.stringify({ prompt, length, draft, voice, speed })
             });
             
-            progressBar.style.width = '50%';
-            progressText.textContent = 'Creating illustrations...';
-            
-            if (!response.ok) {
+            if (!response.ok || !response.body) {
                 throw new Error('Story generation failed');
             }
             
-            const data = await response.json();
+            const downloadBtn = document.getElementById('downloadBtn');
+            const audiobookBtn = document.getElementById('audiobookBtn');
+            const readerBtn = document.getElementById('readerBtn');
+            const resultsCard = document.getElementById('resultsCard');
+            let totalSteps = 1;
+            let finishedSteps = 0;
             
-            if (data.success) {
-                progressBar.style.width = '100%';
-                progressText.textContent = 'Story is ready!';
-                
-                // Show results
-                const resultsCard = document.getElementById('resultsCard');
-                resultsCard.classList.remove('d-none');
-                
-                // Update download links with proper URLs
-                const storyId = data.story_id;
-                const downloadBtn = document.getElementById('downloadBtn');
-                const audiobookBtn = document.getElementById('audiobookBtn');
-                const readerBtn = document.getElementById('readerBtn');
-                
-                downloadBtn.href = `/download-pdf/${storyId}`;
-                audiobookBtn.href = `/download-audiobook/${storyId}`;
-                readerBtn.href = `/reader/${storyId}`;
-                
-                // Enable buttons
-                downloadBtn.classList.remove('disabled');
-                audiobookBtn.classList.remove('disabled');
-                readerBtn.classList.remove('disabled');
-                
-                // Add click handler for reader button
-                readerBtn.onclick = (e) => {
-                    e.preventDefault();
-                    window.location.href = `/reader/${storyId}`;
-                };
-                
-                // Scroll to results
-                resultsCard.scrollIntoView({ behavior: 'smooth' });
-            } else {
-                throw new Error(data.error || 'Story generation failed');
+            const handleEvent = (data) => {
+                switch (data.event) {
+                    case 'story': {
+                        const storyId = data.story_id;
+                        // Two assets per page plus the PDF
+                        totalSteps = data.story_data.pages.length * 2 + 1;
+                        progressBar.style.width = '20%';
+                        progressText.textContent = `"${data.story_data.title}" is written! Creating illustrations...`;
+                        
+                        downloadBtn.href = `/download-pdf/${storyId}`;
+                        audiobookBtn.href = `/download-audiobook/${storyId}`;
+                        readerBtn.href = data.reader_url;
+                        
+                        // The reader opens right away; downloads wait until every asset exists
+                        readerBtn.classList.remove('disabled');
+                        downloadBtn.classList.add('disabled');
+                        audiobookBtn.classList.add('disabled');
+                        readerBtn.onclick = (e) => {
+                            e.preventDefault();
+                            window.location.href = data.reader_url;
+                        };
+                        resultsCard.classList.remove('d-none');
+                        break;
+                    }
+                    case 'page_image':
+                    case 'page_audio':
+                    case 'pdf': {
+                        finishedSteps += 1;
+                        progressBar.style.width = `${20 + Math.round(80 * finishedSteps / totalSteps)}%`;
+                        if (data.event === 'page_image') {
+                            progressText.textContent = `Illustrated page ${data.page}...`;
+                        } else if (data.event === 'page_audio') {
+                            progressText.textContent = `Recorded narration for page ${data.page}...`;
+                        } else {
+                            progressText.textContent = 'Built your PDF storybook...';
+                        }
+                        break;
+                    }
+                    case 'complete':
+                        progressBar.style.width = '100%';
+                        progressText.textContent = 'Story is ready!';
+                        downloadBtn.classList.toggle('disabled', !data.pdf_url);
+                        audiobookBtn.classList.toggle('disabled', !data.audiobook_url);
+                        resultsCard.scrollIntoView({ behavior: 'smooth' });
+                        break;
+                    case 'error':
+                        throw new Error(data.error || 'Story generation failed');
+                }
+            };
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffered = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffered += decoder.decode(value, { stream: true });
+                const lines = buffered.split('\n');
+                buffered = lines.pop();
+                lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)));
+            }
+            if (buffered.trim()) {
+                handleEvent(JSON.parse(buffered));
             }
         } catch (error) {
             // Show error
@@ -2,6 +2,11 @@
 let currentPage = 1;
 let isPlaying = false;
 let isAutoPlaying = false;
+let statusPollTimer = null;
+const prefetchedAssets = new Set();
+const STATUS_POLL_INTERVAL = 2000;
+// 'partial' stories show placeholders while slow pages are backfilled
+const ACTIVE_STATUSES = ['generating', 'partial'];
 
 // Initialize story on page load
 document.addEventListener('DOMContentLoaded', function() {
@@ -28,6 +33,11 @@ document.addEventListener('DOMContentLoaded', function() {
 
         // Setup progress tracking
         audio.addEventListener('timeupdate', updateAudioProgress);
+
+        // Pages of a story that is still generating fill in as their assets finish
+        if (window.storyStatus && window.storyStatus !== 'complete') {
+            pollStoryStatus();
+        }
     } catch (error) {
         StorybookUtils.showNotification('Failed to load story', 'danger');
     }
@@ -64,15 +74,7 @@ function updatePage(pageNum) {
         }
         
         // Update image
-        const pageImage = document.getElementById('pageImage');
-        pageImage.style.display = 'none'; // Hide by default
-        if (window.imagePaths && window.imagePaths[pageNum - 1]) {
-            const imagePath = window.imagePaths[pageNum - 1];
-            if (imagePath) {
-                pageImage.src = '/image/' + imagePath;
-                pageImage.style.display = 'block';
-            }
-        }
+        updatePageImage(pageNum);
         
         // Update audio source
         const pageAudio = document.getElementById('pageAudio');
@@ -86,6 +88,9 @@ function updatePage(pageNum) {
         } else {
             pageAudio.src = '';
         }
+
+        // Warm the cache for the page the reader will most likely open next
+        prefetchPage(pageNum + 1);
     } catch (error) {
         console.error('Error updating page:', error);
         StorybookUtils.showNotification('Error loading page content', 'danger');
@@ -104,6 +109,123 @@ function updatePage(pageNum) {
     document.getElementById('nextBtn').disabled = pageNum === window.storyData.pages.length;
 }
 
+function updatePageImage(pageNum) {
+    const pageImage = document.getElementById('pageImage');
+    const imagePending = document.getElementById('imagePending');
+    const imagePath = window.imagePaths ? window.imagePaths[pageNum - 1] : '';
+
+    pageImage.style.display = 'none'; // Hide by default
+    if (imagePending) {
+        imagePending.style.display = 'none';
+    }
+    if (imagePath) {
+        pageImage.src = '/image/' + imagePath;
+        pageImage.style.display = 'block';
+    } else if (imagePending && ACTIVE_STATUSES.includes(window.storyStatus)) {
+        imagePending.style.display = 'flex';
+    }
+}
+
+function prefetchPage(pageNum) {
+    if (!window.storyData || pageNum < 1 || pageNum > window.storyData.pages.length) {
+        return;
+    }
+
+    const imagePath = window.imagePaths ? window.imagePaths[pageNum - 1] : '';
+    if (imagePath && !prefetchedAssets.has(imagePath)) {
+        prefetchedAssets.add(imagePath);
+        const image = new Image();
+        image.src = '/image/' + imagePath;
+    }
+
+    const audioPath = window.audioPaths ? window.audioPaths[pageNum - 1] : '';
+    if (audioPath && !prefetchedAssets.has(audioPath)) {
+        prefetchedAssets.add(audioPath);
+        const link = document.createElement('link');
+        link.rel = 'prefetch';
+        link.as = 'audio';
+        link.href = '/audio/' + audioPath;
+        document.head.appendChild(link);
+    }
+}
+
+function assetName(asset) {
+    // Status URLs look like /image/<name>?v=<version>; the reader stores just <name>?v=<version>
+    return asset && asset.url ? asset.url.split('/').pop() : '';
+}
+
+function pollStoryStatus() {
+    fetch('/api/story/' + window.storyId + '/status')
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('Status request failed');
+            }
+            return response.json();
+        })
+        .then(status => {
+            applyStoryStatus(status);
+            if (ACTIVE_STATUSES.includes(status.status)) {
+                statusPollTimer = setTimeout(pollStoryStatus, STATUS_POLL_INTERVAL);
+            } else if (status.status === 'complete') {
+                StorybookUtils.showNotification('All illustrations and narration are ready!', 'success');
+            }
+        })
+        .catch(error => {
+            console.error('Error polling story status:', error);
+            statusPollTimer = setTimeout(pollStoryStatus, STATUS_POLL_INTERVAL * 2);
+        });
+}
+
+function upgradeStory() {
+    const upgradeBtn = document.getElementById('upgradeBtn');
+    upgradeBtn.disabled = true;
+    fetch('/api/story/' + window.storyId + '/upgrade', { method: 'POST' })
+        .then(response => response.json().then(data => ({ ok: response.ok, data })))
+        .then(({ ok, data }) => {
+            if (!ok) {
+                throw new Error(data.error || 'Upgrade failed');
+            }
+            upgradeBtn.style.display = 'none';
+            window.storyStatus = data.status;
+            StorybookUtils.showNotification('Painting full-quality illustrations and recording narration...', 'info');
+            clearTimeout(statusPollTimer);
+            pollStoryStatus();
+        })
+        .catch(error => {
+            upgradeBtn.disabled = false;
+            StorybookUtils.showNotification(error.message, 'danger');
+        });
+}
+
+function applyStoryStatus(status) {
+    window.storyStatus = status.status;
+    let currentImageChanged = false;
+    let currentAudioChanged = false;
+
+    status.pages.forEach((page, index) => {
+        const imagePath = assetName(page.image);
+        const audioPath = assetName(page.audio);
+        if (imagePath !== (window.imagePaths[index] || '')) {
+            window.imagePaths[index] = imagePath;
+            currentImageChanged = currentImageChanged || index === currentPage - 1;
+        }
+        if (audioPath !== (window.audioPaths[index] || '')) {
+            window.audioPaths[index] = audioPath;
+            currentAudioChanged = currentAudioChanged || index === currentPage - 1;
+        }
+    });
+
+    // Refresh the open page in place without interrupting narration that is already playing
+    if (currentImageChanged || !ACTIVE_STATUSES.includes(status.status)) {
+        updatePageImage(currentPage);
+    }
+    if (currentAudioChanged && !isPlaying) {
+        const audioPath = window.audioPaths[currentPage - 1];
+        document.getElementById('pageAudio').src = audioPath ? '/audio/' + audioPath : '';
+    }
+    prefetchPage(currentPage + 1);
+}
+
 function toggleAudio() {
     const audio = document.getElementById('pageAudio');
     const playBtn = document.getElementById('playBtn');
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Static asset pipeline for the Storybook app
+Minifies the stylesheets and scripts at startup, fingerprints them with a content hash
+and serves precompressed gzip/brotli variants with immutable cache headers
+"""
+
+import os
+import re
+import gzip
+import uuid
+import fcntl
+import hashlib
+import mimetypes
+
+from flask import request, send_file
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only gzip variants are written
+    brotli = None
+
+# Build output lives under the static folder so the default route can reach it
+STATIC_DIST_DIR = 'dist'
+# Held while building, so workers starting together build one at a time instead of racing
+STATIC_BUILD_LOCK = '.build.lock'
+STATIC_EXTENSIONS = ('.css', '.js')
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", str(365 * 24 * 3600)))
+# Negotiated in this order of preference when the client accepts several
+STATIC_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+CSS_SPACE_AROUND = re.compile(r'\s*([{};,>])\s*')
+
+def minify_css(source):
+    """Drop comments and whitespace that carries no meaning in a stylesheet"""
+    css = CSS_COMMENT.sub('', source)
+    css = re.sub(r'\s+', ' ', css)
+    css = CSS_SPACE_AROUND.sub(r'\1', css)
+    # Space before a colon can be a descendant selector (".card :hover"); only the one after is safe to drop
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip() + '\n'
+
+def ends_inside_template(line, in_template):
+    """Whether a JavaScript template literal is still open at the end of this line"""
+    quote = '`' if in_template else None
+    i = 0
+    while i < len(line):
+        char = line[i]
+        if char == '\\':
+            i += 2
+            continue
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '\'"`':
+            quote = char
+        elif line.startswith('//', i):
+            break
+        i += 1
+    return quote == '`'
+
+def minify_js(source):
+    """Strip indentation, blank lines and whole-line comments from a script
+
+    Line breaks are kept so automatic semicolon insertion behaves exactly as in
+    the source, and lines inside multi-line template literals are left verbatim.
+    """
+    lines = []
+    in_template = False
+    for line in source.splitlines():
+        if in_template:
+            lines.append(line)
+        else:
+            stripped = line.strip()
+            if stripped and not stripped.startswith('//'):
+                lines.append(stripped)
+        in_template = ends_inside_template(line, in_template)
+    return '\n'.join(lines) + '\n'
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+def write_atomically(filepath, data):
+    """Write bytes to a temporary file and move it into place, so concurrent builds never serve half a file"""
+    temp_path = f"{filepath}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, filepath)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def build_static_assets(static_folder):
+    """Minify, fingerprint and precompress every stylesheet and script in static_folder
+
+    Returns the manifest mapping each source filename to its fingerprinted
+    path under dist/. Builds from earlier content are removed. Processes
+    building at the same time take turns; whoever goes second finds every
+    file already in place and writes nothing.
+    """
+    dist_folder = os.path.join(static_folder, STATIC_DIST_DIR)
+    os.makedirs(dist_folder, exist_ok=True)
+    with open(os.path.join(dist_folder, STATIC_BUILD_LOCK), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            return build_into(static_folder, dist_folder)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def build_into(static_folder, dist_folder):
+    """Write the build for build_static_assets; the caller holds the build lock"""
+    manifest = {}
+    outputs = set()
+
+    for filename in sorted(os.listdir(static_folder)):
+        stem, extension = os.path.splitext(filename)
+        source_path = os.path.join(static_folder, filename)
+        if extension not in STATIC_EXTENSIONS or not os.path.isfile(source_path):
+            continue
+        with open(source_path, 'r', encoding='utf-8') as f:
+            source = f.read()
+        minified = MINIFIERS[extension](source).encode('utf-8')
+        digest = hashlib.sha256(minified).hexdigest()[:12]
+        built_name = f"{stem}.{digest}{extension}"
+        built_path = os.path.join(dist_folder, built_name)
+
+        encoders = {'': lambda data: data, '.gz': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            encoders['.br'] = lambda data: brotli.compress(data, quality=11)
+        written = {}
+        for suffix, encode in encoders.items():
+            outputs.add(built_name + suffix)
+            # Content-addressed, so a file that already exists is already correct and is not compressed again
+            if not os.path.exists(built_path + suffix):
+                written[suffix] = encode(minified)
+                write_atomically(built_path + suffix, written[suffix])
+
+        manifest[filename] = f"{STATIC_DIST_DIR}/{built_name}"
+        if written:
+            sizes = ', '.join(f"{suffix.lstrip('.') or 'min'} {len(data)}" for suffix, data in written.items())
+            print(f"📦 {filename} -> {manifest[filename]} ({len(source.encode('utf-8'))} bytes; {sizes})")
+
+    for filename in os.listdir(dist_folder):
+        if filename not in outputs and filename != STATIC_BUILD_LOCK and not filename.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(dist_folder, filename))
+            except FileNotFoundError:
+                pass
+    return manifest
+
+def negotiated_encoding(built_path):
+    """The best precompressed variant of built_path the client accepts, as (encoding, path)"""
+    for encoding, suffix in STATIC_ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.exists(built_path + suffix):
+            return encoding, built_path + suffix
+    return None, built_path
+
+def install_static_assets(app):
+    """Build the assets and make url_for('static') and the static route use them
+
+    Templates keep calling url_for('static', filename='style.css'); the
+    fingerprinted name is substituted automatically. Files outside the
+    manifest are served by Flask as before. If the build fails, for example
+    on a read-only static folder, the unminified files are served instead.
+    """
+    try:
+        manifest = build_static_assets(app.static_folder)
+    except OSError as e:
+        print(f"⚠️ Static asset build failed, serving unminified files: {e}")
+        return {}
+    fingerprinted = set(manifest.values())
+    send_static_file = app.view_functions['static']
+
+    @app.url_defaults
+    def fingerprint_static_url(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values['filename'] = manifest[values['filename']]
+
+    def serve_static(filename):
+        if filename not in fingerprinted:
+            return send_static_file(filename=filename)
+        built_path = os.path.join(app.static_folder, filename)
+        encoding, path = negotiated_encoding(built_path)
+        response = send_file(path, mimetype=mimetypes.guess_type(filename)[0], max_age=STATIC_MAX_AGE)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        # The name changes whenever the content does, so caches never need to revalidate
+        response.headers['Cache-Control'] = f"public, max-age={STATIC_MAX_AGE}, immutable"
+        return response
+
+    app.view_functions['static'] = serve_static
+    return manifest
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Speech backends for page narration
+Text is split on sentence boundaries, the chunks are synthesized concurrently on a bounded
+pool and the audio is joined in order, so a page takes about as long as its longest chunk
+"""
+
+import re
+import time
+import inspect
+import base64
+from concurrent.futures import ThreadPoolExecutor
+
+# The Google Translate speech endpoint behind gTTS takes at most 100 characters per request
+TTS_CHUNK_CHARS = 100
+
+VOICES = ('us', 'uk', 'au', 'in', 'ca')
+SPEEDS = ('normal', 'slow')
+
+# A sentence runs to its closing punctuation plus any closing quotes or brackets
+SENTENCE_PATTERN = re.compile(r'.+?(?:[.!?]+["”’\')\]]*(?=\s|$)|$)', re.S)
+
+def split_long_sentence(sentence, max_chars):
+    """Cut a sentence longer than max_chars at the last comma, semicolon or space that fits"""
+    pieces = []
+    while len(sentence) > max_chars:
+        window = sentence[:max_chars + 1]
+        cut = max(window.rfind(', '), window.rfind('; '), window.rfind(': '))
+        cut = cut + 1 if cut > 0 else window.rfind(' ')
+        if cut <= 0:
+            cut = max_chars
+        pieces.append(sentence[:cut].strip())
+        sentence = sentence[cut:].strip()
+    if sentence:
+        pieces.append(sentence)
+    return pieces
+
+def split_sentences(text, max_chars=TTS_CHUNK_CHARS):
+    """Speech chunks of at most max_chars characters, each ending on a sentence boundary where possible
+
+    Neighbouring short sentences share a chunk while they fit, so a page
+    never needs more requests than its length requires.
+    """
+    chunks = []
+    for match in SENTENCE_PATTERN.finditer(' '.join(text.split())):
+        for piece in split_long_sentence(match.group().strip(), max_chars):
+            if chunks and len(chunks[-1]) + 1 + len(piece) <= max_chars:
+                chunks[-1] = f"{chunks[-1]} {piece}"
+            elif piece:
+                chunks.append(piece)
+    return chunks
+
+class TTSBackend:
+    """One speech provider: synthesize() turns a short text chunk into encoded audio bytes
+
+    Chunks in the backend's format must be joinable by concatenation, as MP3
+    frames are.
+    """
+
+    name = None
+    extension = 'mp3'
+
+    def synthesize(self, text, voice, speed):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class GTTSBackend(TTSBackend):
+    """Google Translate speech through gTTS, with every request on one pooled HTTPS session
+
+    gTTS itself opens a new connection per 100-character request and sends
+    them one after another; here gTTS only builds the request bodies.
+    """
+
+    name = 'gtts'
+    # Voices are Google Translate regional hosts, which change the accent
+    VOICE_HOSTS = {'us': 'com', 'uk': 'co.uk', 'au': 'com.au', 'in': 'co.in', 'ca': 'ca'}
+    AUDIO_PATTERN = re.compile(r'jQ1olc","\[\\"(.*)\\"]')
+
+    def __init__(self, lang='en', pool_size=8, timeout=30):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.lang = lang
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=len(self.VOICE_HOSTS), pool_maxsize=pool_size))
+
+    def synthesize(self, text, voice, speed):
+        from gtts import gTTS
+
+        host = self.VOICE_HOSTS[voice]
+        tts = gTTS(text=text, lang=self.lang, tld=host, slow=speed == 'slow')
+        url = f"https://translate.google.{host}/_/TranslateWebserverUi/data/batchexecute"
+        audio = bytearray()
+        for body in tts.get_bodies():
+            response = self.session.post(url, data=body, headers=gTTS.GOOGLE_TTS_HEADERS, timeout=self.timeout)
+            response.raise_for_status()
+            match = self.AUDIO_PATTERN.search(response.text)
+            if not match:
+                raise RuntimeError(f"gTTS returned no audio for {text[:40]!r}")
+            audio += base64.b64decode(match.group(1))
+        return bytes(audio)
+
+    def close(self):
+        self.session.close()
+
+class StubBackend(TTSBackend):
+    """Offline backend for tests and benchmarks: silent MP3 sized like real speech after a simulated delay
+
+    Each call sleeps latency seconds plus seconds_per_char per character,
+    roughly a remote request's round trip and synthesis time.
+    """
+
+    name = 'stub'
+    # One silent MPEG-1 Layer III frame: 128 kbps, 44.1 kHz, mono, 1152 samples (about 26 ms)
+    SILENT_FRAME = b'\xff\xfb\x90\xc0' + b'\x00' * 413
+    FRAME_SECONDS = 1152 / 44100
+    SPOKEN_SECONDS_PER_CHAR = 0.06
+
+    def __init__(self, latency=0.15, seconds_per_char=0.002):
+        self.latency = latency
+        self.seconds_per_char = seconds_per_char
+
+    def synthesize(self, text, voice, speed):
+        time.sleep(self.latency + self.seconds_per_char * len(text))
+        spoken_seconds = len(text) * self.SPOKEN_SECONDS_PER_CHAR * (1.5 if speed == 'slow' else 1)
+        return self.SILENT_FRAME * max(1, round(spoken_seconds / self.FRAME_SECONDS))
+
+BACKENDS = {'gtts': GTTSBackend, 'stub': StubBackend}
+
+def create_backend(name, **options):
+    """Instantiate a backend by name, passing only the options it accepts"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown TTS backend {name!r}; choose one of {', '.join(BACKENDS)}")
+    backend = BACKENDS[name]
+    accepted = inspect.signature(backend).parameters
+    return backend(**{key: value for key, value in options.items() if key in accepted})
+
+class ChunkedSpeech:
+    """Narrates text chunk by chunk on a shared bounded pool and writes the audio in order"""
+
+    def __init__(self, backend, workers=8, max_chars=TTS_CHUNK_CHARS):
+        self.backend = backend
+        self.max_chars = max_chars
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts")
+
+    def timed_chunk(self, text, voice, speed):
+        started = time.time()
+        audio = self.backend.synthesize(text, voice, speed)
+        return audio, time.time() - started
+
+    def synthesize(self, text, out_file, voice='us', speed='normal'):
+        """Write the narration of text to out_file; returns chunk count and timings"""
+        chunks = split_sentences(text, self.max_chars)
+        if not chunks:
+            raise ValueError("No text to narrate")
+        started = time.time()
+        futures = [self.pool.submit(self.timed_chunk, chunk, voice, speed) for chunk in chunks]
+        longest = 0.0
+        try:
+            for future in futures:
+                audio, seconds = future.result()
+                out_file.write(audio)
+                longest = max(longest, seconds)
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        return {'chunks': len(chunks), 'seconds': time.time() - started, 'longest_chunk_seconds': longest}
+
+def main():
+    import io
+
+    backend = StubBackend()
+    page = ("Luna the little fox tiptoed through the silver forest, listening to the owls whisper secrets. "
+            "Suddenly, a glowing butterfly landed on her nose! \"Follow me,\" it giggled, fluttering toward the river. "
+            "Luna hesitated, remembering her mother's warning about wandering too far from the den. "
+            "But the butterfly's light was so warm and friendly that she took one brave step, and then another. "
+            "Together they crossed the old stone bridge, where the water sang softly beneath them.")
+    chunks = split_sentences(page)
+    print(f"📊 TTS benchmark with the stub backend: {len(page)} characters, {len(chunks)} chunks "
+          f"(longest {max(len(chunk) for chunk in chunks)})")
+
+    started = time.time()
+    for chunk in chunks:
+        backend.synthesize(chunk, 'us', 'normal')
+    serial_seconds = time.time() - started
+
+    speech = ChunkedSpeech(backend, workers=8)
+    stats = speech.synthesize(page, io.BytesIO())
+    print(f"   one request at a time  {serial_seconds:6.2f} s")
+    print(f"   chunks in parallel     {stats['seconds']:6.2f} s  ({serial_seconds / stats['seconds']:.1f}x, "
+          f"longest chunk {stats['longest_chunk_seconds']:.2f} s)")
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())